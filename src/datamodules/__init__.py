@@ -1,7 +1,9 @@
+from .collate import BatchCollator
 from .landcover import MODISJDLandcoverSimpleDataModule
 from .modis_landsat import MODISJDLandcoverSimpleLandsatDataModule
 
 __all__ = (
+    "BatchCollator",
     "MODISJDLandcoverSimpleDataModule",
     "MODISJDLandcoverSimpleLandsatDataModule",
 )
@@ -0,0 +1,235 @@
+import time
+import warnings
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+import torch
+from torch import Tensor
+from torch.utils.data import get_worker_info
+from torchgeo.datasets import BoundingBox, stack_samples
+
+
+class BatchCollator:
+    """Collates samples into reusable, preallocated batch tensors.
+
+    Unlike stack_samples, which allocates new batch tensors every step, the samples
+    of each key are stacked in place into one of 'ring_size' buffers, used in turn.
+    In DataLoader workers the buffers are in shared memory, so sending a batch to the
+    main process only sends a handle to them, rather than copying it into a new shared
+    memory segment. In the main process (num_workers=0) they are in pinned memory
+    (with pin_memory set and CUDA available), so batches are copied to the GPU
+    directly and asynchronously.
+    A buffer is overwritten 'ring_size' batches after it was filled, so the batch must
+    have been used (or copied to the device) by then. DataLoader workers are at most
+    'prefetch_factor' batches ahead of the training step, so a ring_size larger than
+    prefetch_factor + 1 is safe, as long as batches are not kept (e.g. by callbacks).
+    Copying a batch to a GPU frees its buffer, but on the CPU the model would be given
+    the buffer itself, so batches are then copied out of it (see copy_batch).
+    Metadata (crs and bbox) is dropped, or compacted with keep_metadata into one crs
+    and a (batch, 6) float64 tensor of the bounding boxes.
+    Args:
+        ring_size: number of buffers of each key, used in turn.
+        pin_memory: set True to pin the buffers of the main process.
+        keep_metadata: set True to keep the crs and bbox of the samples.
+        share_memory: set True (or False) to put the buffers in shared memory, which
+            defaults to doing so in DataLoader workers only.
+    """
+
+    def __init__(
+        self,
+        ring_size: int = 4,
+        pin_memory: bool = False,
+        keep_metadata: bool = False,
+        share_memory: Optional[bool] = None,
+    ) -> None:
+
+        self.ring_size = ring_size
+        self.pin_memory = pin_memory
+        self.keep_metadata = keep_metadata
+        self.share_memory = share_memory
+
+        # (key, shape, dtype) -> buffers, and the number of batches collated
+        self.buffers: Dict[Tuple[str, torch.Size, torch.dtype], List[Tensor]] = {}
+        self.batches = 0
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Workers allocate their own buffers, rather than sharing these
+        state = self.__dict__.copy()
+        state["buffers"] = {}
+        state["batches"] = 0
+        return state
+
+    def __call__(self, samples: Sequence[Dict[str, Any]]) -> Dict[str, Any]:
+        """Collates a list of samples into a batch.
+
+        Args:
+            samples: the samples, with tensors of the same shape and dtype per key.
+        Returns:
+            batch: a (batch, ...) tensor per key of the samples, and the compacted
+                metadata if keep_metadata is set.
+        """
+
+        slot = self.batches % self.ring_size
+        self.batches += 1
+
+        batch: Dict[str, Any] = {}
+        for key, value in samples[0].items():
+            if isinstance(value, Tensor):
+                values = [sample[key] for sample in samples]
+                out = self.get_buffer(key, (len(values),) + value.shape, value.dtype)
+                batch[key] = torch.stack(values, out=out[slot])
+
+            elif self.keep_metadata and key == "bbox":
+                batch[key] = torch.tensor(
+                    [tuple(sample[key]) for sample in samples], dtype=torch.float64
+                )
+            elif self.keep_metadata and key == "crs":
+                batch[key] = value
+
+        return batch
+
+    def get_buffer(
+        self, key: str, shape: Tuple[int, ...], dtype: torch.dtype
+    ) -> List[Tensor]:
+        """Returns the buffers of a key, shape and dtype, allocating them if needed."""
+
+        buffer_key = (key, torch.Size(shape), dtype)
+        if buffer_key not in self.buffers:
+            share_memory = self.share_memory
+            if share_memory is None:
+                share_memory = get_worker_info() is not None
+
+            if share_memory:
+                buffers = [
+                    torch.empty(shape, dtype=dtype).share_memory_()
+                    for _ in range(self.ring_size)
+                ]
+            else:
+                pin = self.pin_memory and torch.cuda.is_available()
+                buffers = [
+                    torch.empty(shape, dtype=dtype, pin_memory=pin)
+                    for _ in range(self.ring_size)
+                ]
+            self.buffers[buffer_key] = buffers
+
+        return self.buffers[buffer_key]
+
+
+def copy_batch(batch: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns a batch whose tensors are copies, rather than the (reused) buffers of a
+    BatchCollator.
+
+    The datamodules do this in place of the transfer to the device when training on
+    the CPU, warning that the buffers then cost a copy rather than saving one.
+    """
+
+    warnings.warn(
+        "Batches are collated into reusable buffers (collate_buffers > 0) but the "
+        "model is on the CPU, so every batch is copied out of its buffer. Set "
+        "collate_buffers to 0 to train on the CPU."
+    )
+    return {
+        key: value.clone() if isinstance(value, Tensor) else value
+        for key, value in batch.items()
+    }
+
+
+def random_samples(
+    batch_size: int,
+    patch_size: int = 256,
+    bands: Sequence[Tuple[str, int, torch.dtype]] = (
+        ("image", 13, torch.float32),
+        ("mask", 0, torch.int64),
+    ),
+) -> List[Dict[str, Any]]:
+    """Returns random samples shaped like those of the datamodules.
+
+    Args:
+        batch_size: number of samples.
+        patch_size: height and width of the samples, in pixels.
+        bands: (key, number of bands, dtype) of each tensor of the samples, with 0
+            bands for (height, width) tensors such as the masks.
+    """
+
+    samples = []
+    for i in range(batch_size):
+        sample: Dict[str, Any] = {"bbox": BoundingBox(i, i + 1, 0, 1, 0, 1)}
+        for key, num_bands, dtype in bands:
+            shape = (num_bands,) if num_bands > 0 else ()
+            sample[key] = torch.randint(0, 100, shape + (patch_size, patch_size)).to(
+                dtype
+            )
+        samples.append(sample)
+
+    return samples
+
+
+def collate_latency(
+    collate_fn: Callable[[Sequence[Dict[str, Any]]], Dict[str, Any]],
+    samples: Sequence[Dict[str, Any]],
+    num_batches: int = 20,
+    worker: bool = False,
+) -> np.ndarray:
+    """Returns the time (in ms) taken to collate a batch of samples, num_batches
+    times.
+
+    Args:
+        worker: set True to also move the batch to shared memory, as a DataLoader
+            worker does to send it to the main process.
+    """
+
+    times = []
+    for _ in range(num_batches):
+        start = time.perf_counter()
+        batch = collate_fn(samples)
+        if worker:
+            for value in batch.values():
+                if isinstance(value, Tensor):
+                    value.share_memory_()
+        times.append(time.perf_counter() - start)
+
+    return 1000 * np.array(times)
+
+
+def benchmark(
+    patch_size: int = 256,
+    batch_sizes: Sequence[int] = (16, 32, 64),
+    num_batches: int = 20,
+    worker: bool = False,
+    pin_memory: bool = False,
+) -> Dict[Tuple[str, int], Tuple[float, float]]:
+    """Compares the latency of stack_samples and BatchCollator, on samples shaped
+    like those of the datamodules (landcover and sentinel bands, and MODIS mask).
+
+    Args:
+        patch_size: size of the samples, in pixels.
+        batch_sizes: batch sizes to compare.
+        num_batches: batches collated per batch size (after one warm up batch).
+        worker: set True to include sending the batch from a worker, see
+            collate_latency.
+        pin_memory: set True to pin the buffers of the BatchCollator.
+    Returns:
+        latency: mean and median time to collate a batch, in ms, of each collate
+            function ("stack_samples" or "BatchCollator") and batch size.
+    """
+
+    latency = {}
+    for batch_size in batch_sizes:
+        samples = random_samples(batch_size, patch_size)
+        collators = {
+            "stack_samples": stack_samples,
+            "BatchCollator": BatchCollator(pin_memory=pin_memory, share_memory=worker),
+        }
+        for name, collate_fn in collators.items():
+            collate_latency(collate_fn, samples, 1, worker)
+            ms = collate_latency(collate_fn, samples, num_batches, worker)
+            latency[name, batch_size] = (float(ms.mean()), float(np.median(ms)))
+
+    return latency
+
+
+if __name__ == "__main__":
+
+    for worker in [False, True]:
+        print("worker (with IPC)" if worker else "main process")
+        for (name, batch_size), (mean, median) in benchmark(worker=worker).items():
+            print(f"  {name} x{batch_size}: mean {mean:.2f} ms, median {median:.2f} ms")
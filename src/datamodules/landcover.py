@@ -1,14 +1,45 @@
-from typing import Any, Dict, Optional
-
-from ..datasets import LandcoverSimple, MODIS_JD, Sentinel2, Landsat7
-from ..samplers import ConstrainedRandomBatchGeoSampler
+import functools
+import hashlib
+import math
+import os
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+
+from ..datasets import (
+    ChipDataset,
+    CoalescingReader,
+    ConcurrentReader,
+    ERA5LandCube,
+    LabelledReader,
+    LandcoverSimple,
+    MODIS_JD,
+    Sentinel2,
+    Sentinel2Stacked,
+    Landsat7,
+)
+from ..datasets.cache import RasterCacheMixin
+from ..datasets.geo import PixelGrid, leaf_datasets
+from ..preprocessing import dequantize, one_hot, quantize
+from ..samplers import (
+    AdaptiveConstrainedRandomBatchGeoSampler,
+    BurnIndex,
+    BurnWeightedBatchGeoSampler,
+    CatalogueBatchGeoSampler,
+    ConstrainedRandomBatchGeoSampler,
+    FootprintIndex,
+    PatchCatalogue,
+    PrefetchBatchSampler,
+    SampleCatalogue,
+    SeededRandomBatchGeoSampler,
+    StagedRandomBatchGeoSampler,
+    VectorizedConstrainedRandomBatchGeoSampler,
+)
+from .collate import BatchCollator, copy_batch
 
 import torch
 import pytorch_lightning as pl
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
-from torchgeo.samplers.batch import RandomBatchGeoSampler
-from torchgeo.datasets import BoundingBox, stack_samples
+from torchgeo.datasets import BoundingBox, GeoDataset, stack_samples
 from torchgeo.samplers.constants import Units
 
 
@@ -32,12 +63,26 @@ class MODISJDLandcoverSimpleDataModule(pl.LightningDataModule):
         "urban": 9,
     }
 
+    # Samplers used when balance_samples is True, selected with 'sampler_mode'
+    constrained_samplers = {
+        "rejection": ConstrainedRandomBatchGeoSampler,
+        "importance": BurnWeightedBatchGeoSampler,
+        "vectorized": VectorizedConstrainedRandomBatchGeoSampler,
+        "adaptive": AdaptiveConstrainedRandomBatchGeoSampler,
+    }
+
+    # Burn proportion used to fill sample catalogues, so that any burn_prop can be
+    # resampled from them
+    catalogue_burn_prop = 0.5
+
     def __init__(
         self,
         modis_root_dir: str,
         landcover_root_dir: str,
         sentinel_root_dir: Optional[str] = None,
         landsat_root_dir: Optional[str] = None,
+        era5_root_dir: Optional[str] = None,
+        era5_variables: Optional[Sequence[str]] = None,
         batch_size: int = 64,
         length: int = 256,
         num_workers: int = 0,
@@ -47,6 +92,30 @@ class MODISJDLandcoverSimpleDataModule(pl.LightningDataModule):
         burn_prop: float = 1,
         units: Units = Units.PIXELS,
         test_roi: Optional[BoundingBox] = None,
+        use_burn_index: bool = True,
+        burn_index_path: Optional[str] = None,
+        sampler_mode: str = "rejection",
+        seed: Optional[int] = None,
+        catalogue_dir: Optional[str] = None,
+        catalogue_size: Optional[int] = None,
+        log_sampler_stats: bool = False,
+        patch_catalogue_path: Optional[str] = None,
+        patch_query: Optional[Dict[str, Sequence[Optional[float]]]] = None,
+        prefetch_batches: int = 0,
+        snap_to_grid: bool = False,
+        chip_store_dir: Optional[str] = None,
+        sentinel_stacked: bool = False,
+        share_landcover: bool = False,
+        block_cache_mb: int = 0,
+        landcover_on_device: bool = False,
+        compact_dtypes: bool = False,
+        collate_buffers: int = 0,
+        pin_memory: bool = False,
+        coalesce_reads: bool = False,
+        read_threads: int = 0,
+        patch_validity: Optional[Dict[str, float]] = None,
+        footprint_cell_size: int = 0,
+        footprint_path: Optional[str] = None,
         **kwargs: Any,
     ) -> None:
         """Initialize a LightningDataModule for MODIS and Landcover based DataLoaders.
@@ -55,6 +124,11 @@ class MODISJDLandcoverSimpleDataModule(pl.LightningDataModule):
             landcover_root_dir: directory containing (Polesia) landcover data
             sentinel_root_dir: directory of sentinel 2 band data
             landast_root_dir: directory of landsat 7 data
+            era5_root_dir: directory of ERA5 Land data, whose variables are added as
+                image bands (held in memory, see ERA5LandCube, and NaN where ERA5
+                Land has no data)
+            era5_variables: ERA5 Land variables to use, e.g. ["t2m", "swvl1"]
+                (defaults to all of them)
             batch_size: number of samples in batch
             num_workers:
             patch_size:
@@ -62,12 +136,74 @@ class MODISJDLandcoverSimpleDataModule(pl.LightningDataModule):
             balance_samples: set True to get more samples with fires in training
             burn_prop: the proportion of burned samples to take per batch
             units: whether to use pixels or CRS units for sizes
+            use_burn_index: set True to classify constrained samples with a
+                precomputed BurnIndex rather than reading the dataset
+            burn_index_path: .npz file used to save/load the BurnIndex between runs
+                (rebuilt if the roi or any MODIS file changed)
+            sampler_mode: how balanced batches are drawn, "rejection" (rejection
+                sampling), "vectorized" (rejection sampling of many candidates at
+                once), "adaptive" (vectorized, choosing tiles for burned samples by
+                their burn yield) or "importance" (direct draws from burned/unburned
+                strata)
+            seed: random seed of the samplers, set to make epochs reproducible
+            catalogue_dir: directory used to save/load catalogues of balanced
+                samples, which are resampled instead of searching every run
+            catalogue_size: number of samples stored in a new catalogue (defaults
+                to length)
+            log_sampler_stats: set True to log the work done by the training sampler
+                (candidates, acceptance rate, reads, time per batch, ...)
+            patch_catalogue_path: .npz file used to save/load a PatchCatalogue of
+                every patch, which balanced samples are then drawn from
+            patch_query: (min, max) range (inclusive, None for no limit) that
+                columns of the PatchCatalogue patches must lie within, e.g.
+                {"unobserved": (None, 0.2), "coverage_Sentinel2": (1, None)}
+            prefetch_batches: number of batches that the samplers draw ahead of time
+                in a background thread (0 to draw them when needed)
+            snap_to_grid: set True to align patches with the landcover pixel grid,
+                so that they are read without resampling
+            chip_store_dir: directory of chip stores, used to read the samples of
+                the sample (or patch) catalogue once and serve them from memory maps
+            sentinel_stacked: set True if sentinel_root_dir holds the stacked files of
+                stack_sentinel_bands, to read all bands of a sample in one read
+            share_landcover: set True to read the (static) landcover once into shared
+                memory, used by all DataLoader workers
+            block_cache_mb: size (in MB, per process) of the cache of blocks read from
+                the other datasets, or 0 to disable it
+            landcover_on_device: set True to load the landcover as uint8 class
+                indices, which are one-hot encoded (if one_hot_encode) and cast to
+                float on the device, a batch at a time
+            compact_dtypes: set True to load samples in compact dtypes (uint8 masks
+                and landcover, scaled uint16 bands, see quantize), which are only
+                converted to the training dtypes on the device, a batch at a time
+            collate_buffers: number of reusable batch buffers that samples are
+                collated into (see BatchCollator), or 0 to use stack_samples. Only
+                for training on a GPU, as on the CPU every batch is copied out of its
+                buffer (with a warning)
+            pin_memory: set True to put batches in pinned memory, for faster copies
+                to the GPU
+            coalesce_reads: set True to read the samples of a batch together, reading
+                the files shared by nearby patches once (see CoalescingReader)
+            read_threads: number of threads (per DataLoader worker) that the sources
+                and bands of samples are read in at the same time (see
+                ConcurrentReader), or 0 to read them one after another
+            patch_validity: largest fractions of invalid label pixels allowed in the
+                random (not balanced) samples, e.g. {"invalid": 0.5, "unobserved":
+                0.2}, checked on the labels before the images are read (see
+                StagedRandomBatchGeoSampler, which passes the labels on to the
+                DataLoader), or None to allow any samples
+            footprint_cell_size: size (in landcover pixels) of the cells of a
+                FootprintIndex of where every dataset has data, which all samples
+                are drawn within, or 0 to draw them anywhere in the roi
+            footprint_path: .npz file used to save/load the FootprintIndex between
+                runs
         """
         super().__init__()  # type: ignore[no-untyped-call]
         self.modis_root_dir = modis_root_dir
         self.landcover_root_dir = landcover_root_dir
         self.sentinel_root_dir = sentinel_root_dir
         self.landsat_root_dir = landsat_root_dir
+        self.era5_root_dir = era5_root_dir
+        self.era5_variables = era5_variables
         self.batch_size = batch_size
         self.length = length
         self.num_workers = num_workers
@@ -77,8 +213,39 @@ class MODISJDLandcoverSimpleDataModule(pl.LightningDataModule):
         self.burn_prop = burn_prop
         self.units = units
         self.test_roi = test_roi
+        self.use_burn_index = use_burn_index
+        self.burn_index_path = burn_index_path
+        self.sampler_mode = sampler_mode
+        self.seed = seed
+        self.catalogue_dir = catalogue_dir
+        self.catalogue_size = catalogue_size
+        self.log_sampler_stats = log_sampler_stats
+        self.patch_catalogue_path = patch_catalogue_path
+        self.patch_query = patch_query
+        self.prefetch_batches = prefetch_batches
+        self.snap_to_grid = snap_to_grid
+        self.chip_store_dir = chip_store_dir
+        self.sentinel_stacked = sentinel_stacked
+        self.share_landcover = share_landcover
+        self.block_cache_mb = block_cache_mb
+        self.landcover_on_device = landcover_on_device
+        self.compact_dtypes = compact_dtypes
+        self.collate_buffers = collate_buffers
+        self.pin_memory = pin_memory
+        self.coalesce_reads = coalesce_reads
+        self.read_threads = read_threads
+        self.patch_validity = patch_validity
+        self.footprint_cell_size = footprint_cell_size
+        self.footprint_path = footprint_path
+        self.footprint: Optional[FootprintIndex] = None
+        self.image_scales: List[float] = []
+        self.sampler_state = None
 
     def modis_transforms(self, sample: Dict[str, Any]) -> Dict[str, Any]:
+        # Burned (1) or not (0), as the binarized mask below
+        if self.compact_dtypes:
+            return {"mask": (sample["mask"] > 0).to(torch.uint8).squeeze()}
+
         # Binarize the samples
         sample["mask"] = torch.where(
             sample["mask"] > 0,
@@ -102,25 +269,12 @@ class MODISJDLandcoverSimpleDataModule(pl.LightningDataModule):
         sample: Dict[str, Any],
     ) -> Dict[str, Any]:
 
-        if self.one_hot_encode:
-
-            x_shape = sample["image"].shape
+        # Class indices are sent as they are, and encoded per batch on the device
+        if self.landcover_on_device or self.compact_dtypes:
+            return {"landcover": sample["image"].to(torch.uint8)}
 
-            input_mask = sample["image"]
-            # Get the one-hot encodings, which are a tensor of: (batch_idx, lat, lon, band_idx)
-            encodings = F.one_hot(
-                input_mask.to(torch.int64), num_classes=len(self.simple_classes)
-            )
-
-            # not sure this is the right shape we want for the mask – here the batch idx is missing
-            # but maybe that gets added in the dataloader
-            new_mask = torch.zeros([len(self.simple_classes), x_shape[1], x_shape[2]])
-            for band_idx in range(0, len(self.simple_classes)):
-                new_mask[band_idx, :, :] = encodings[0, :, :, band_idx]
-
-            # Write one-hot encodings to the output tensor
-            # outputs = sample
-            sample["image"] = new_mask.to(torch.int32)
+        if self.one_hot_encode:
+            sample["image"] = one_hot(sample["image"], len(self.simple_classes))
 
         sample_ = {"image": sample["image"].float()}
 
@@ -135,6 +289,214 @@ class MODISJDLandcoverSimpleDataModule(pl.LightningDataModule):
 
         return sample_
 
+    def compact_sample(
+        self, sample: Dict[str, Any], scale: Union[float, torch.Tensor]
+    ) -> Dict[str, Any]:
+
+        sample_ = {"image": quantize(sample["image"], scale)}
+
+        return sample_
+
+    def image_transforms(
+        self, dataset_cls: Any, scales: Optional[List[float]] = None
+    ) -> Callable[[Dict[str, Any]], Any]:
+        """Returns the transforms of an image dataset (e.g. Sentinel2 or Landsat7),
+        whose bands are stored compactly with the compact_scale of the dataset, or one
+        of 'scales' per band."""
+        if self.compact_dtypes:
+            if scales is not None:
+                scale: Union[float, torch.Tensor] = torch.tensor(scales).view(-1, 1, 1)
+            else:
+                scale = dataset_cls.compact_scale
+            return functools.partial(self.compact_sample, scale=scale)
+        return self.get_sample
+
+    def get_burn_index(self, roi: BoundingBox) -> BurnIndex:
+        """Loads the BurnIndex for the roi from disk, or builds (and saves) it.
+
+        Args:
+            roi: region of interest the sampler will draw from
+        Returns:
+            burn_index: summed-area tables of the burned MODIS pixels within the roi
+        """
+        if self.burn_index_path is not None and os.path.exists(self.burn_index_path):
+            burn_index = BurnIndex.load(self.burn_index_path)
+            fingerprint = BurnIndex.get_fingerprint(self.dataset)
+            if burn_index.roi == tuple(roi) and burn_index.fingerprint == fingerprint:
+                return burn_index
+
+        print("Building the burn index for the constrained sampler.")
+        burn_index = BurnIndex(self.dataset, roi)
+        if self.burn_index_path is not None:
+            burn_index.save(self.burn_index_path)
+
+        return burn_index
+
+    def get_footprint(self, roi: BoundingBox) -> FootprintIndex:
+        """Loads the FootprintIndex for the roi from disk, or builds (and saves) it.
+
+        Args:
+            roi: region of interest the samplers will draw from
+        Returns:
+            footprint: bitmaps of the cells where every dataset has data, per month
+        """
+        cell = self.footprint_cell_size * self.dataset.res
+        if self.footprint_path is not None and os.path.exists(self.footprint_path):
+            footprint = FootprintIndex.load(self.footprint_path)
+            if footprint.roi == tuple(roi) and math.isclose(footprint.origin[2], cell):
+                return footprint
+
+        print("Building the footprint index of the samplers.")
+        footprint = FootprintIndex(self.dataset, roi, self.footprint_cell_size)
+        if self.footprint_path is not None:
+            footprint.save(self.footprint_path)
+
+        return footprint
+
+    def get_random_sampler(
+        self, roi: BoundingBox, seed: Optional[int]
+    ) -> SeededRandomBatchGeoSampler:
+        """Returns a sampler of random batches, of valid patches if 'patch_validity'
+        is set.
+
+        Args:
+            roi: region of interest the sampler will draw from
+            seed: random seed of the sampler
+        """
+        if self.patch_validity is not None:
+            return StagedRandomBatchGeoSampler(
+                self.dataset,
+                self.patch_size,
+                self.batch_size,
+                self.length,
+                self.patch_validity,
+                roi,
+                self.units,
+                seed=seed,
+                snap=self.snap_to_grid,
+                footprint=self.footprint,
+                reuse_labels=True,
+            )
+
+        return SeededRandomBatchGeoSampler(
+            self.dataset,
+            self.patch_size,
+            self.batch_size,
+            self.length,
+            roi,
+            self.units,
+            seed=seed,
+            snap=self.snap_to_grid,
+            footprint=self.footprint,
+        )
+
+    def get_constrained_sampler(
+        self, roi: BoundingBox, burn_prop: float
+    ) -> ConstrainedRandomBatchGeoSampler:
+        """Returns the constrained sampler selected with 'sampler_mode'.
+
+        Args:
+            roi: region of interest the sampler will draw from
+            burn_prop: the proportion of burned samples to take per batch
+        Returns:
+            sampler: the constrained batch sampler
+        """
+        if self.use_burn_index or self.sampler_mode != "rejection":
+            burn_index = self.get_burn_index(roi)
+        else:
+            burn_index = None
+
+        return self.constrained_samplers[self.sampler_mode](
+            dataset=self.dataset,
+            size=self.patch_size,
+            batch_size=self.batch_size,
+            length=self.length,
+            burn_prop=burn_prop,
+            roi=roi,
+            units=self.units,
+            burn_index=burn_index,
+            seed=self.seed,
+            snap=self.snap_to_grid,
+            footprint=self.footprint,
+        )
+
+    def get_catalogue(self, roi: BoundingBox) -> SampleCatalogue:
+        """Loads the catalogue of balanced samples for the data and roi from disk, or
+        builds (and saves) it with the constrained sampler.
+
+        Args:
+            roi: region of interest the sampler will draw from
+        Returns:
+            catalogue: burned and unburned samples to resample from
+        """
+        fingerprint = SampleCatalogue.get_fingerprint(
+            self.dataset, roi, self.patch_size, self.units
+        )
+        path = SampleCatalogue.get_path(self.catalogue_dir, fingerprint)
+        catalogue = SampleCatalogue.load(path, fingerprint)
+        if catalogue is not None:
+            return catalogue
+
+        print("Building the sample catalogue for the constrained sampler.")
+        sampler = self.get_constrained_sampler(roi, self.catalogue_burn_prop)
+        catalogue = sampler.build_catalogue(self.catalogue_size or self.length)
+        catalogue.fingerprint = fingerprint
+        os.makedirs(self.catalogue_dir, exist_ok=True)
+        catalogue.save(path)
+
+        return catalogue
+
+    def get_patch_catalogue(self, roi: BoundingBox) -> PatchCatalogue:
+        """Loads the PatchCatalogue for the data and roi from disk, or builds (and
+        saves) it, and returns the patches that meet 'patch_query'.
+
+        Args:
+            roi: region of interest the sampler will draw from
+        Returns:
+            catalogue: the patches to draw from
+        """
+        fingerprint = PatchCatalogue.get_fingerprint(
+            self.dataset, roi, self.patch_size, self.units
+        )
+        catalogue = PatchCatalogue.load(self.patch_catalogue_path, fingerprint)
+        if catalogue is None:
+            print("Building the patch catalogue.")
+            catalogue = PatchCatalogue.build(
+                self.dataset, self.patch_size, roi=roi, units=self.units
+            )
+            catalogue.fingerprint = fingerprint
+            catalogue.save(self.patch_catalogue_path)
+
+        if self.patch_query is not None:
+            catalogue = catalogue.query(self.patch_query)
+
+        return catalogue
+
+    def get_chip_dataset(self, roi: BoundingBox, boxes: Any) -> ChipDataset:
+        """Loads the chip store of the given samples, or builds it.
+
+        Args:
+            roi: region of interest the sampler will draw from
+            boxes: (N, 6) array of the bounding boxes of the samples
+        Returns:
+            chips: dataset serving the samples from the chip store
+        """
+        digest = hashlib.sha1(
+            SampleCatalogue.get_fingerprint(
+                self.dataset, roi, self.patch_size, self.units
+            ).encode()
+        )
+        digest.update(boxes.tobytes())
+        fingerprint = digest.hexdigest()
+
+        print("Loading (or building) the chip store of the training samples.")
+        return ChipDataset.build(
+            self.dataset,
+            boxes,
+            os.path.join(self.chip_store_dir, f"chips_{fingerprint[:16]}"),
+            fingerprint,
+        )
+
     def setup(self, stage: Optional[str] = None) -> None:
         """Initialize the main ``Dataset`` objects.
         This method is called once per GPU per run.
@@ -156,15 +518,18 @@ class MODISJDLandcoverSimpleDataModule(pl.LightningDataModule):
         )
 
         self.dataset = landcover & modis
+        self.image_scales = []
 
         if self.sentinel_root_dir is not None:
-            sentinel = Sentinel2(
+            sentinel_cls = Sentinel2Stacked if self.sentinel_stacked else Sentinel2
+            sentinel = sentinel_cls(
                 self.sentinel_root_dir,
                 landcover.crs,
                 landcover.res,
                 bands=["B03", "B08", "B11"],
-                transforms=self.get_sample,
+                transforms=self.image_transforms(sentinel_cls),
             )
+            self.image_scales += [sentinel.compact_scale] * len(sentinel.bands)
             self.dataset = self.dataset & sentinel
 
         if self.landsat_root_dir is not None:
@@ -173,37 +538,211 @@ class MODISJDLandcoverSimpleDataModule(pl.LightningDataModule):
                 landcover.crs,
                 landcover.res,
                 bands=["B2", "B3", "B4", "B5"],
-                transforms=self.get_sample,
+                transforms=self.image_transforms(Landsat7),
             )
+            self.image_scales += [landsat.compact_scale] * len(landsat.bands)
             self.dataset = self.dataset & landsat
 
+        if self.era5_root_dir is not None:
+            era5 = ERA5LandCube(
+                self.era5_root_dir,
+                landcover.crs,
+                landcover.res,
+                variables=self.era5_variables,
+            )
+            scales = [era5.compact_scales[name] for name in era5.variable_names]
+            era5.transforms = self.image_transforms(ERA5LandCube, scales)
+            self.image_scales += scales
+            self.dataset = self.dataset & era5
+
+        # Landcover is static, so it is read once and shared by all the workers
+        if self.share_landcover:
+            landcover.share_memory()
+        if self.block_cache_mb > 0:
+            grid = PixelGrid.from_dataset(landcover)
+            for ds in leaf_datasets(self.dataset)[1:]:
+                if isinstance(ds, RasterCacheMixin):
+                    ds.enable_block_cache(self.block_cache_mb * 2**20, grid=grid)
+
         if self.test_roi is not None:
             roi = self.test_roi
         else:
             roi = self.dataset.bounds
 
+        # Samples are only drawn where every dataset has data
+        if self.footprint_cell_size > 0:
+            self.footprint = self.get_footprint(roi)
+
         if self.balance_samples:
+            if self.sampler_mode not in self.constrained_samplers:
+                raise ValueError(f"Sampler mode '{self.sampler_mode}' is not valid.")
+
             print("Using a constrained sampler to get more samples with fires.")
-            self.train_sampler = ConstrainedRandomBatchGeoSampler(
-                dataset=self.dataset,
-                size=self.patch_size,
-                batch_size=self.batch_size,
-                length=self.length,
-                burn_prop=self.burn_prop,
-                roi=roi,
-                units=self.units,
+            if self.patch_catalogue_path is not None:
+                self.train_sampler = CatalogueBatchGeoSampler(
+                    dataset=self.dataset,
+                    size=self.patch_size,
+                    batch_size=self.batch_size,
+                    length=self.length,
+                    burn_prop=self.burn_prop,
+                    catalogue=self.get_patch_catalogue(roi),
+                    roi=roi,
+                    units=self.units,
+                    seed=self.seed,
+                    snap=self.snap_to_grid,
+                    footprint=self.footprint,
+                )
+            elif self.catalogue_dir is not None:
+                self.train_sampler = CatalogueBatchGeoSampler(
+                    dataset=self.dataset,
+                    size=self.patch_size,
+                    batch_size=self.batch_size,
+                    length=self.length,
+                    burn_prop=self.burn_prop,
+                    catalogue=self.get_catalogue(roi),
+                    roi=roi,
+                    units=self.units,
+                    seed=self.seed,
+                    snap=self.snap_to_grid,
+                    footprint=self.footprint,
+                )
+            else:
+                self.train_sampler = self.get_constrained_sampler(roi, self.burn_prop)
+
+        else:
+            self.train_sampler = self.get_random_sampler(roi, self.seed)
+
+        # Validation and test samples use their own random streams
+        self.val_sampler = self.get_random_sampler(
+            roi, None if self.seed is None else self.seed + 1
+        )
+        self.test_sampler = self.get_random_sampler(
+            roi, None if self.seed is None else self.seed + 2
+        )
+
+        # Serve the (fixed set of) training samples from memory-mapped chips
+        self.train_dataset = self.dataset
+        if self.chip_store_dir is not None:
+            if not isinstance(self.train_sampler, CatalogueBatchGeoSampler):
+                raise ValueError(
+                    "A chip store requires balanced samples from a catalogue "
+                    "(catalogue_dir or patch_catalogue_path)."
+                )
+            self.train_dataset = self.get_chip_dataset(roi, self.train_sampler.boxes)
+
+        # Draw batches in the background, while the previous ones are being used
+        if self.prefetch_batches > 0:
+            self.train_sampler = PrefetchBatchSampler(
+                self.train_sampler, self.prefetch_batches
+            )
+            self.val_sampler = PrefetchBatchSampler(
+                self.val_sampler, self.prefetch_batches
             )
+            self.test_sampler = PrefetchBatchSampler(
+                self.test_sampler, self.prefetch_batches
+            )
+
+        # Resume the training sampler if a checkpoint was loaded before setup
+        if self.sampler_state is not None:
+            self.train_sampler.load_state_dict(self.sampler_state)
+
+    def on_save_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
+        """Saves the position of the training sampler, so that training can resume."""
+        if hasattr(self, "train_sampler"):
+            checkpoint["train_sampler"] = self.train_sampler.state_dict()
+
+    def on_load_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
+        """Restores the position of the training sampler from a checkpoint."""
+        self.sampler_state = checkpoint.get("train_sampler")
+        if self.sampler_state is not None and hasattr(self, "train_sampler"):
+            self.train_sampler.load_state_dict(self.sampler_state)
+
+    def transfer_batch_to_device(
+        self, batch: Any, device: torch.device, dataloader_idx: int
+    ) -> Any:
+        """Moves a batch to the device, or copies it out of its collate buffer if the
+        device is the CPU, where the buffer would otherwise reach the model."""
+        if self.collate_buffers > 0 and device.type == "cpu":
+            return copy_batch(batch)
+        return super().transfer_batch_to_device(batch, device, dataloader_idx)
+
+    def on_after_batch_transfer(self, batch: Any, dataloader_idx: int) -> Any:
+        """Converts the batch to the training dtypes (if loaded in compact ones) and
+        encodes its landcover (if loaded as class indices), and logs the training
+        sampler stats every 'log_every_n_steps' steps."""
+        if self.compact_dtypes:
+            batch = self.decode_compact(batch)
+        if "landcover" in batch:
+            batch = self.encode_landcover(batch)
+
+        trainer = self.trainer
+        if (
+            self.log_sampler_stats
+            and trainer is not None
+            and trainer.training
+            and trainer.logger is not None
+            and trainer.global_step % trainer.log_every_n_steps == 0
+        ):
+            stats = self.train_sampler.stats.as_dict()
+            if isinstance(self.train_sampler, PrefetchBatchSampler):
+                stats.update(self.train_sampler.prefetch_stats.as_dict())
+            trainer.logger.log_metrics(stats, step=trainer.global_step)
+        return batch
+
+    def decode_compact(self, batch: Dict[str, Any]) -> Dict[str, Any]:
+        """Converts the compact masks and image bands of a batch to the training
+        dtypes, i.e. long masks and float bands."""
+        batch["mask"] = batch["mask"].long()
+        if "image" in batch:
+            scales = torch.tensor(self.image_scales, device=batch["image"].device)
+            batch["image"] = dequantize(batch["image"], scales.view(1, -1, 1, 1))
+        return batch
+
+    def encode_landcover(self, batch: Dict[str, Any]) -> Dict[str, Any]:
+        """Turns the uint8 landcover class indices of a batch into float image bands,
+        placed before the bands of the other datasets."""
+        landcover = batch.pop("landcover")
+        if self.one_hot_encode:
+            landcover = one_hot(landcover, len(self.simple_classes))
+        landcover = landcover.float()
 
+        if "image" in batch:
+            batch["image"] = torch.cat([landcover, batch["image"]], dim=1)
         else:
-            self.train_sampler = RandomBatchGeoSampler(
-                self.dataset, self.patch_size, self.batch_size, self.length, roi
+            batch["image"] = landcover
+        return batch
+
+    def get_collate_fn(self) -> Callable[[Any], Dict[str, Any]]:
+        """Returns the collate function of a new DataLoader."""
+        if self.collate_buffers > 0:
+            return BatchCollator(self.collate_buffers, self.pin_memory)
+        return stack_samples
+
+    def get_dataloader(self, dataset: Any, batch_sampler: Any) -> DataLoader[Any]:
+        """Returns a DataLoader of the batches of a batch sampler."""
+        if self.coalesce_reads and isinstance(dataset, GeoDataset):
+            # The reader is given whole batches of bounding boxes
+            return DataLoader(
+                CoalescingReader(dataset, read_threads=self.read_threads),
+                sampler=batch_sampler,
+                batch_size=None,
+                num_workers=self.num_workers,
+                collate_fn=self.get_collate_fn(),
+                pin_memory=self.pin_memory,
             )
 
-        self.val_sampler = RandomBatchGeoSampler(
-            self.dataset, self.patch_size, self.batch_size, self.length, roi
-        )
-        self.test_sampler = RandomBatchGeoSampler(
-            self.dataset, self.patch_size, self.batch_size, self.length, roi
+        if self.read_threads > 0 and isinstance(dataset, GeoDataset):
+            dataset = ConcurrentReader(dataset, self.read_threads)
+        elif self.patch_validity is not None and isinstance(dataset, GeoDataset):
+            # The labels read by the sampler to check the patches are not read again
+            dataset = LabelledReader(dataset)
+
+        return DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            num_workers=self.num_workers,
+            collate_fn=self.get_collate_fn(),
+            pin_memory=self.pin_memory,
         )
 
     def train_dataloader(self) -> DataLoader[Any]:
@@ -211,33 +750,18 @@ class MODISJDLandcoverSimpleDataModule(pl.LightningDataModule):
         Returns:
             training data loader
         """
-        return DataLoader(
-            self.dataset,
-            batch_sampler=self.train_sampler,
-            num_workers=self.num_workers,
-            collate_fn=stack_samples,
-        )
+        return self.get_dataloader(self.train_dataset, self.train_sampler)
 
     def val_dataloader(self) -> DataLoader[Any]:
         """Return a DataLoader for validation.
         Returns:
             validation data loader
         """
-        return DataLoader(
-            self.dataset,
-            batch_sampler=self.val_sampler,
-            num_workers=self.num_workers,
-            collate_fn=stack_samples,
-        )
+        return self.get_dataloader(self.dataset, self.val_sampler)
 
     def test_dataloader(self) -> DataLoader[Any]:
         """Return a DataLoader for testing.
         Returns:
             testing data loader
         """
-        return DataLoader(
-            self.dataset,
-            batch_sampler=self.test_sampler,
-            num_workers=self.num_workers,
-            collate_fn=stack_samples,
-        )
+        return self.get_dataloader(self.dataset, self.test_sampler)
@@ -1,6 +1,14 @@
-from ..datasets import MODIS_JD, LandcoverSimple, Landsat7
-
-from typing import Any, Dict, Optional
+from ..datasets import MODIS_JD, GridSweepReader, LandcoverSimple, Landsat7
+from ..preprocessing import dequantize, one_hot, quantize
+from ..samplers import (
+    FootprintIndex,
+    SeededRandomBatchGeoSampler,
+    SnappedGridGeoSampler,
+)
+from .collate import BatchCollator, copy_batch
+
+import functools
+from typing import Any, Callable, Dict, Optional
 
 import torch
 import pytorch_lightning as pl
@@ -8,6 +16,7 @@ import torch.nn.functional as F
 from torch.utils.data import DataLoader
 from torchgeo.samplers.batch import RandomBatchGeoSampler
 from torchgeo.samplers.single import GridGeoSampler
+from torchgeo.samplers.constants import Units
 from torchgeo.datasets import stack_samples
 from torchgeo.datasets import BoundingBox
 
@@ -43,6 +52,14 @@ class MODISJDLandcoverSimpleLandsatDataModule(pl.LightningDataModule):
         batch_size: int = 64,
         num_workers: int = 8,
         patch_size: int = 0.04,
+        units: Units = Units.PIXELS,
+        snap_to_grid: bool = False,
+        landcover_on_device: bool = False,
+        compact_dtypes: bool = False,
+        collate_buffers: int = 0,
+        pin_memory: bool = False,
+        sweep_block_size: int = 0,
+        footprint_cell_size: int = 0,
         **kwargs: Any,
     ) -> None:
         """Initialize a LightningDataModule for MODIS, LANDSAT and Landcover based DataLoaders.
@@ -54,6 +71,28 @@ class MODISJDLandcoverSimpleLandsatDataModule(pl.LightningDataModule):
             batch_size: number of samples in batch
             num_workers:
             patch_size:
+            units: whether to use pixels or CRS units for sizes (and the stride),
+                e.g. Units.CRS for lat/lon sizes such as 0.04
+            snap_to_grid: set True to align patches with the landcover pixel grid,
+                so that they are read without resampling
+            landcover_on_device: set True to load the landcover as uint8 class
+                indices, which are one-hot encoded and cast to float on the device,
+                a batch at a time
+            compact_dtypes: set True to load samples in compact dtypes (uint8 masks
+                and landcover, scaled uint16 landsat bands), which are only converted
+                to the training dtypes on the device, a batch at a time
+            collate_buffers: number of reusable batch buffers that samples are
+                collated into (see BatchCollator), or 0 to use stack_samples. Only
+                for training on a GPU, as on the CPU every batch is copied out of its
+                buffer (with a warning)
+            pin_memory: set True to put batches in pinned memory, for faster copies
+                to the GPU
+            sweep_block_size: size (in pixels) of the blocks that the overlapping
+                validation and test patches are read in (see GridSweepReader), or 0
+                to read each patch on its own
+            footprint_cell_size: size (in landcover pixels) of the cells of a
+                FootprintIndex of where every dataset has data, which the (snapped)
+                samples are drawn within, or 0 to draw them anywhere in the roi
 
         """
         super().__init__()  # type: ignore[no-untyped-call]
@@ -64,8 +103,20 @@ class MODISJDLandcoverSimpleLandsatDataModule(pl.LightningDataModule):
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.patch_size = patch_size
+        self.units = units
+        self.snap_to_grid = snap_to_grid
+        self.landcover_on_device = landcover_on_device
+        self.compact_dtypes = compact_dtypes
+        self.collate_buffers = collate_buffers
+        self.pin_memory = pin_memory
+        self.sweep_block_size = sweep_block_size
+        self.footprint_cell_size = footprint_cell_size
 
     def modis_transforms(self, sample: Dict[str, Any]) -> Dict[str, Any]:
+        # Burned (1) or not (0), as the binarized mask below
+        if self.compact_dtypes:
+            return {"mask": (sample["mask"] > 0).to(torch.uint8).squeeze()}
+
         # Binarize the samples
         sample["mask"] = torch.where(
             sample["mask"] > 0,
@@ -87,25 +138,19 @@ class MODISJDLandcoverSimpleLandsatDataModule(pl.LightningDataModule):
         sample: Dict[str, Any],
     ) -> Dict[str, Any]:
 
-        x_shape = sample["image"].shape
+        # Class indices are sent as they are, and encoded per batch on the device
+        if self.landcover_on_device or self.compact_dtypes:
+            return {"landcover": sample["image"].to(torch.uint8)}
 
-        input_mask = sample["image"]
-        # Get the one-hot encodings, which are a tensor of: (batch_idx, lat, lon, band_idx)
-        encodings = F.one_hot(
-            input_mask.to(torch.int64), num_classes=len(self.simple_classes)
-        )
+        sample["image"] = one_hot(sample["image"], len(self.simple_classes))
+
+        sample_ = {"image": sample["image"].float()}
 
-        # not sure this is the right shape we want for the mask – here the batch idx is missing
-        # but maybe that gets added in the dataloader
-        new_mask = torch.zeros([len(self.simple_classes), x_shape[1], x_shape[2]])
-        for band_idx in range(0, len(self.simple_classes)):
-            new_mask[band_idx, :, :] = encodings[0, :, :, band_idx]
+        return sample_
 
-        # Write one-hot encodings to the output tensor
-        # outputs = sample
-        sample["image"] = new_mask.to(torch.int32)
+    def landsat_transforms(self, sample: Dict[str, Any]) -> Dict[str, Any]:
 
-        sample_ = {"image": sample["image"].float()}
+        sample_ = {"image": quantize(sample["image"], Landsat7.compact_scale)}
 
         return sample_
 
@@ -131,17 +176,77 @@ class MODISJDLandcoverSimpleLandsatDataModule(pl.LightningDataModule):
             transforms=self.modis_transforms,
         )
 
-        landsat = Landsat7(self.landsat_root_dir, landcover.crs, landcover.res)
+        landsat = Landsat7(
+            self.landsat_root_dir,
+            landcover.crs,
+            landcover.res,
+            transforms=self.landsat_transforms if self.compact_dtypes else None,
+        )
 
         self.dataset = landcover & modis & landsat
 
         roi = self.dataset.bounds
 
-        self.train_sampler = RandomBatchGeoSampler(
-            landcover, self.patch_size, self.batch_size, self.length, roi
+        if self.snap_to_grid:
+            # Samples are only drawn where landsat (and the labels) have data
+            footprint = None
+            if self.footprint_cell_size > 0:
+                footprint = FootprintIndex(self.dataset, roi, self.footprint_cell_size)
+
+            self.train_sampler = SeededRandomBatchGeoSampler(
+                landcover,
+                self.patch_size,
+                self.batch_size,
+                self.length,
+                roi,
+                self.units,
+                snap=True,
+                footprint=footprint,
+            )
+            grid_sampler = functools.partial(SnappedGridGeoSampler, footprint=footprint)
+        else:
+            self.train_sampler = RandomBatchGeoSampler(
+                landcover,
+                self.patch_size,
+                self.batch_size,
+                self.length,
+                roi,
+                self.units,
+            )
+            grid_sampler = GridGeoSampler
+
+        self.val_sampler = grid_sampler(
+            landcover, self.patch_size, self.stride, roi, self.units
         )
-        self.val_sampler = GridGeoSampler(landcover, self.patch_size, self.stride, roi)
-        self.test_sampler = GridGeoSampler(landcover, self.patch_size, self.stride, roi)
+        self.test_sampler = grid_sampler(
+            landcover, self.patch_size, self.stride, roi, self.units
+        )
+
+    def transfer_batch_to_device(
+        self, batch: Any, device: torch.device, dataloader_idx: int
+    ) -> Any:
+        """Moves a batch to the device, or copies it out of its collate buffer if the
+        device is the CPU, where the buffer would otherwise reach the model."""
+        if self.collate_buffers > 0 and device.type == "cpu":
+            return copy_batch(batch)
+        return super().transfer_batch_to_device(batch, device, dataloader_idx)
+
+    def on_after_batch_transfer(self, batch: Any, dataloader_idx: int) -> Any:
+        """Converts the batch to the training dtypes, if loaded in compact ones, and
+        one-hot encodes its landcover, if loaded as class indices."""
+        if self.compact_dtypes:
+            batch["mask"] = batch["mask"].long()
+            batch["image"] = dequantize(batch["image"], Landsat7.compact_scale)
+        if "landcover" in batch:
+            landcover = one_hot(batch.pop("landcover"), len(self.simple_classes))
+            batch["image"] = torch.cat([landcover.float(), batch["image"]], dim=1)
+        return batch
+
+    def get_collate_fn(self) -> Callable[[Any], Dict[str, Any]]:
+        """Returns the collate function of a new DataLoader."""
+        if self.collate_buffers > 0:
+            return BatchCollator(self.collate_buffers, self.pin_memory)
+        return stack_samples
 
     def train_dataloader(self) -> DataLoader[Any]:
         """Return a DataLoader for training.
@@ -153,33 +258,44 @@ class MODISJDLandcoverSimpleLandsatDataModule(pl.LightningDataModule):
             self.dataset,
             batch_sampler=self.train_sampler,
             num_workers=self.num_workers,
-            collate_fn=stack_samples,
+            collate_fn=self.get_collate_fn(),
+            pin_memory=self.pin_memory,
         )
 
-    def val_dataloader(self) -> DataLoader[Any]:
-        """Return a DataLoader for validation.
+    def get_grid_dataloader(self, sampler: Any) -> DataLoader[Any]:
+        """Returns a DataLoader of the patches of a grid sampler."""
+        if self.sweep_block_size > 0:
+            return DataLoader(
+                GridSweepReader(
+                    self.dataset, sampler, self.sweep_block_size, self.batch_size
+                ),
+                batch_size=self.batch_size,
+                num_workers=self.num_workers,
+                collate_fn=self.get_collate_fn(),
+                pin_memory=self.pin_memory,
+            )
 
-        Returns:
-            validation data loader
-        """
         return DataLoader(
             self.dataset,
             batch_size=self.batch_size,
-            sampler=self.val_sampler,
+            sampler=sampler,
             num_workers=self.num_workers,
-            collate_fn=stack_samples,
+            collate_fn=self.get_collate_fn(),
+            pin_memory=self.pin_memory,
         )
 
+    def val_dataloader(self) -> DataLoader[Any]:
+        """Return a DataLoader for validation.
+
+        Returns:
+            validation data loader
+        """
+        return self.get_grid_dataloader(self.val_sampler)
+
     def test_dataloader(self) -> DataLoader[Any]:
         """Return a DataLoader for testing.
 
         Returns:
             testing data loader
         """
-        return DataLoader(
-            self.dataset,
-            batch_size=self.batch_size,
-            sampler=self.test_sampler,
-            num_workers=self.num_workers,
-            collate_fn=stack_samples,
-        )
+        return self.get_grid_dataloader(self.test_sampler)
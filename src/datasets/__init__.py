@@ -1,23 +1,54 @@
-from .era5land import ERA5SnowC, ERA5SnowDepth, ERA5T2M, ERA5SWVL1
+from .era5land import (
+    ERA5Land,
+    ERA5LandCube,
+    ERA5SnowC,
+    ERA5SnowDepth,
+    ERA5T2M,
+    ERA5SWVL1,
+)
 from .modis_cci import MODIS_CCI, MODIS_JD
-from .sentinel import Sentinel2
+from .sentinel import Sentinel2, Sentinel2Stacked
 from .landsat import Landsat7
 
 # this is a bit of a clunky solution for now (for modis unzip)
-from .utils import unzip_all_modis_fire_files, pull_monthly_cloudless_sentinel, download_landsat
+from .utils import (
+    unzip_all_modis_fire_files,
+    pull_monthly_cloudless_sentinel,
+    download_landsat,
+    stack_sentinel_bands,
+)
 from .landcover import LandcoverSimple, LandcoverComplex
+from .chips import ChipDataset
+from .readers import (
+    CoalescingReader,
+    ConcurrentReader,
+    GridSweepReader,
+    LabelledReader,
+    ReadPool,
+)
 
 __all__ = (
+    "ChipDataset",
+    "CoalescingReader",
+    "ConcurrentReader",
+    "GridSweepReader",
+    "LabelledReader",
+    "ERA5Land",
+    "ERA5LandCube",
     "ERA5SnowC",
     "ERA5SnowDepth",
-    "ERA5SWVL1" "ERA5T2M",
+    "ERA5SWVL1",
+    "ERA5T2M",
     "LandcoverComplex",
     "LandcoverSimple",
     "MODIS_CCI",
     "MODIS_JD",
     "unzip_all_modis_fire_files",
     "Sentinel2",
+    "Sentinel2Stacked",
     "pull_monthly_cloudless_sentinel",
     "download_landsat",
+    "stack_sentinel_bands",
     "Landsat7",
+    "ReadPool",
 )
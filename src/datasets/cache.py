@@ -0,0 +1,194 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import torch
+from torch import Tensor
+from torchgeo.datasets import BoundingBox
+
+from .geo import PixelGrid, files_extent
+
+
+class RasterCacheMixin:
+    """Caches the data read by a RasterDataset, in one of two ways.
+
+    - share_memory: for static rasters (landcover), reads the whole dataset once
+      into a shared memory tensor. DataLoader workers map the same memory (whether
+      forked or spawned), and samples are slices of it.
+    - enable_block_cache: for rasters that change over time (MODIS, Sentinel), keeps
+      a size-bounded LRU cache of the blocks of the dataset grid read so far, so that
+      patches overlapping the same blocks (in the same month) reuse them. Each worker
+      has its own cache, which is not copied into new workers, and which can be used
+      by several threads (see ConcurrentReader).
+    Only samples on the pixel grid of the dataset (e.g. those of snapping samplers)
+    are cached, others are read as usual. Subclasses that change how files are read
+    override _read_files rather than _merge_files.
+    """
+
+    shared_data: Optional[Tensor] = None
+    block_cache: Optional["OrderedDict[Any, Tuple[Any, Tensor]]"] = None
+
+    def share_memory(self) -> "RasterCacheMixin":
+        """Reads the whole dataset into shared memory, returning the dataset."""
+
+        bounds = self.bounds  # type: ignore[attr-defined]
+        self.shared_grid = PixelGrid(bounds.minx, bounds.maxy, self.res)  # type: ignore
+        extent = self.shared_grid.inner_bounds(bounds)
+
+        hits = self.index.intersection(tuple(extent), objects=True)  # type: ignore
+        filepaths = [hit.object for hit in hits]
+        self.shared_data = self._read_files(filepaths, extent).share_memory_()
+        return self
+
+    def enable_block_cache(
+        self, max_bytes: int, blocksize: int = 256, grid: Optional[PixelGrid] = None
+    ) -> "RasterCacheMixin":
+        """Starts caching blocks of blocksize x blocksize pixels, up to max_bytes of
+        them (per process), returning the dataset.
+
+        Args:
+            max_bytes: maximum size of the cached blocks, per process.
+            blocksize: size of the blocks, in pixels.
+            grid: pixel grid of the blocks, which should be that of the samples (e.g.
+                of the landcover), defaulting to the grid of the dataset itself.
+        """
+
+        if grid is None:
+            bounds = self.bounds  # type: ignore[attr-defined]
+            grid = PixelGrid(bounds.minx, bounds.maxy, self.res)  # type: ignore
+        self.block_grid = grid
+        self.blocksize = blocksize
+        self.block_cache_max_bytes = max_bytes
+        self.block_cache = OrderedDict()
+        self.block_cache_bytes = 0
+        self.block_lock = threading.Lock()
+        return self
+
+    def __getstate__(self) -> Tuple[Dict[str, Any], List[Any]]:
+        # Workers start with an empty block cache, rather than a copy of this one
+        attrs, items = super().__getstate__()  # type: ignore[misc]
+        if self.block_cache is not None:
+            attrs = {
+                **attrs,
+                "block_cache": OrderedDict(),
+                "block_cache_bytes": 0,
+                "block_lock": None,
+            }
+        return attrs, items
+
+    def __setstate__(self, state: Tuple[Dict[str, Any], List[Any]]) -> None:
+        super().__setstate__(state)  # type: ignore[misc]
+        if self.block_cache is not None:
+            self.block_lock = threading.Lock()
+
+    def _merge_files(self, filepaths: Sequence[str], query: BoundingBox) -> Tensor:
+        """Returns the data within query, from the caches if it is on their grid."""
+
+        if self.shared_data is not None:
+            window = self.shared_grid.window(query)
+            _, height, width = self.shared_data.shape
+            if window is not None:
+                row, col, h, w = window
+                if row >= 0 and col >= 0 and row + h <= height and col + w <= width:
+                    # Copied, so that transforms cannot modify the shared data
+                    return self.shared_data[:, row : row + h, col : col + w].clone()
+
+        if self.block_cache is not None:
+            window = self.block_grid.window(query)
+            if window is not None:
+                data = self.read_blocks(filepaths, window)
+                if data is not None:
+                    return data
+
+        return self._read_files(filepaths, query)
+
+    def _read_files(self, filepaths: Sequence[str], query: BoundingBox) -> Tensor:
+        """Reads (and merges) the files within query, bypassing the caches."""
+
+        return super()._merge_files(filepaths, query)  # type: ignore[misc]
+
+    def read_blocks(
+        self,
+        filepaths: Sequence[str],
+        window: Tuple[int, int, int, int],
+    ) -> Optional[Tensor]:
+        """Assembles a window from the blocks of some files, reading missing blocks.
+
+        Returns None if the blocks do not cover the window, i.e. if it goes past the
+        edge of the files.
+        """
+
+        row, col, height, width = window
+        size = self.blocksize
+
+        data: Optional[Tensor] = None
+        covered = 0
+        for block_row in range(row // size, (row + height - 1) // size + 1):
+            for block_col in range(col // size, (col + width - 1) // size + 1):
+                (top, left, bottom, right), block = self.get_block(
+                    filepaths, block_row, block_col
+                )
+
+                # Overlap of the block and the window, in pixels of the grid
+                r0, r1 = max(row, top), min(row + height, bottom)
+                c0, c1 = max(col, left), min(col + width, right)
+                if r0 < r1 and c0 < c1:
+                    if data is None:
+                        data = block.new_zeros((block.shape[0], height, width))
+                    data[:, r0 - row : r1 - row, c0 - col : c1 - col] = block[
+                        :, r0 - top : r1 - top, c0 - left : c1 - left
+                    ]
+                    covered += (r1 - r0) * (c1 - c0)
+
+        return data if covered == height * width else None
+
+    def get_block(
+        self, filepaths: Sequence[str], block_row: int, block_col: int
+    ) -> Tuple[Tuple[int, int, int, int], Tensor]:
+        """Returns a block of the grid, read from some files.
+
+        Blocks are clipped to the extent of the files, so that no pixel of a block is
+        resampled from a partial window of a file.
+        Returns:
+            pixels: (top, left, bottom, right) rows and cols of the block in the grid
+            block: data of the block
+        """
+
+        # The files (e.g. of a band and month) decide the data of a block
+        key = (tuple(filepaths), block_row, block_col)
+        with self.block_lock:
+            cached = self.block_cache.get(key)
+            if cached is not None:
+                self.block_cache.move_to_end(key)
+                return cached
+
+        size = self.blocksize
+        top, left = block_row * size, block_col * size
+        bottom, right = top + size, left + size
+
+        extent = files_extent(self, filepaths)  # type: ignore[arg-type]
+        row, col, rows, cols = self.block_grid.window(
+            self.block_grid.inner_bounds(extent)
+        )
+        top, left = max(top, row), max(left, col)
+        bottom, right = max(min(bottom, row + rows), top), max(
+            min(right, col + cols), left
+        )
+
+        if bottom > top and right > left:
+            bounds = self.block_grid.bounds(top, left, bottom - top, right - left, 0, 0)
+            block = self._read_files(filepaths, bounds)
+        else:
+            block = torch.zeros(0, 0, 0)
+
+        cached = ((top, left, bottom, right), block)
+        with self.block_lock:
+            if key not in self.block_cache:
+                self.block_cache[key] = cached
+                self.block_cache_bytes += block.numel() * block.element_size()
+            while (
+                self.block_cache_bytes > self.block_cache_max_bytes and self.block_cache
+            ):
+                _, (_, evicted) = self.block_cache.popitem(last=False)
+                self.block_cache_bytes -= evicted.numel() * evicted.element_size()
+
+        return cached
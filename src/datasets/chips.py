@@ -0,0 +1,180 @@
+import json
+import os
+import numpy as np
+import torch
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+from rasterio.crs import CRS
+from torch.utils.data import Dataset
+from torchgeo.datasets import BoundingBox, GeoDataset
+from torchgeo.datasets.utils import concat_samples
+
+from .geo import leaf_datasets, read_raw, without_transforms
+
+
+class ChipDataset(Dataset):
+    """Dataset of patches (chips) materialized from a GeoDataset by build.
+
+    Each source of the GeoDataset (e.g. landcover, modis and sentinel) is stored in its
+    own memory-mapped .npy array of shape (N, bands, height, width), in the dtype it is
+    read with, so that every chip is a contiguous block of the file. Samples are served
+    as zero-copy views of these arrays, passed through the transforms of each source
+    and concatenated, as an IntersectionDataset would do.
+    Chips are indexed by number or by the bounding box they were read from, so the
+    samplers that produced the boxes can be used as they are.
+    Args:
+        root: directory of the chip store.
+        transforms: transform of each source (e.g. the transforms of the datasets the
+            chips were read from), or None to return the raw values.
+    Raises:
+        FileNotFoundError: if no complete chip store is found in ``root``.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        transforms: Optional[
+            Sequence[Optional[Callable[[Dict[str, Any]], Dict[str, Any]]]]
+        ] = None,
+    ) -> None:
+
+        metadata_path = os.path.join(root, "metadata.json")
+        if not os.path.exists(metadata_path):
+            raise FileNotFoundError(f"No chip store found in {root}.")
+
+        with open(metadata_path) as f:
+            self.metadata = json.load(f)
+
+        self.root = root
+        self.crs = CRS.from_wkt(self.metadata["crs"])
+        self.boxes = np.load(os.path.join(root, "boxes.npy"))
+        self.keys = [source["key"] for source in self.metadata["sources"]]
+        self.transforms = transforms or [None] * len(self.keys)
+
+        self._arrays: Optional[List[np.ndarray]] = None
+        self.box_index = {tuple(box): i for i, box in enumerate(self.boxes.tolist())}
+
+    @property
+    def arrays(self) -> List[np.ndarray]:
+        """Returns the memory-mapped array of each source, opening them if needed."""
+
+        # Copy-on-write maps give writable (zero-copy) views that torch can use
+        if self._arrays is None:
+            self._arrays = [
+                np.load(os.path.join(self.root, source["filename"]), mmap_mode="c")
+                for source in self.metadata["sources"]
+            ]
+        return self._arrays
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Reopen the maps in DataLoader workers, rather than copying their contents
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def __len__(self) -> int:
+        return len(self.boxes)
+
+    def __getitem__(self, index: Union[int, BoundingBox]) -> Dict[str, Any]:
+        """Returns the chip with a given number or bounding box.
+
+        Raises:
+            IndexError: if no chip was read from the bounding box.
+        """
+
+        if isinstance(index, BoundingBox):
+            if tuple(index) not in self.box_index:
+                raise IndexError(f"query: {index} not found in the chip store")
+            index = self.box_index[tuple(index)]
+
+        bbox = BoundingBox(*self.boxes[index].tolist())
+        samples = []
+        for key, array, transform in zip(self.keys, self.arrays, self.transforms):
+            sample = {
+                key: torch.from_numpy(array[index]),
+                "crs": self.crs,
+                "bbox": bbox,
+            }
+            if transform is not None:
+                sample = transform(sample)
+            samples.append(sample)
+
+        return concat_samples(samples)
+
+    @classmethod
+    def build(
+        cls,
+        dataset: GeoDataset,
+        boxes: np.ndarray,
+        root: str,
+        fingerprint: str = "",
+    ) -> "ChipDataset":
+        """Reads the chips of a dataset within each bounding box into a chip store.
+
+        Nothing is read if a complete store with the same fingerprint exists already.
+        Args:
+            dataset: the dataset to read, e.g. landcover & modis & sentinel.
+            boxes: (N, 6) array of the minx, maxx, miny, maxy, mint, maxt coordinates
+                of the chips (which must all have the same size in pixels).
+            root: directory of the chip store.
+            fingerprint: identifies the data and boxes that the store was made from.
+        Returns:
+            chips: the chip store, applying the transforms of the dataset sources.
+        """
+
+        leaves = leaf_datasets(dataset)
+        transforms = [ds.transforms for ds in leaves]
+        try:
+            chips = cls(root, transforms)
+            if chips.metadata["fingerprint"] == fingerprint:
+                return chips
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(root, exist_ok=True)
+        metadata_path = os.path.join(root, "metadata.json")
+        if os.path.exists(metadata_path):
+            os.remove(metadata_path)
+
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 6)
+        if len(boxes) == 0:
+            raise ValueError("No bounding boxes to build the chip store from.")
+        np.save(os.path.join(root, "boxes.npy"), boxes)
+
+        sources: List[Dict[str, Any]] = []
+        for i, ds in enumerate(without_transforms(ds) for ds in leaves):
+            filename = f"source_{i}.npy"
+            array = None
+            for n, box in enumerate(boxes.tolist()):
+                chip = read_raw(ds, BoundingBox(*box))
+                if array is None:
+                    array = np.lib.format.open_memmap(
+                        os.path.join(root, filename),
+                        mode="w+",
+                        dtype=chip.dtype,
+                        shape=(len(boxes),) + chip.shape,
+                    )
+                array[n] = chip
+            array.flush()
+
+            sources.append(
+                {
+                    "name": type(ds).__name__,
+                    "key": "image" if ds.is_image else "mask",
+                    "filename": filename,
+                    "dtype": str(array.dtype),
+                    "shape": list(array.shape),
+                }
+            )
+            del array
+
+        # The metadata is written last, marking the store as complete
+        metadata = {
+            "fingerprint": fingerprint,
+            "crs": dataset.crs.to_wkt(),
+            "res": dataset.res,
+            "sources": sources,
+        }
+        with open(metadata_path, "w") as f:
+            json.dump(metadata, f, indent=2)
+
+        return cls(root, transforms)
@@ -1,8 +1,16 @@
+import numpy as np
+import rasterio
 import torch
-from torchgeo.datasets.geo import RasterDataset
-from typing import Any, Callable, Dict, Optional
+import torch.nn.functional as F
+from typing import Any, Callable, Dict, List, Optional, Sequence
 
 from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.warp import calculate_default_transform, reproject
+from torchgeo.datasets import BoundingBox, GeoDataset
+
+from .geo import CachedIndexRasterDataset
 
 # info on ERA5 projection here:
 #
@@ -14,7 +22,7 @@ from rasterio.crs import CRS
 # -180 to 180 if that's the case
 
 
-class ERA5Land(RasterDataset):
+class ERA5Land(CachedIndexRasterDataset):
     """Abstract class for all ERA5 Land datasets."""
 
 
@@ -144,3 +152,183 @@ class ERA5SWVL1(ERA5Land):
         """
 
         super().__init__(root, crs, res, transforms, cache)
+
+
+class ERA5LandCube(GeoDataset):
+    """All ERA5 Land variables, held in memory on their native grid.
+
+    ERA5 Land is a coarse (~0.1 degree) grid, so every requested variable of every
+    month is read once, at construction, into a (months, variables, height, width)
+    array. Samples are sliced from this array and upsampled to the resolution of the
+    dataset, with no file reads (or warps) per sample.
+    Only months with a file for every variable are indexed. Pixels without data (e.g.
+    over water, or outside the files) are NaN, rather than a value such as 0 that the
+    variables can hold. Pixels next to them are interpolated from the valid cells only.
+    """
+
+    # Dataset class of each variable, and so the files of each variable
+    variables = {
+        "snowc": ERA5SnowC,
+        "sd": ERA5SnowDepth,
+        "t2m": ERA5T2M,
+        "swvl1": ERA5SWVL1,
+    }
+    is_image = True
+
+    # Scale of each variable when stored compactly (see quantize): snow cover (%),
+    # snow depth (m of water), 2m temperature (K) and soil water (m3/m3)
+    compact_scales = {"snowc": 100, "sd": 10000, "t2m": 100, "swvl1": 10000}
+
+    def __init__(
+        self,
+        root: str = None,
+        crs: CRS = CRS.from_epsg(4326),
+        res: Optional[float] = None,
+        variables: Optional[Sequence[str]] = None,
+        transforms: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+        mode: str = "bilinear",
+    ) -> None:
+        """Initialize a new Dataset instance.
+
+        Args:
+            root: root directory where dataset can be found
+            crs: :term:`coordinate reference system (CRS)` to warp to
+            res: resolution of the samples in units of CRS
+                (defaults to the resolution of the ERA5 grid)
+            variables: variables to load, in order (defaults to all variables)
+            transforms: a function/transform that takes an input sample
+                and returns a transformed version
+            mode: interpolation used to upsample the grid, "bilinear" or "nearest"
+        Raises:
+            FileNotFoundError: if no month has files for all the variables
+            ValueError: if a variable is not valid
+        """
+
+        super().__init__(transforms)
+
+        self.variable_names = list(variables or self.variables)
+        for name in self.variable_names:
+            if name not in self.variables:
+                raise ValueError(f"Variable '{name}' is not valid.")
+        self.mode = mode
+        self._crs = crs
+
+        # Files of each variable by month (start time)
+        months: Dict[float, List[Any]] = {}
+        datasets = [self.variables[name](root, crs) for name in self.variable_names]
+        for v, ds in enumerate(datasets):
+            for hit in ds.index.intersection(ds.index.bounds, objects=True):
+                months.setdefault(hit.bounds[4], [None] * len(datasets))[v] = hit
+        months = {t: hits for t, hits in months.items() if None not in hits}
+        if not months:
+            raise FileNotFoundError(
+                f"No month with all ERA5 Land variables was found in '{root}'"
+            )
+
+        self.grid_transform, height, width = self.get_grid(datasets)
+        self.res = res if res is not None else self.grid_transform.a
+
+        self.data = np.full(
+            (len(months), len(datasets), height, width), np.nan, dtype=np.float32
+        )
+        for i, mint in enumerate(sorted(months)):
+            hits = months[mint]
+            for v, hit in enumerate(hits):
+                with rasterio.open(hit.object) as src:
+                    reproject(
+                        rasterio.band(src, 1),
+                        self.data[i, v],
+                        src_nodata=src.nodata,
+                        dst_transform=self.grid_transform,
+                        dst_crs=crs,
+                        dst_nodata=np.nan,
+                        resampling=Resampling.nearest,
+                    )
+
+            minx, maxx, miny, maxy, mint, maxt = hits[0].bounds
+            self.index.insert(i, (minx, maxx, miny, maxy, mint, maxt), i)
+
+    def get_grid(self, datasets: List[GeoDataset]) -> Any:
+        """Returns the transform, height and width of a grid at the native resolution
+        of the files, covering the files of all variables."""
+
+        bounds = [ds.bounds for ds in datasets]
+        minx, maxy = min(b.minx for b in bounds), max(b.maxy for b in bounds)
+        maxx, miny = max(b.maxx for b in bounds), min(b.miny for b in bounds)
+
+        hit = next(datasets[0].index.intersection(datasets[0].bounds, objects=True))
+        with rasterio.open(hit.object) as src:
+            transform, _, _ = calculate_default_transform(
+                src.crs, self.crs, src.width, src.height, *src.bounds
+            )
+        res = transform.a
+
+        width = int(np.ceil((maxx - minx) / res - 1e-6))
+        height = int(np.ceil((maxy - miny) / res - 1e-6))
+        return from_origin(minx, maxy, res, res), height, width
+
+    def __getitem__(self, query: BoundingBox) -> Dict[str, Any]:
+        """Retrieve the variables indexed by query, upsampled to the dataset res.
+
+        Args:
+            query: (minx, maxx, miny, maxy, mint, maxt) coordinates to index
+
+        Returns:
+            sample of the variables (as image) and metadata at that index
+
+        Raises:
+            IndexError: if query is not found in the index
+        """
+
+        hits = list(self.index.intersection(tuple(query), objects=True))
+        if not hits:
+            raise IndexError(
+                f"query: {query} not found in index with bounds: {self.bounds}"
+            )
+        grid = torch.from_numpy(self.data[hits[0].object])
+
+        # Centres of the sample pixels, in (fractional) pixels of the grid
+        width = int(round((query.maxx - query.minx) / self.res))
+        height = int(round((query.maxy - query.miny) / self.res))
+        x0, y0, grid_res = (
+            self.grid_transform.c,
+            self.grid_transform.f,
+            self.grid_transform.a,
+        )
+        cols = (query.minx + (np.arange(width) + 0.5) * self.res - x0) / grid_res - 0.5
+        rows = (y0 - query.maxy + (np.arange(height) + 0.5) * self.res) / grid_res - 0.5
+
+        # Normalised to [-1, 1] across the grid, as grid_sample expects
+        variables, grid_height, grid_width = grid.shape
+        x = torch.tensor(2 * cols / max(grid_width - 1, 1) - 1, dtype=torch.float32)
+        y = torch.tensor(2 * rows / max(grid_height - 1, 1) - 1, dtype=torch.float32)
+        ys, xs = torch.meshgrid(y, x, indexing="ij")
+        points = torch.stack([xs, ys], dim=-1)
+
+        # Interpolated from the valid cells only (weighted by their share of the
+        # interpolation), so that NaN cells do not spread into their neighbours
+        valid = ~torch.isnan(grid)
+        stacked = torch.cat([torch.where(valid, grid, 0.0), valid.float()])
+        sampled = F.grid_sample(
+            stacked[None],
+            points[None],
+            mode=self.mode,
+            padding_mode="border",
+            align_corners=True,
+        )[0]
+        image = sampled[:variables] / sampled[variables:]
+
+        # Pixels outside the grid, or within a NaN cell, have no data
+        inside = ((rows > -0.5) & (rows < grid_height - 0.5))[:, None] & (
+            (cols > -0.5) & (cols < grid_width - 0.5)
+        )[None, :]
+        row_cells = np.clip(np.floor(rows + 0.5), 0, grid_height - 1).astype(int)
+        col_cells = np.clip(np.floor(cols + 0.5), 0, grid_width - 1).astype(int)
+        missing = ~valid[:, row_cells][:, :, col_cells] | ~torch.from_numpy(inside)
+        image[missing] = np.nan
+
+        sample = {"image": image, "crs": self.crs, "bbox": query}
+        if self.transforms is not None:
+            sample = self.transforms(sample)
+
+        return sample
@@ -0,0 +1,519 @@
+import glob
+import hashlib
+import json
+import math
+import os
+import re
+import warnings
+import numpy as np
+import torch
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+)
+from rasterio.crs import CRS
+
+from torchgeo.datasets import (
+    BoundingBox,
+    GeoDataset,
+    IntersectionDataset,
+    RasterDataset,
+    UnionDataset,
+)
+
+
+def leaf_datasets(dataset: GeoDataset) -> List[GeoDataset]:
+    """Returns the datasets that make up a (possibly nested) Intersection/UnionDataset.
+
+    Args:
+        dataset: the dataset to unpack, e.g. ``landcover & modis & sentinel``
+
+    Returns:
+        leaves: the underlying datasets, in the order their samples are concatenated
+    """
+
+    if isinstance(dataset, (IntersectionDataset, UnionDataset)):
+        leaves = []
+        for ds in dataset.datasets:
+            leaves.extend(leaf_datasets(ds))
+        return leaves
+
+    return [dataset]
+
+
+def dataset_files(dataset: GeoDataset) -> List[str]:
+    """Returns the (sorted) paths of all files indexed by a dataset and its leaves.
+
+    Args:
+        dataset: the dataset to list the files of
+
+    Returns:
+        filepaths: the files of every leaf dataset that are held in its index
+    """
+
+    filepaths = set()
+    for ds in leaf_datasets(dataset):
+        for hit in ds.index.intersection(ds.index.bounds, objects=True):
+            if isinstance(hit.object, str):
+                filepaths.add(hit.object)
+
+    return sorted(filepaths)
+
+
+def without_transforms(dataset: RasterDataset) -> RasterDataset:
+    """Returns a (shallow) copy of a dataset that does not apply its transforms.
+
+    The copy shares the index and files of the original dataset, so it is cheap to make.
+    """
+
+    # Not copy.copy, whose GeoDataset.__setstate__ would insert the index entries
+    # again into the (shared) index
+    raw = object.__new__(type(dataset))
+    raw.__dict__.update(dataset.__dict__)
+    raw.transforms = None
+    return raw
+
+
+def close_warp_file(handle: Any) -> None:
+    """Closes a file handle returned by RasterDataset._load_warp_file, along with the
+    file it warps if it is a WarpedVRT."""
+
+    handle.close()
+    src = getattr(handle, "src_dataset", None)
+    if src is not None:
+        src.close()
+
+
+@contextmanager
+def open_warp_file(dataset: RasterDataset, filepath: str) -> Iterator[Any]:
+    """Opens a file of a dataset as it is read (warped to the CRS of the dataset), and
+    closes it (see close_warp_file) on exit."""
+
+    handle = dataset._load_warp_file(filepath)
+    try:
+        yield handle
+    finally:
+        close_warp_file(handle)
+
+
+def read_raw(dataset: RasterDataset, query: BoundingBox) -> np.ndarray:
+    """Reads the raw values of a dataset within a bounding box, without transforms.
+
+    Args:
+        dataset: the dataset to read (usually made with without_transforms)
+        query: (minx, maxx, miny, maxy, mint, maxt) coordinates to read
+
+    Returns:
+        data: (bands, height, width) array at the resolution of the dataset
+    """
+
+    if dataset.transforms is not None:
+        dataset = without_transforms(dataset)
+
+    sample = dataset[query]
+    return sample["image" if dataset.is_image else "mask"].numpy()
+
+
+@dataclass(frozen=True)
+class LabelledBoundingBox(BoundingBox):
+    """A bounding box carrying the raw data of some sources within it, read by a
+    sampler to check the box (see StagedRandomBatchGeoSampler).
+
+    Readers (see LabelledReader) use the data instead of reading those sources again,
+    and any other reader treats it as a plain BoundingBox.
+    Attributes:
+        labels: raw data of sources (as read_raw returns), keyed by the position of
+            the source in the leaf_datasets of the dataset.
+    """
+
+    labels: Dict[int, np.ndarray] = field(
+        default_factory=dict, compare=False, repr=False
+    )
+
+
+def labelled_sample(
+    dataset: GeoDataset, query: BoundingBox, data: np.ndarray
+) -> Dict[str, Any]:
+    """Returns the sample of a dataset within query from its raw data (as read_raw
+    returns), passed through the transforms of the dataset.
+
+    The sample is the same as dataset[query], without reading the dataset again.
+    """
+
+    key = "image" if dataset.is_image else "mask"
+    sample = {key: torch.from_numpy(data), "crs": dataset.crs, "bbox": query}
+    if dataset.transforms is not None:
+        sample = dataset.transforms(sample)
+    return sample
+
+
+def band_files(dataset: RasterDataset, filepaths: Sequence[str]) -> List[List[str]]:
+    """Returns the files read for each band of a dataset, as RasterDataset does.
+
+    Args:
+        dataset: the dataset the files were found in
+        filepaths: files of the dataset index that intersect a query
+    Returns:
+        files: the files of each band (the files themselves, as a single "band", for
+            datasets that are not stored as a file per band)
+    """
+
+    if not dataset.separate_files:
+        return [list(filepaths)]
+
+    filename_regex = re.compile(dataset.filename_regex, re.VERBOSE)
+    files = []
+    for band in getattr(dataset, "bands", dataset.all_bands):
+        band_filepaths = []
+        for filepath in filepaths:
+            filename = os.path.basename(filepath)
+            directory = os.path.dirname(filepath)
+            match = re.match(filename_regex, filename)
+            if match:
+                if "date" in match.groupdict():
+                    start, end = match.start("band"), match.end("band")
+                    filename = filename[:start] + band + filename[end:]
+                if "resolution" in match.groupdict():
+                    start, end = match.start("resolution"), match.end("resolution")
+                    filename = filename[:start] + "*" + filename[end:]
+            band_filepaths.append(glob.glob(os.path.join(directory, filename))[0])
+        files.append(band_filepaths)
+
+    return files
+
+
+def files_extent(dataset: RasterDataset, filepaths: Sequence[str]) -> BoundingBox:
+    """Returns the extent of some files of a dataset (in its CRS), from their (cached)
+    file handles, with mint and maxt set to 0."""
+
+    bounds = []
+    for filepath in filepaths:
+        if dataset.cache:
+            bounds.append(dataset._cached_load_warp_file(filepath).bounds)
+        else:
+            with open_warp_file(dataset, filepath) as src:
+                bounds.append(src.bounds)
+
+    return BoundingBox(
+        min(b.left for b in bounds),
+        max(b.right for b in bounds),
+        min(b.bottom for b in bounds),
+        max(b.top for b in bounds),
+        0,
+        0,
+    )
+
+
+class PixelGrid:
+    """The pixel grid of a reference dataset, used to align bounding boxes with it.
+
+    Bounding boxes whose edges lie on the grid are read as plain windows of whole
+    pixels, instead of being resampled.
+    Args:
+        x0: x coordinate of a grid line (e.g. the left edge of the reference).
+        y0: y coordinate of a grid line (e.g. the top edge of the reference).
+        res: size of the (square) pixels in CRS units.
+    """
+
+    # Tolerance (in pixels) for coordinates that should already be on the grid
+    eps = 1e-6
+
+    def __init__(self, x0: float, y0: float, res: float) -> None:
+        self.x0 = x0
+        self.y0 = y0
+        self.res = res
+
+    @classmethod
+    def from_dataset(cls, dataset: GeoDataset) -> "PixelGrid":
+        """Returns the grid of the first (reference) dataset, e.g. landcover in
+        ``landcover & modis``, at the resolution of the dataset."""
+
+        reference = leaf_datasets(dataset)[0]
+        return cls(reference.bounds.minx, reference.bounds.maxy, dataset.res)
+
+    def snap_size(self, size: Tuple[float, float]) -> Tuple[float, float]:
+        """Rounds a (height, width) size to a whole number of pixels (at least one)."""
+
+        return (
+            max(round(size[0] / self.res), 1) * self.res,
+            max(round(size[1] / self.res), 1) * self.res,
+        )
+
+    def inner_bounds(self, bounds: BoundingBox) -> BoundingBox:
+        """Returns the largest bounding box on the grid that lies within 'bounds'."""
+
+        res, eps = self.res, self.eps
+        return BoundingBox(
+            self.x0 + math.ceil((bounds.minx - self.x0) / res - eps) * res,
+            self.x0 + math.floor((bounds.maxx - self.x0) / res + eps) * res,
+            self.y0 - math.floor((self.y0 - bounds.miny) / res + eps) * res,
+            self.y0 - math.ceil((self.y0 - bounds.maxy) / res - eps) * res,
+            bounds.mint,
+            bounds.maxt,
+        )
+
+    def window(self, bounds: BoundingBox) -> Optional[Tuple[int, int, int, int]]:
+        """Returns the (row, col, height, width) pixels of a bounding box on the grid,
+        or None if its edges are not on the grid."""
+
+        edges = np.array(
+            [
+                (bounds.minx - self.x0) / self.res,
+                (bounds.maxx - self.x0) / self.res,
+                (self.y0 - bounds.maxy) / self.res,
+                (self.y0 - bounds.miny) / self.res,
+            ]
+        )
+        pixels = np.round(edges)
+        if np.abs(edges - pixels).max() > self.eps:
+            return None
+
+        col0, col1, row0, row1 = pixels.astype(int).tolist()
+        return row0, col0, row1 - row0, col1 - col0
+
+    def bounds(
+        self, row: int, col: int, height: int, width: int, mint: float, maxt: float
+    ) -> BoundingBox:
+        """Returns the bounding box of a window of pixels (the inverse of window)."""
+
+        return BoundingBox(
+            self.x0 + col * self.res,
+            self.x0 + (col + width) * self.res,
+            self.y0 - (row + height) * self.res,
+            self.y0 - row * self.res,
+            mint,
+            maxt,
+        )
+
+    def snap(self, coordinates: np.ndarray, size: Tuple[float, float]) -> np.ndarray:
+        """Moves bounding boxes to the nearest position on the grid.
+
+        Args:
+            coordinates: (4, N) array of minx, maxx, miny, maxy coordinates.
+            size: (height, width) of the boxes, as returned by snap_size.
+        Returns:
+            coordinates: (4, N) array of the snapped coordinates.
+        """
+
+        minx = self.x0 + np.round((coordinates[0] - self.x0) / self.res) * self.res
+        maxy = self.y0 - np.round((self.y0 - coordinates[3]) / self.res) * self.res
+        return np.stack([minx, minx + size[1], maxy - size[0], maxy])
+
+
+def source_files(dataset_cls: Type[RasterDataset], root: str) -> List[str]:
+    """Returns the (sorted) files of a RasterDataset class found in root.
+
+    These are the files matching the filename glob and regex of the class and, for
+    datasets with a file per band (e.g. Sentinel2), the files of the other bands.
+    """
+
+    filename_regex = re.compile(dataset_cls.filename_regex, re.VERBOSE)
+    pathname = os.path.join(root, "**", dataset_cls.filename_glob)
+
+    filepaths = set()
+    for filepath in glob.iglob(pathname, recursive=True):
+        directory, filename = os.path.split(filepath)
+        match = re.match(filename_regex, filename)
+        if match is None:
+            continue
+
+        filepaths.add(filepath)
+        if dataset_cls.separate_files and "band" in match.groupdict():
+            start, end = match.start("band"), match.end("band")
+            for band in dataset_cls.all_bands:
+                other = os.path.join(
+                    directory, filename[:start] + band + filename[end:]
+                )
+                if os.path.exists(other):
+                    filepaths.add(other)
+
+    return sorted(filepaths)
+
+
+def get_aligned_root(root: str, crs: CRS, res: float) -> str:
+    """Returns the directory of the aligned store of a dataset root, for a grid.
+
+    The store is a hidden directory of the root, so the (recursive) file search of
+    the datasets does not find its files when reading the original root.
+    """
+
+    key = hashlib.sha1(f"{crs.to_wkt()}:{res!r}".encode()).hexdigest()
+    return os.path.join(root, ".aligned", key[:16])
+
+
+class AlignedRasterMixin:
+    """Reads a RasterDataset from its aligned store, if there is an up to date one.
+
+    An aligned store (made by src/preprocessing/align.py) holds a copy of every file
+    of the dataset, warped and resampled once onto the pixel grid of the reference
+    dataset (landcover). Samples on that grid are then plain window reads, rather
+    than being warped on the fly. The store is used when the dataset is made with the
+    crs and res it was aligned to, and none of the original files changed since.
+    Attributes:
+        source_root: the root the dataset was made with.
+        aligned: whether the dataset reads from the aligned store.
+    """
+
+    # Written last by the alignment tool, marking the store as complete
+    metadata_filename = "aligned.json"
+
+    def __init__(
+        self,
+        root: str,
+        crs: Optional[CRS] = None,
+        res: Optional[float] = None,
+        *args: Any,
+        **kwargs: Any,
+    ) -> None:
+
+        self.source_root = root
+        self.aligned = False
+        if crs is not None and res is not None:
+            aligned_root = get_aligned_root(root, crs, res)
+            if self.is_current(aligned_root):
+                root, self.aligned = aligned_root, True
+
+        super().__init__(root, crs, res, *args, **kwargs)  # type: ignore[call-arg]
+
+    @classmethod
+    def read_metadata(cls, aligned_root: str) -> Optional[Dict[str, Any]]:
+        """Returns the metadata of an aligned store, or None if it is incomplete."""
+
+        path = os.path.join(aligned_root, cls.metadata_filename)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def is_current(self, aligned_root: str) -> bool:
+        """Returns whether an aligned store holds every file of the source root, as
+        they are now."""
+
+        metadata = self.read_metadata(aligned_root)
+        if metadata is None:
+            return False
+
+        files = {
+            os.path.relpath(path, self.source_root): os.path.getmtime(path)
+            for path in source_files(type(self), self.source_root)  # type: ignore
+        }
+        if files != metadata["files"]:
+            warnings.warn(
+                f"The aligned store in {aligned_root} is out of date, so "
+                f"{type(self).__name__} is read from {self.source_root} instead."
+            )
+            return False
+
+        return True
+
+
+class CachedIndexRasterDataset(RasterDataset):
+    """RasterDataset that saves its index to a sidecar file, and loads it from there.
+
+    Building the index opens every file of the root, which takes minutes for the
+    MODIS and Sentinel roots. The index (bounds, time range and path of every file),
+    CRS, res and colormap are saved to a hidden file of the root, keyed by the dataset
+    class, the requested CRS and res, and the names, sizes and mtimes of the files
+    matching the filename glob. The index is only rebuilt when the key changes.
+    Subclasses of torchgeo datasets (e.g. Sentinel2) list this class after them, so
+    that it takes the place of RasterDataset.__init__ in their __init__.
+    """
+
+    # Value of the pixels without data, or None to use that of the files
+    nodata: Optional[float] = None
+
+    def __init__(
+        self,
+        root: str,
+        crs: Optional[CRS] = None,
+        res: Optional[float] = None,
+        transforms: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+        cache: bool = True,
+    ) -> None:
+
+        path, key = self.get_index_path(root, crs, res)
+        entries = self.load_index(path, key)
+        if entries is None:
+            super().__init__(root, crs, res, transforms, cache)
+            self.save_index(path, key)
+            return
+
+        GeoDataset.__init__(self, transforms)
+        self.root = root
+        self.cache = cache
+        for i, (minx, maxx, miny, maxy, mint, maxt, filename) in enumerate(entries):
+            coords = (minx, maxx, miny, maxy, mint, maxt)
+            self.index.insert(i, coords, os.path.join(root, filename))
+
+    def get_index_path(
+        self, root: str, crs: Optional[CRS], res: Optional[float]
+    ) -> Tuple[str, str]:
+        """Returns the path of the index sidecar of a root, and the key of its files."""
+
+        grid = f"{None if crs is None else crs.to_wkt()}:{res!r}"
+        name = f"{type(self).__name__}_{hashlib.sha1(grid.encode()).hexdigest()[:12]}"
+
+        digest = hashlib.sha1(
+            f"{self.filename_glob}:{self.filename_regex}:{self.date_format}".encode()
+        )
+        pathname = os.path.join(root, "**", self.filename_glob)
+        for filepath in sorted(glob.iglob(pathname, recursive=True)):
+            stat = os.stat(filepath)
+            relpath = os.path.relpath(filepath, root)
+            digest.update(f"{relpath}:{stat.st_size}:{stat.st_mtime}".encode())
+
+        return os.path.join(root, ".index", f"{name}.json"), digest.hexdigest()
+
+    def load_index(self, path: str, key: str) -> Optional[List[List[Any]]]:
+        """Restores the CRS, res and colormap saved with an index, and returns its
+        entries (coordinates and filename), or None if there is no valid index."""
+
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            saved = json.load(f)
+        if saved["key"] != key or not saved["entries"]:
+            return None
+
+        self._crs = CRS.from_wkt(saved["crs"])
+        self.res = saved["res"]
+        if saved["cmap"]:
+            self.cmap = {int(k): tuple(v) for k, v in saved["cmap"].items()}
+        return saved["entries"]
+
+    def save_index(self, path: str, key: str) -> None:
+        """Saves the index (and the CRS, res and colormap) to a sidecar file."""
+
+        # In insertion order, which decides the order files are merged in
+        hits = sorted(
+            self.index.intersection(self.index.bounds, objects=True),
+            key=lambda hit: hit.id,
+        )
+        entries = [
+            list(hit.bounds) + [os.path.relpath(hit.object, self.root)] for hit in hits
+        ]
+        saved = {
+            "key": key,
+            "crs": self.crs.to_wkt(),
+            "res": self.res,
+            "cmap": {str(k): list(v) for k, v in self.cmap.items()},
+            "entries": entries,
+        }
+
+        # The root may be read-only, in which case the index is built every time
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "w") as f:
+                json.dump(saved, f)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            pass
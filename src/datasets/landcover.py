@@ -1,17 +1,22 @@
 import torch
-from torchgeo.datasets.geo import RasterDataset
 from typing import Any, Callable, Dict, Optional
 
 from rasterio.crs import CRS
 
+from .cache import RasterCacheMixin
+from .geo import CachedIndexRasterDataset
 
-class LandcoverSimple(RasterDataset):
+
+class LandcoverSimple(RasterCacheMixin, CachedIndexRasterDataset):
     filename_glob = "*Simple.tif"
 
     # this is not true strictly speaking, but keeping like this for now
     # until we figure out how to handle this/how it fails
     is_image = True
 
+    # Class 0 is outside of Polesia
+    nodata = 0
+
     # Possible landcover classifications and corresponding values
     classifications = {
         "deciduous forests": 1,
@@ -51,9 +56,10 @@ class LandcoverSimple(RasterDataset):
         super().__init__(root, crs, res, transforms, cache)
 
 
-class LandcoverComplex(RasterDataset):
+class LandcoverComplex(RasterCacheMixin, CachedIndexRasterDataset):
     filename_glob = "*Complex.tif"
     is_image = False
+    nodata = 0
 
     # Possible landcover classifications and corresponding values
     classifications = {
@@ -9,10 +9,17 @@ from typing import Any, Callable, Dict, List, Optional, Sequence
 
 from rasterio.crs import CRS
 
-class Landsat7(Landsat):
+from .cache import RasterCacheMixin
+from .geo import AlignedRasterMixin, CachedIndexRasterDataset
+
+class Landsat7(AlignedRasterMixin, RasterCacheMixin, Landsat, CachedIndexRasterDataset):
     """Landsat 7 Enhanced Thematic Mapper Plus (ETM+)."""
 
     filename_glob = "LE07_*B3.TIF"
 
     all_bands = ["B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8"]
     rgb_bands = ["B3", "B2", "B1"]
+    resampling = "bilinear"
+    compact_scale = 1
+    # fill value of the scenes, outside their footprint
+    nodata = 0
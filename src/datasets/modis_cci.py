@@ -1,13 +1,18 @@
 import torch
-from torchgeo.datasets.geo import RasterDataset
 from typing import Any, Callable, Dict, Optional
 
 from rasterio.crs import CRS
 
+from .cache import RasterCacheMixin
+from .geo import AlignedRasterMixin, CachedIndexRasterDataset
 
-class MODIS_CCI(RasterDataset):
+
+class MODIS_CCI(AlignedRasterMixin, RasterCacheMixin, CachedIndexRasterDataset):
     """Abstract class for all MODIS CCI datasets."""
 
+    # Values are labels (burn dates), so they must not be interpolated
+    resampling = "nearest"
+
 
 class MODIS_JD(MODIS_CCI):
     filename_glob = "*JD.tif"
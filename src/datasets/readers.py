@@ -0,0 +1,453 @@
+import functools
+import itertools
+import math
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+import torch
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
+from torchgeo.datasets import BoundingBox, GeoDataset, RasterDataset
+from torchgeo.datasets.utils import concat_samples
+
+from .geo import PixelGrid, band_files, files_extent, labelled_sample, leaf_datasets
+
+# (row, col, height, width) of a patch on the pixel grid
+Window = Tuple[int, int, int, int]
+
+
+class ReadPool:
+    """A pool of (at most) max_threads threads to read files in.
+
+    GDAL releases the GIL while it decodes and warps rasters, so reads of different
+    files overlap. The threads are started when first used in each process (e.g. in
+    each DataLoader worker), as they do not survive a fork, and are not pickled.
+    """
+
+    def __init__(self, max_threads: int = 4) -> None:
+        self.max_threads = max_threads
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pid: Optional[int] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {"max_threads": self.max_threads, "_executor": None, "_pid": None}
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """Returns the thread pool of this process, starting it if needed."""
+
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(self.max_threads)
+            self._pid = os.getpid()
+        return self._executor
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> "Future[Any]":
+        """Runs fn(*args) in the pool, returning its future."""
+
+        return self.executor.submit(fn, *args)
+
+
+class CoalescingReader(Dataset):
+    """Reads the samples of a GeoDataset a batch at a time, coalescing the reads of
+    patches that share files.
+
+    Indexed by the list of bounding boxes of a batch (as yielded by the project batch
+    samplers), so it is used with ``DataLoader(reader, sampler=batch_sampler,
+    batch_size=None)``. For each source (leaf dataset) the patches of the batch that
+    read the same files (e.g. of one tile and month, as the constrained samplers draw)
+    are grouped into clusters of nearby patches, and the union window of each cluster
+    is read once, then sliced into the patches in memory. Patches that are alone in
+    their cluster, not on the pixel grid of the dataset or that go past the edge of
+    their files are read as usual, as are sources that are not RasterDatasets.
+    Samples are the same as those read one at a time, passed through the transforms
+    of each source and concatenated, as an IntersectionDataset would do.
+    Args:
+        dataset: the dataset to read, e.g. landcover & modis & sentinel.
+        max_union_ratio: largest ratio of the pixels read for a cluster (its union
+            window) to the pixels of its patches, which limits how much data between
+            distant patches is read.
+        copy_patches: set False to pass patches to the transforms as views of the
+            data read for their cluster, which the transforms must then not modify.
+        read_threads: number of threads that sources are read in at the same time,
+            or 0 to read them one after another.
+    """
+
+    def __init__(
+        self,
+        dataset: GeoDataset,
+        max_union_ratio: float = 2.0,
+        copy_patches: bool = True,
+        read_threads: int = 0,
+    ) -> None:
+
+        self.dataset = dataset
+        self.leaves = leaf_datasets(dataset)
+        self.grid = PixelGrid.from_dataset(dataset)
+        self.max_union_ratio = max_union_ratio
+        self.copy_patches = copy_patches
+        self.read_pool = ReadPool(read_threads) if read_threads > 0 else None
+
+    def __getitem__(self, boxes: Sequence[BoundingBox]) -> List[Dict[str, Any]]:
+        """Returns the samples of a batch of bounding boxes.
+
+        Raises:
+            IndexError: if a bounding box is not within the bounds of the dataset.
+        """
+
+        for box in boxes:
+            if not box.intersects(self.dataset.bounds):
+                raise IndexError(
+                    f"query: {box} not found in index with bounds: "
+                    f"{self.dataset.bounds}"
+                )
+
+        # Raw data already read by the sampler (see LabelledBoundingBox)
+        labels = [getattr(box, "labels", {}) for box in boxes]
+        boxes = [BoundingBox(*box) for box in boxes]
+
+        if self.read_pool is not None:
+            futures = [
+                self.read_pool.submit(self.read_source, i, ds, boxes, labels)
+                for i, ds in enumerate(self.leaves)
+            ]
+            leaf_samples = [future.result() for future in futures]
+        else:
+            leaf_samples = [
+                self.read_source(i, ds, boxes, labels)
+                for i, ds in enumerate(self.leaves)
+            ]
+        return [concat_samples(list(samples)) for samples in zip(*leaf_samples)]
+
+    def read_source(
+        self,
+        index: int,
+        dataset: GeoDataset,
+        boxes: Sequence[BoundingBox],
+        labels: Sequence[Dict[int, Any]],
+    ) -> List[Dict[str, Any]]:
+        """Returns the samples of the index-th source for a batch of bounding boxes,
+        made from the labels of the boxes that carry its data, and read for others."""
+
+        samples = {
+            n: labelled_sample(dataset, boxes[n], box_labels[index])
+            for n, box_labels in enumerate(labels)
+            if index in box_labels
+        }
+        missing = [n for n in range(len(boxes)) if n not in samples]
+        if missing:
+            read = self.read_boxes(dataset, [boxes[n] for n in missing])
+            samples.update(zip(missing, read))
+        return [samples[n] for n in range(len(boxes))]
+
+    def read_boxes(
+        self, dataset: GeoDataset, boxes: Sequence[BoundingBox]
+    ) -> List[Dict[str, Any]]:
+        """Returns the samples of a source for a batch of bounding boxes."""
+
+        if not isinstance(dataset, RasterDataset) or dataset.res != self.grid.res:
+            return [dataset[box] for box in boxes]
+
+        # Patches on the grid, grouped by the files (and time range) they read
+        samples: List[Optional[Dict[str, Any]]] = [None] * len(boxes)
+        windows: Dict[int, Window] = {}
+        groups: Dict[Tuple[Any, ...], List[int]] = {}
+        for i, box in enumerate(boxes):
+            hits = dataset.index.intersection(tuple(box), objects=True)
+            filepaths = tuple(hit.object for hit in hits)
+            window = self.grid.window(box)
+            if filepaths and window is not None:
+                windows[i] = window
+                groups.setdefault((filepaths, box.mint, box.maxt), []).append(i)
+
+        for (filepaths, mint, maxt), indexes in groups.items():
+            # Windows past the edge of the files are resampled, so not coalesced
+            extent = self.grid.window(
+                self.grid.inner_bounds(files_extent(dataset, filepaths))
+            )
+            if extent is None:
+                continue
+            indexes = [i for i in indexes if contains(extent, windows[i])]
+
+            for cluster in self.cluster(indexes, windows):
+                if len(cluster) > 1:
+                    union = union_window([windows[i] for i in cluster])
+                    data = self.read_window(dataset, filepaths, union, mint, maxt)
+                    for i in cluster:
+                        samples[i] = self.slice_sample(
+                            dataset, data, union, windows[i], boxes[i]
+                        )
+
+        return [
+            sample if sample is not None else dataset[box]
+            for sample, box in zip(samples, boxes)
+        ]
+
+    def cluster(
+        self, indexes: Sequence[int], windows: Dict[int, Window]
+    ) -> List[List[int]]:
+        """Greedily groups patches into clusters whose union window is at most
+        max_union_ratio times the size of their patches."""
+
+        clusters: List[Tuple[List[int], Window, int]] = []
+        for i in sorted(indexes, key=lambda i: windows[i][:2]):
+            pixels = windows[i][2] * windows[i][3]
+            for n, (members, union, cluster_pixels) in enumerate(clusters):
+                new_union = union_window([union, windows[i]])
+                new_pixels = cluster_pixels + pixels
+                if new_union[2] * new_union[3] <= self.max_union_ratio * new_pixels:
+                    clusters[n] = (members + [i], new_union, new_pixels)
+                    break
+            else:
+                clusters.append(([i], windows[i], pixels))
+
+        return [members for members, _, _ in clusters]
+
+    def read_window(
+        self,
+        dataset: RasterDataset,
+        filepaths: Sequence[str],
+        window: Window,
+        mint: float,
+        maxt: float,
+    ) -> torch.Tensor:
+        """Reads (and merges) a window of the grid from some files of a dataset, as
+        the dataset would for a bounding box."""
+
+        bounds = self.grid.bounds(*window, mint, maxt)
+        return torch.cat(
+            [
+                dataset._merge_files(files, bounds)
+                for files in band_files(dataset, filepaths)
+            ]
+        )
+
+    def slice_sample(
+        self,
+        dataset: RasterDataset,
+        data: torch.Tensor,
+        union: Window,
+        window: Window,
+        box: BoundingBox,
+    ) -> Dict[str, Any]:
+        """Returns the sample of a patch within the data read for its cluster."""
+
+        row, col = window[0] - union[0], window[1] - union[1]
+        patch = data[:, row : row + window[2], col : col + window[3]]
+        if self.copy_patches:
+            # Copied, so that transforms cannot modify the other patches
+            patch = patch.clone()
+
+        key = "image" if dataset.is_image else "mask"
+        sample = {key: patch, "crs": dataset.crs, "bbox": box}
+        if dataset.transforms is not None:
+            sample = dataset.transforms(sample)
+        return sample
+
+
+def union_window(windows: Sequence[Window]) -> Window:
+    """Returns the smallest window containing all the given windows."""
+
+    row0 = min(row for row, _, _, _ in windows)
+    col0 = min(col for _, col, _, _ in windows)
+    row1 = max(row + height for row, _, height, _ in windows)
+    col1 = max(col + width for _, col, _, width in windows)
+    return row0, col0, row1 - row0, col1 - col0
+
+
+def contains(outer: Window, inner: Window) -> bool:
+    """Returns whether a window lies within another."""
+
+    return (
+        outer[0] <= inner[0]
+        and outer[1] <= inner[1]
+        and inner[0] + inner[2] <= outer[0] + outer[2]
+        and inner[1] + inner[3] <= outer[1] + outer[3]
+    )
+
+
+class ConcurrentReader(Dataset):
+    """Reads the sources of each sample of a GeoDataset at the same time, in threads.
+
+    An IntersectionDataset reads its sources (and the bands of sources stored as a
+    file per band, e.g. Sentinel2 and Landsat7) one after another, so a sample takes
+    the sum of their read times. Here every source, and every band of those, is read
+    in a ReadPool, so a sample takes about as long as its slowest read. Samples are
+    the same as those of the dataset.
+    Args:
+        dataset: the dataset to read, e.g. landcover & modis & sentinel.
+        read_threads: maximum number of threads (per DataLoader worker).
+    """
+
+    def __init__(self, dataset: GeoDataset, read_threads: int = 4) -> None:
+
+        self.dataset = dataset
+        self.leaves = leaf_datasets(dataset)
+        self.read_pool = ReadPool(read_threads)
+
+    def __getitem__(self, query: BoundingBox) -> Dict[str, Any]:
+        """Returns the sample within a bounding box.
+
+        Raises:
+            IndexError: if the bounding box is not within the bounds of the dataset.
+        """
+
+        if not query.intersects(self.dataset.bounds):
+            raise IndexError(
+                f"query: {query} not found in index with bounds: {self.dataset.bounds}"
+            )
+
+        # Sources whose raw data the sampler already read are not read again
+        labels = getattr(query, "labels", {})
+        query = BoundingBox(*query)
+
+        # Every read is started before waiting for any of them
+        results = [
+            functools.partial(labelled_sample, ds, query, labels[i])
+            if i in labels
+            else self.submit(ds, query)
+            for i, ds in enumerate(self.leaves)
+        ]
+        return concat_samples([result() for result in results])
+
+    def submit(
+        self, dataset: GeoDataset, query: BoundingBox
+    ) -> Callable[[], Dict[str, Any]]:
+        """Starts reading the sample of a source, returning a function that waits for
+        the sample (as read by the source) and returns it."""
+
+        if not isinstance(dataset, RasterDataset):
+            return self.read_pool.submit(dataset.__getitem__, query).result
+
+        hits = dataset.index.intersection(tuple(query), objects=True)
+        filepaths = [hit.object for hit in hits]
+        if not filepaths:
+            raise IndexError(
+                f"query: {query} not found in index with bounds: {dataset.bounds}"
+            )
+
+        futures = [
+            self.read_pool.submit(dataset._merge_files, files, query)
+            for files in band_files(dataset, filepaths)
+        ]
+
+        def result() -> Dict[str, Any]:
+            data = torch.cat([future.result() for future in futures])
+            key = "image" if dataset.is_image else "mask"
+            sample = {key: data, "crs": dataset.crs, "bbox": query}
+            if dataset.transforms is not None:
+                sample = dataset.transforms(sample)
+            return sample
+
+        return result
+
+
+class LabelledReader(Dataset):
+    """Reads the samples of a GeoDataset as the dataset does, except for the sources
+    whose raw data a LabelledBoundingBox carries, which are not read again.
+
+    Samplers that read the label layers of their patches to check them (see
+    StagedRandomBatchGeoSampler) pass the data on with the bounding boxes, so the
+    DataLoader only reads the other sources. CoalescingReader and ConcurrentReader
+    use the data of such boxes too.
+    Args:
+        dataset: the dataset to read, e.g. landcover & modis & sentinel.
+    """
+
+    def __init__(self, dataset: GeoDataset) -> None:
+
+        self.dataset = dataset
+        self.leaves = leaf_datasets(dataset)
+
+    def __getitem__(self, query: BoundingBox) -> Dict[str, Any]:
+        """Returns the sample within a bounding box.
+
+        Raises:
+            IndexError: if the bounding box is not within the bounds of the dataset.
+        """
+
+        if not query.intersects(self.dataset.bounds):
+            raise IndexError(
+                f"query: {query} not found in index with bounds: {self.dataset.bounds}"
+            )
+
+        labels = getattr(query, "labels", {})
+        query = BoundingBox(*query)
+        return concat_samples(
+            [
+                labelled_sample(ds, query, labels[i]) if i in labels else ds[query]
+                for i, ds in enumerate(self.leaves)
+            ]
+        )
+
+
+class GridSweepReader(IterableDataset):
+    """Reads every patch of a grid sampler (e.g. SnappedGridGeoSampler), a block of
+    the grid at a time.
+
+    Grid samplers with a stride smaller than the patch size read every pixel many
+    times, (size / stride) ** 2 times in total. Instead, the patches are grouped into
+    blocks of block_size x block_size pixels (by their top left corner), and each
+    source is read once per block, over the union of its patches (see
+    CoalescingReader), then sliced into the patches as views. Blocks are read in the
+    order the sampler first reaches them (row by row within each tile), so that
+    neighbouring blocks, which share files, are read one after another. The patches
+    are yielded one at a time, in that order, to be batched by the DataLoader.
+    DataLoader workers take turns at whole batches of 'batch_size' patches (reading
+    the patches of each block within a batch together), so that no worker ends on a
+    partial batch, and the DataLoader yields len(self) / batch_size batches (rounded
+    up) in the same order as without workers.
+    Args:
+        dataset: the dataset to read, e.g. landcover & modis & landsat.
+        sampler: sampler of the patches, whose boxes should be on the pixel grid of
+            the dataset (as those of SnappedGridGeoSampler), others are read as usual.
+        block_size: size of the blocks, in pixels of the grid.
+        batch_size: batch size of the DataLoader.
+    """
+
+    def __init__(
+        self,
+        dataset: GeoDataset,
+        sampler: Sampler[BoundingBox],
+        block_size: int = 1024,
+        batch_size: int = 1,
+    ) -> None:
+
+        self.reader = CoalescingReader(dataset, math.inf, copy_patches=False)
+        self.sampler = sampler
+        self.block_size = block_size
+        self.batch_size = batch_size
+
+    def __len__(self) -> int:
+        return len(self.sampler)  # type: ignore[arg-type]
+
+    def blocks(self) -> List[List[BoundingBox]]:
+        """Returns the boxes of the sampler, grouped into blocks."""
+
+        blocks: Dict[Tuple[Any, ...], List[BoundingBox]] = {}
+        for n, box in enumerate(self.sampler):
+            window = self.reader.grid.window(box)
+            if window is None:
+                key: Tuple[Any, ...] = (n,)
+            else:
+                row, col = window[0] // self.block_size, window[1] // self.block_size
+                key = (box.mint, box.maxt, row, col)
+            blocks.setdefault(key, []).append(box)
+
+        return list(blocks.values())
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        """Yields the samples of the patches, block by block."""
+
+        blocks = self.blocks()
+        worker_info = get_worker_info()
+        if worker_info is None:
+            for boxes in blocks:
+                yield from self.reader[boxes]
+            return
+
+        # The batches of this worker, as (block, box) pairs in the order of the blocks
+        patches = [(i, box) for i, boxes in enumerate(blocks) for box in boxes]
+        step = self.batch_size * worker_info.num_workers
+        for start in range(worker_info.id * self.batch_size, len(patches), step):
+            batch = patches[start : start + self.batch_size]
+            for _, group in itertools.groupby(batch, key=lambda patch: patch[0]):
+                yield from self.reader[[box for _, box in group]]
@@ -1,10 +1,17 @@
 from typing import Any, Callable, Dict, Optional, Sequence
+import numpy as np
+import rasterio
+import rasterio.merge
+import torch
 from rasterio.crs import CRS
 
 
-from torchgeo.datasets import Sentinel2
+from torchgeo.datasets import BoundingBox, Sentinel2
 
-class Sentinel2(Sentinel2):
+from .cache import RasterCacheMixin
+from .geo import AlignedRasterMixin, CachedIndexRasterDataset
+
+class Sentinel2(AlignedRasterMixin, RasterCacheMixin, Sentinel2, CachedIndexRasterDataset):
     """
     Custom Sentinel 2 Class
      - works with new name and date format for monthly composite files. 
@@ -16,3 +23,92 @@ class Sentinel2(Sentinel2):
     filename_regex = '^(?P<date>\\d{6})\\S{4}(?P<band>B[018][\\dA]).tif$'
     date_format = '%Y%m'
     all_bands = ['B03', 'B08', 'B11']
+    resampling = 'bilinear'
+    # bands are exported divided by 65535 (see pull_monthly_cloudless_sentinel), so this scale stores them exactly as uint16
+    compact_scale = 65535
+    # pixels outside the tiles (or masked by GEE) are exported as 0
+    nodata = 0
+
+
+class Sentinel2Stacked(AlignedRasterMixin, RasterCacheMixin, CachedIndexRasterDataset):
+    """
+    Sentinel 2 monthly composites with all bands stacked in one file per month/tile
+     - made from the per band files by stack_sentinel_bands (see utils.py)
+     - the requested bands of a sample are read from a file in one windowed read, rather than a file open and read per band
+
+    Note: band names are read from the band descriptions of the first file found, all files are assumed to hold the same bands
+    """
+    filename_glob = '*_stack.tif'
+    filename_regex = '^(?P<date>\\d{6})_(?P<tile>\\d{1,2})_stack.tif$'
+    date_format = '%Y%m'
+    is_image = True
+    resampling = 'bilinear'
+    compact_scale = 65535
+    nodata = 0
+
+    def __init__(
+        self,
+        root: str = None,
+        crs: Optional[CRS] = None,
+        res: Optional[float] = None,
+        bands: Optional[Sequence[str]] = None,
+        transforms: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+        cache: bool = True,
+    ) -> None:
+        """Initialize a new Dataset instance.
+
+        Args:
+            root: root directory where dataset can be found
+            crs: :term:`coordinate reference system (CRS)` to warp to
+                (defaults to the CRS of the first file found)
+            res: resolution of the dataset in units of CRS
+                (defaults to the resolution of the first file found)
+            bands: bands to return (defaults to all bands in the files)
+            transforms: a function/transform that takes an input sample
+                and returns a transformed version
+            cache: if True, cache file handle to speed up repeated sampling
+        Raises:
+            FileNotFoundError: if no files are found in ``root``
+            ValueError: if a band is not in the files
+        """
+
+        super().__init__(root, crs, res, transforms, cache)
+
+        hit = next(self.index.intersection(self.index.bounds, objects=True))
+        with rasterio.open(hit.object) as src:
+            self.all_bands = list(src.descriptions)
+
+        self.bands = list(bands or self.all_bands)
+        for band in self.bands:
+            if band not in self.all_bands:
+                raise ValueError(f"Band '{band}' is not in the stacked files ({self.all_bands}).")
+        self.band_indexes = [self.all_bands.index(band) + 1 for band in self.bands]
+
+    def _read_files(self, filepaths: Sequence[str], query: BoundingBox) -> torch.Tensor:
+        """Load and merge the requested bands of one or more files (called through the
+        caches of RasterCacheMixin, if enabled).
+
+        Args:
+            filepaths: one or more files to load and merge
+            query: (minx, maxx, miny, maxy, mint, maxt) coordinates to index
+
+        Returns:
+            image at that index, with the bands in the requested order
+        """
+        if self.cache:
+            vrt_fhs = [self._cached_load_warp_file(fp) for fp in filepaths]
+        else:
+            vrt_fhs = [self._load_warp_file(fp) for fp in filepaths]
+
+        # merged even for a single file, as parts of the query outside the file (e.g. at the edge of a tile) are filled with
+        # nodata this way, which a windowed read of a WarpedVRT (not boundless) would stretch the file over instead
+        bounds = (query.minx, query.miny, query.maxx, query.maxy)
+        dest, _ = rasterio.merge.merge(vrt_fhs, bounds, self.res, nodata=self.nodata, indexes=self.band_indexes)
+
+        # fix numpy dtypes which are not supported by pytorch tensors
+        if dest.dtype == np.uint16:
+            dest = dest.astype(np.int32)
+        elif dest.dtype == np.uint32:
+            dest = dest.astype(np.int64)
+
+        return torch.tensor(dest)
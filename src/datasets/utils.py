@@ -12,6 +12,7 @@ import dateutil
 import glob
 import re
 import shutil
+import rasterio
 
 
 
@@ -410,6 +411,73 @@ def clean_sentinel_folder(path, bad_path):
             shutil.move(os.path.join(path, filename) , os.path.join( bad_path, filename ) )
 
 
+def stack_sentinel_bands(path, outdir, bands=('B03', 'B08', 'B11'), blocksize=256):
+    """
+    Stacks the per band files of each date/tile (as exported by pull_monthly_cloudless_sentinel) into one multi-band GeoTIFF,
+    {date}_{tile}_stack.tif, with the band names as band descriptions. Sentinel2Stacked then reads all bands of a sample in one read.
+    Date/tile combos missing a band are skipped (see clean_sentinel_folder), as are stacks that are newer than their band files,
+    so this can be rerun after new months are downloaded.
+
+    Inputs:
+
+    path: folder of the per band files
+
+    outdir: folder to write the stacks to
+
+    bands: bands to stack, in order (e.g. add 'B04' and 'B12' for NBR)
+
+    blocksize: size of the internal tiles of the stacks, in pixels
+    """
+    filename_regex = re.compile('^(?P<date>\\d{6})_(?P<tile>\\d{1,2})_(?P<band>B[018][\\dA]).tif$')
+
+    # Band files of each date/tile combo
+    date_tiles = {}
+    for filename in sorted(os.listdir(path)):
+        match = re.match(filename_regex, filename)
+        if match is not None:
+            date_tile = (match.group('date'), match.group('tile'))
+            date_tiles.setdefault(date_tile, {})[match.group('band')] = os.path.join(path, filename)
+
+    os.makedirs(outdir, exist_ok=True)
+
+    for (date, tile), band_files in date_tiles.items():
+        stack_file_name = os.path.join(outdir, date + '_' + tile + '_stack.tif')
+
+        if any(band not in band_files for band in bands):
+            print('Skipping {}_{}, missing bands'.format(date, tile))
+            continue
+
+        band_paths = [band_files[band] for band in bands]
+        if os.path.exists(stack_file_name) and os.path.getmtime(stack_file_name) >= max(os.path.getmtime(p) for p in band_paths):
+            continue
+
+        print('Stacking {}_{}'.format(date, tile))
+        with rasterio.open(band_paths[0]) as first:
+            profile = first.profile.copy()
+            for band_path in band_paths[1:]:
+                with rasterio.open(band_path) as src:
+                    if (src.crs, src.transform, src.shape) != (first.crs, first.transform, first.shape):
+                        raise ValueError('{} is not on the same grid as {}'.format(band_path, band_paths[0]))
+
+        # Pixel interleaved tiles, so a window of all bands is decompressed in one go
+        float_data = np.issubdtype(np.dtype(profile['dtype']), np.floating)
+        profile.update(
+            driver='GTiff', count=len(bands), tiled=True, blockxsize=blocksize, blockysize=blocksize,
+            compress='deflate', predictor=3 if float_data else 2, interleave='pixel',
+        )
+
+        # Written to a temporary file first, so an interrupted run leaves no partial stack
+        tmp_file_name = os.path.join(outdir, '.' + date + '_' + tile + '_stack.tif.tmp')
+        with rasterio.open(tmp_file_name, 'w', **profile) as dst:
+            for i, (band, band_path) in enumerate(zip(bands, band_paths), start=1):
+                with rasterio.open(band_path) as src:
+                    dst.write(src.read(1), i)
+                dst.set_band_description(i, band)
+        os.replace(tmp_file_name, stack_file_name)
+
+    print('Stacked all Sentinel 2 bands!')
+
+
 def unzip_all_modis_fire_files(output_path):
     """
     Function pulls all modis fire data from CEDA archive within Jasmin from 2001 - 2020 and unzips it into output folder. 
@@ -1,6 +1,9 @@
-from .transforms import Binarize, OneHotEncode
+from .transforms import Binarize, OneHotEncode, dequantize, one_hot, quantize
 
 __all__ = (
     Binarize,
     OneHotEncode,
+    one_hot,
+    quantize,
+    dequantize,
 )
@@ -0,0 +1,191 @@
+"""
+Description: Warps the rasters of a dataset once onto the landcover pixel grid, so the
+datasets read them without warping or resampling every sample
+
+Usage:
+  python -m src.preprocessing.align <landcover_root> <root> --dataset=<name> [--blocksize=<px>] [--workers=<n>]
+
+Options:
+  --dataset=<name>         Dataset class of the rasters in root: MODIS_JD, Sentinel2
+                           or Landsat7.
+  --blocksize=<px>         Internal tile size of the aligned rasters [default: 128].
+  --workers=<n>            Files aligned in parallel [default: 4].
+
+Every file of the dataset (a source and month, or a band of one) is written to the
+aligned store of the root (see AlignedRasterMixin), keeping its name, as a tiled COG in
+the CRS and at the resolution of the landcover, with its edges on the landcover grid.
+The datasets use the store when made with the landcover CRS and res (as the datamodules
+do), and fall back to the original files when they changed since the store was made.
+Files that are already aligned are skipped, so the tool can be re-run after new months
+are added to the root. The tool is run as a module from the root of the repository, as
+it imports the datasets of the package.
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Tuple, Type
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from torchgeo.datasets import RasterDataset
+
+from ..datasets import LandcoverSimple, Landsat7, MODIS_JD, Sentinel2
+from ..datasets.geo import PixelGrid, get_aligned_root, source_files
+from .cog import write_cog
+
+datasets: Dict[str, Type[RasterDataset]] = {
+    "MODIS_JD": MODIS_JD,
+    "Sentinel2": Sentinel2,
+    "Landsat7": Landsat7,
+}
+
+
+def align_file(
+    src_path: str,
+    dst_path: str,
+    grid: Tuple[str, float, float, float],
+    resampling: str = "nearest",
+    blocksize: int = 128,
+) -> None:
+    """Warps a raster onto a pixel grid, and writes it as a COG.
+
+    The edges of the raster are moved to the nearest grid lines, so that neighbouring
+    tiles do not overlap once aligned.
+    Args:
+        src_path: raster to align.
+        dst_path: path of the aligned raster.
+        grid: (crs wkt, x0, y0, res) of the grid, see PixelGrid.
+        resampling: resampling method, used as is for labels ("nearest"), or when
+            the raster is upsampled, and replaced by "average" when it is downsampled.
+        blocksize: size of the internal tiles, in pixels.
+    """
+
+    crs_wkt, x0, y0, res = grid
+    crs = CRS.from_wkt(crs_wkt)
+
+    with rasterio.open(src_path) as src:
+        minx, miny, maxx, maxy = transform_bounds(src.crs, crs, *src.bounds)
+
+        # Pixels averaged from several source pixels, rather than interpolated
+        if resampling != "nearest" and res > (maxx - minx) / src.width:
+            resampling = "average"
+
+        col0, col1 = np.round((np.array([minx, maxx]) - x0) / res).astype(int)
+        row0, row1 = np.round((y0 - np.array([maxy, miny])) / res).astype(int)
+        transform = from_origin(x0 + col0 * res, y0 - row0 * res, res, res)
+
+        with WarpedVRT(
+            src,
+            crs=crs,
+            transform=transform,
+            width=max(col1 - col0, 1),
+            height=max(row1 - row0, 1),
+            resampling=Resampling[resampling],
+        ) as vrt:
+            write_cog(
+                vrt,
+                dst_path,
+                blocksize,
+                "nearest" if resampling == "nearest" else "average",
+            )
+
+
+def align_dataset(
+    dataset_cls: Type[RasterDataset],
+    root: str,
+    reference: RasterDataset,
+    blocksize: int = 128,
+    workers: int = 4,
+) -> str:
+    """Writes (or updates) the aligned store of a dataset root.
+
+    Args:
+        dataset_cls: class of the dataset, e.g. MODIS_JD.
+        root: root directory of the dataset.
+        reference: dataset whose grid to align to, i.e. the landcover.
+        blocksize: size of the internal tiles, in pixels.
+        workers: number of files aligned at the same time.
+    Returns:
+        aligned_root: directory of the aligned store.
+    """
+
+    reference_grid = PixelGrid.from_dataset(reference)
+    grid = (
+        reference.crs.to_wkt(),
+        reference_grid.x0,
+        reference_grid.y0,
+        reference_grid.res,
+    )
+    aligned_root = get_aligned_root(root, reference.crs, reference.res)
+    metadata_path = os.path.join(aligned_root, dataset_cls.metadata_filename)
+
+    # Files already aligned to the same grid are kept, unless they changed since
+    metadata = dataset_cls.read_metadata(aligned_root)
+    done = {}
+    if metadata is not None and tuple(metadata["grid"]) == grid:
+        done = metadata["files"]
+        os.remove(metadata_path)
+
+    files = {
+        os.path.relpath(path, root): os.path.getmtime(path)
+        for path in source_files(dataset_cls, root)
+    }
+    todo = [
+        name
+        for name, mtime in files.items()
+        if done.get(name) != mtime
+        or not os.path.exists(os.path.join(aligned_root, name))
+    ]
+
+    # Aligned copies of removed files would otherwise still be read
+    for name in set(done) - set(files):
+        if os.path.exists(os.path.join(aligned_root, name)):
+            os.remove(os.path.join(aligned_root, name))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                align_file,
+                os.path.join(root, name),
+                os.path.join(aligned_root, name),
+                grid,
+                dataset_cls.resampling,
+                blocksize,
+            )
+            for name in todo
+        ]
+        for name, future in zip(todo, futures):
+            future.result()
+            print(f"aligned: {name}")
+
+    # The metadata is written last, marking the store as complete
+    os.makedirs(aligned_root, exist_ok=True)
+    with open(metadata_path, "w") as f:
+        json.dump({"grid": grid, "files": files}, f, indent=2)
+
+    print(f"Aligned {len(todo)} of {len(files)} files into {aligned_root}.")
+    return aligned_root
+
+
+if __name__ == "__main__":
+
+    import sys
+    from docopt import docopt
+
+    # Python consumes the "-m src.preprocessing.align" of the usage line
+    args = docopt(__doc__, argv=["-m", __spec__.name] + sys.argv[1:])
+    if args["--dataset"] not in datasets:
+        raise ValueError(f"Dataset '{args['--dataset']}' is not valid.")
+
+    align_dataset(
+        datasets[args["--dataset"]],
+        args["<root>"],
+        LandcoverSimple(args["<landcover_root>"]),
+        blocksize=int(args["--blocksize"]),
+        workers=int(args["--workers"]),
+    )
@@ -0,0 +1,299 @@
+"""
+Description: Rewrites the rasters of a dataset root as cloud-optimized GeoTIFFs (COGs),
+and benchmarks random window reads before and after
+
+Usage:
+  cog.py convert <root> [--out=<dir>] [--patch-size=<px>] [--blocksize=<px>] [--resampling=<method>] [--workers=<n>] [--pattern=<glob>]
+  cog.py benchmark <before> <after> [--patch-size=<px>] [--reads=<n>] [--pattern=<glob>] [--seed=<seed>]
+
+Options:
+  --out=<dir>              Directory to write the COGs to (default: rewrite in place).
+  --patch-size=<px>        Patch size the rasters are sampled with [default: 256].
+  --blocksize=<px>         Internal tile size (default: chosen from the patch size).
+  --resampling=<method>    Overview resampling, or auto for nearest on integer rasters
+                           (labels, landcover) and average on float ones [default: auto].
+  --workers=<n>            Files converted in parallel [default: 4].
+  --pattern=<glob>         Rasters to convert, relative to the root (only .tif and .tiff
+                           files, not sidecars such as .tif.aux.xml) [default: **/*.tif*].
+  --reads=<n>              Random windows read per raster [default: 50].
+  --seed=<seed>            Seed of the random windows [default: 0].
+
+The MODIS, landcover, Sentinel and ERA5 rasters are read as written by their producers,
+usually in strips and without overviews, so that a random patch decompresses many full
+rows of the raster. COGs are tiled, so a patch only decompresses the tiles it overlaps.
+Files keep their names (the datasets find them by filename), and rasters that already
+are COGs with the requested layout are skipped, so converting a root twice is cheap.
+Rasters that fail to convert are reported, and do not stop the others.
+"""
+
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.windows import Window
+
+# Extensions of the rasters found by a pattern (rather than their sidecars)
+RASTER_EXTENSIONS = (".tif", ".tiff")
+
+
+def get_blocksize(patch_size: int) -> int:
+    """Returns the tile size to use for rasters sampled in patches of a given size.
+
+    A random patch overlaps about (patch_size / blocksize + 1) ** 2 tiles, so smaller
+    tiles decompress fewer unused pixels, while larger ones need fewer reads (and
+    compress better). Half the patch size is a good balance, within GDAL's limits.
+    """
+
+    blocksize = 2 ** int(np.round(np.log2(max(patch_size, 1) / 2)))
+    return int(np.clip(blocksize, 128, 512))
+
+
+def is_cog(path: str, blocksize: int) -> bool:
+    """Returns whether a raster is already tiled and compressed with the given
+    blocksize, and has overviews (when large enough to need them)."""
+
+    with rasterio.open(path) as src:
+        if src.profile.get("tiled") is not True or src.compression is None:
+            return False
+        if any(shape != (blocksize, blocksize) for shape in src.block_shapes):
+            return False
+        return max(src.width, src.height) <= blocksize or len(src.overviews(1)) > 0
+
+
+def find_rasters(root: str, pattern: str) -> List[str]:
+    """Returns the (sorted) rasters of a root matching a glob, skipping any sidecar
+    files it matches too (e.g. .tif.aux.xml or .tif.ovr)."""
+
+    paths = glob.glob(os.path.join(root, pattern), recursive=True)
+    return sorted(path for path in paths if path.lower().endswith(RASTER_EXTENSIONS))
+
+
+def convert_file(
+    src_path: str,
+    dst_path: str,
+    blocksize: int = 256,
+    resampling: str = "auto",
+) -> str:
+    """Writes a raster as a DEFLATE-compressed COG, unless this was done already.
+
+    Args:
+        src_path: raster to convert.
+        dst_path: path of the COG (may be src_path, to convert in place).
+        blocksize: size of the internal tiles, in pixels.
+        resampling: overview resampling method, or "auto" for nearest on integer
+            rasters (categorical values, e.g. burn dates) and average on float ones.
+    Returns:
+        status: "converted" or "skipped".
+    """
+
+    if os.path.exists(dst_path) and is_cog(dst_path, blocksize):
+        if dst_path == src_path or os.path.getmtime(dst_path) >= os.path.getmtime(
+            src_path
+        ):
+            return "skipped"
+
+    with rasterio.open(src_path) as src:
+        write_cog(src, dst_path, blocksize, resampling)
+
+    return "converted"
+
+
+def write_cog(
+    src: Any, dst_path: str, blocksize: int = 256, resampling: str = "auto"
+) -> None:
+    """Writes an open raster (or VRT) as a DEFLATE-compressed COG.
+
+    Args:
+        src: the raster to write, e.g. a rasterio dataset or WarpedVRT.
+        dst_path: path of the COG.
+        blocksize: size of the internal tiles, in pixels.
+        resampling: overview resampling method, see convert_file.
+    """
+
+    if resampling == "auto":
+        integer = np.issubdtype(np.dtype(src.dtypes[0]), np.integer)
+        resampling = "nearest" if integer else "average"
+
+    # Written next to the destination (as a hidden file, which glob ignores) and
+    # moved into place once complete, so an interrupted conversion never leaves a
+    # broken raster behind
+    directory, filename = os.path.split(dst_path)
+    os.makedirs(directory or ".", exist_ok=True)
+    tmp_path = os.path.join(directory, f".{filename}.tmp")
+    rasterio.shutil.copy(
+        src,
+        tmp_path,
+        driver="COG",
+        BLOCKSIZE=blocksize,
+        COMPRESS="DEFLATE",
+        PREDICTOR="YES",
+        OVERVIEW_RESAMPLING=resampling.upper(),
+        BIGTIFF="IF_SAFER",
+    )
+    os.replace(tmp_path, dst_path)
+
+
+def convert_root(
+    root: str,
+    out: Optional[str] = None,
+    patch_size: int = 256,
+    blocksize: Optional[int] = None,
+    resampling: str = "auto",
+    workers: int = 4,
+    pattern: str = "**/*.tif*",
+) -> Dict[str, int]:
+    """Converts every raster of a dataset root to a COG, in parallel.
+
+    Args:
+        root: dataset root, e.g. the modis_root_dir of the datamodule.
+        out: directory to write the COGs to, mirroring root (None to convert in place).
+        patch_size: patch size the rasters are sampled with.
+        blocksize: size of the internal tiles (None to choose it from patch_size).
+        resampling: overview resampling method, see convert_file.
+        workers: number of files converted at the same time.
+        pattern: glob of the rasters to convert, relative to root (see find_rasters).
+    Returns:
+        counts: number of files converted, skipped and failed.
+    """
+
+    blocksize = blocksize or get_blocksize(patch_size)
+    src_paths = find_rasters(root, pattern)
+    dst_paths = [
+        path if out is None else os.path.join(out, os.path.relpath(path, root))
+        for path in src_paths
+    ]
+
+    counts = {"converted": 0, "skipped": 0, "failed": 0}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(convert_file, src, dst, blocksize, resampling)
+            for src, dst in zip(src_paths, dst_paths)
+        ]
+        for path, future in zip(src_paths, futures):
+            try:
+                status = future.result()
+            except Exception as error:
+                # Reported, so that one unreadable file does not stop the others
+                status = "failed"
+                print(f"{status}: {path} ({error})")
+            else:
+                print(f"{status}: {path}")
+            counts[status] += 1
+
+    return counts
+
+
+def random_windows(
+    path: str, size: int, num_reads: int, generator: np.random.Generator
+) -> List[Window]:
+    """Returns random windows of a raster, of (at most) size x size pixels."""
+
+    with rasterio.open(path) as src:
+        width, height = min(size, src.width), min(size, src.height)
+        cols = generator.integers(0, src.width - width + 1, num_reads)
+        rows = generator.integers(0, src.height - height + 1, num_reads)
+
+    return [Window(col, row, width, height) for col, row in zip(cols, rows)]
+
+
+def read_latency(path: str, window: Window) -> float:
+    """Returns the time (in seconds) taken to open a raster and read a window, as
+    the datasets do for every sample."""
+
+    start = time.perf_counter()
+    with rasterio.open(path) as src:
+        src.read(window=window)
+    return time.perf_counter() - start
+
+
+def benchmark(
+    before: str,
+    after: str,
+    patch_size: int = 256,
+    num_reads: int = 50,
+    pattern: str = "**/*.tif*",
+    seed: int = 0,
+) -> Dict[str, Tuple[float, float, float]]:
+    """Compares the latency of random patch reads between two copies of a dataset.
+
+    The same windows are read from each raster (with the same relative path) of both
+    roots, alternating which copy is read first so that neither benefits more from
+    the OS cache.
+    Args:
+        before: root of the original rasters.
+        after: root of the converted rasters.
+        patch_size: size of the windows read, in pixels.
+        num_reads: windows read per raster.
+        pattern: glob of the rasters to compare, relative to before.
+        seed: seed of the random windows.
+    Returns:
+        latency: mean, median and 95th percentile read times of each root, in ms.
+    """
+
+    generator = np.random.default_rng(seed)
+    times: Dict[str, List[float]] = {before: [], after: []}
+    for path in find_rasters(before, pattern):
+        other = os.path.join(after, os.path.relpath(path, before))
+        if not os.path.exists(other):
+            continue
+
+        windows = random_windows(path, patch_size, num_reads, generator)
+        for i, window in enumerate(windows):
+            pair = [(before, path), (after, other)]
+            for root, raster in pair if i % 2 == 0 else pair[::-1]:
+                times[root].append(read_latency(raster, window))
+
+    latency = {}
+    for root, root_times in times.items():
+        if not root_times:
+            raise ValueError(f"No rasters to compare were found in {root}.")
+        ms = 1000 * np.array(root_times)
+        latency[root] = (
+            float(ms.mean()),
+            float(np.median(ms)),
+            float(np.percentile(ms, 95)),
+        )
+
+    return latency
+
+
+if __name__ == "__main__":
+
+    from docopt import docopt
+
+    args = docopt(__doc__)
+    patch_size = int(args["--patch-size"])
+
+    if args["convert"]:
+        blocksize = args["--blocksize"]
+        counts = convert_root(
+            args["<root>"],
+            out=args["--out"],
+            patch_size=patch_size,
+            blocksize=None if blocksize is None else int(blocksize),
+            resampling=args["--resampling"],
+            workers=int(args["--workers"]),
+            pattern=args["--pattern"],
+        )
+        print(
+            f"Converted {counts['converted']}, skipped {counts['skipped']} and failed "
+            f"{counts['failed']} rasters."
+        )
+
+    elif args["benchmark"]:
+        latency = benchmark(
+            args["<before>"],
+            args["<after>"],
+            patch_size=patch_size,
+            num_reads=int(args["--reads"]),
+            pattern=args["--pattern"],
+            seed=int(args["--seed"]),
+        )
+        for root, (mean, median, p95) in latency.items():
+            print(
+                f"{root}: mean {mean:.2f} ms, median {median:.2f} ms, p95 {p95:.2f} ms"
+            )
@@ -1,7 +1,52 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from typing import Dict
+from typing import Dict, Union
+
+
+def one_hot(indices: torch.Tensor, num_classes: int) -> torch.Tensor:
+    """One-hot encodes class indices, in a single vectorized operation.
+
+    Args:
+        indices: tensor of class indices, of shape (..., 1, height, width)
+        num_classes: number of classes (indices must be in [0, num_classes))
+    Returns:
+        encodings: uint8 tensor of shape (..., num_classes, height, width)
+    """
+
+    encodings = F.one_hot(indices.squeeze(-3).long(), num_classes=num_classes)
+    return encodings.movedim(-1, -3).to(torch.uint8)
+
+
+def quantize(values: torch.Tensor, scale: Union[float, torch.Tensor]) -> torch.Tensor:
+    """Stores values in [0, 65535 / scale] compactly, as scaled uint16 integers.
+
+    torch has no uint16 type, so the integers are held in an int16 tensor, offset by
+    -32768. Values out of range are clipped, and NaNs stored as 0.
+    Args:
+        values: tensor to store, e.g. reflectances
+        scale: factor applied to the values before rounding them to integers, or a
+            tensor of factors broadcast against values (e.g. one per band)
+    Returns:
+        quantized: int16 tensor, of the same shape as values
+    """
+
+    scaled = torch.round(torch.nan_to_num(values.float()) * scale)
+    return (scaled.clamp(0, 65535) - 32768).to(torch.int16)
+
+
+def dequantize(
+    quantized: torch.Tensor, scale: Union[float, torch.Tensor]
+) -> torch.Tensor:
+    """Returns the float values of a tensor stored by quantize.
+
+    Args:
+        quantized: int16 tensor returned by quantize
+        scale: scale given to quantize, or a tensor of scales broadcast against
+            quantized (e.g. one per band)
+    """
+
+    return (quantized.float() + 32768) / scale
 
 
 class Binarize(nn.Module):
@@ -56,23 +101,10 @@ class OneHotEncode(nn.Module):
            'inputs': the sample or batch samples obtained from the DataLoader
         """
 
-        x_shape = inputs["mask"].shape
-
         # Minimum class value must be equal to zero
         inputs["mask"] = inputs["mask"] - min(self.classes.values())
 
-        # Remove the 'band' dimension since this is always of dimension 1
-        input_mask = torch.reshape(inputs["mask"], (x_shape[0], x_shape[2], x_shape[3]))
-
-        # Get the one-hot encodings, which are a tensor of: (batch_idx, lat, lon, band_idx)
-        encodings = F.one_hot(input_mask.to(torch.int64), num_classes=len(self.classes))
-
-        # Create a new mask, which is a tensor of: (batch_idx, band_idx, lat, lon)
-        new_mask = torch.zeros([x_shape[0], len(self.classes), x_shape[2], x_shape[3]])
-        for band_idx in range(0, len(self.classes)):
-            new_mask[:, band_idx, :, :] = encodings[:, :, :, band_idx]
-
-        # Write one-hot encodings to the output tensor
+        # One-hot encodings, which are a tensor of: (batch_idx, band_idx, lat, lon)
         outputs = inputs
-        outputs["mask"] = new_mask.to(torch.int32)
+        outputs["mask"] = one_hot(inputs["mask"], len(self.classes)).to(torch.int32)
         return outputs
@@ -1,3 +1,35 @@
-from .custom_samplers import ConstrainedRandomBatchGeoSampler
+from .burn_index import BurnIndex
+from .catalogue import PatchCatalogue, SampleCatalogue
+from .footprint import FootprintIndex
+from .prefetch import PrefetchBatchSampler, PrefetchStats
+from .scheduler import TileScheduler
+from .stats import SamplerStats
+from .custom_samplers import (
+    AdaptiveConstrainedRandomBatchGeoSampler,
+    BurnWeightedBatchGeoSampler,
+    CatalogueBatchGeoSampler,
+    ConstrainedRandomBatchGeoSampler,
+    SeededRandomBatchGeoSampler,
+    SnappedGridGeoSampler,
+    StagedRandomBatchGeoSampler,
+    VectorizedConstrainedRandomBatchGeoSampler,
+)
 
-__all__ = ("ConstrainedRandomBatchGeoSampler",)
+__all__ = (
+    "AdaptiveConstrainedRandomBatchGeoSampler",
+    "BurnIndex",
+    "BurnWeightedBatchGeoSampler",
+    "CatalogueBatchGeoSampler",
+    "ConstrainedRandomBatchGeoSampler",
+    "FootprintIndex",
+    "PatchCatalogue",
+    "PrefetchBatchSampler",
+    "PrefetchStats",
+    "SampleCatalogue",
+    "SamplerStats",
+    "SeededRandomBatchGeoSampler",
+    "SnappedGridGeoSampler",
+    "StagedRandomBatchGeoSampler",
+    "TileScheduler",
+    "VectorizedConstrainedRandomBatchGeoSampler",
+)
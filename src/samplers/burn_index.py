@@ -0,0 +1,259 @@
+import hashlib
+import math
+import os
+import numpy as np
+from typing import List, Optional, Tuple
+from rasterio.windows import Window
+from rtree.index import Index, Property
+from torchgeo.datasets import BoundingBox, GeoDataset
+
+from ..datasets import MODIS_JD
+from ..datasets.geo import dataset_files, leaf_datasets, open_warp_file
+
+# Tolerance (in pixels) used when converting coordinates to pixel edges, so that
+# boxes lying exactly on the MODIS grid do not pick up an extra row/column
+_EPS = 1e-6
+
+
+class BurnIndex:
+    """Per-tile, per-month summed-area tables (integral images) of burned MODIS_JD pixels.
+
+    The tables are built once at the native MODIS resolution and clipped to the region
+    of interest. The number of burned pixels within any bounding box is then found with
+    four lookups, instead of reading every source of the IntersectionDataset.
+    Note: counts are made on the MODIS grid, so every MODIS pixel touched by a bounding
+    box is included in its burn proportion.
+    The index keeps the roi and a fingerprint of the MODIS files (see get_fingerprint)
+    it was built from, so that a saved index is only reused for the same data.
+
+    Args:
+        dataset: dataset containing MODIS_JD data (e.g. landcover & modis).
+        roi: region of interest to index (defaults to the bounds of the dataset).
+    """
+
+    def __init__(
+        self,
+        dataset: Optional[GeoDataset] = None,
+        roi: Optional[BoundingBox] = None,
+    ) -> None:
+
+        # Each table is stored with its bounds, grid origin/res (x0, y0, xres, yres)
+        # and shape. Tables of tiles without any burned pixels are stored as None.
+        self.index = Index(interleaved=False, properties=Property(dimension=3))
+        self.bounds: List[Tuple[float, ...]] = []
+        self.origins: List[Tuple[float, ...]] = []
+        self.shapes: List[Tuple[int, int]] = []
+        self.tables: List[Optional[np.ndarray]] = []
+        self.roi = None
+        self.fingerprint = ""
+
+        if dataset is not None:
+            self.roi = tuple(roi if roi is not None else dataset.bounds)
+            self.fingerprint = self.get_fingerprint(dataset)
+            self._populate(dataset, BoundingBox(*self.roi))
+
+    @staticmethod
+    def modis_datasets(dataset: GeoDataset) -> List[MODIS_JD]:
+        """Returns the MODIS_JD datasets of a dataset, e.g. landcover & modis."""
+
+        modis_datasets = [
+            ds for ds in leaf_datasets(dataset) if isinstance(ds, MODIS_JD)
+        ]
+        if not modis_datasets:
+            raise ValueError("BurnIndex requires a dataset containing MODIS_JD data.")
+        return modis_datasets
+
+    @classmethod
+    def get_fingerprint(cls, dataset: GeoDataset) -> str:
+        """Returns a fingerprint of the MODIS_JD files (paths, sizes and modification
+        times) of a dataset."""
+
+        digest = hashlib.sha1()
+        for modis in cls.modis_datasets(dataset):
+            for filepath in dataset_files(modis):
+                stat = os.stat(filepath)
+                digest.update(f"{filepath}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        return digest.hexdigest()
+
+    def _populate(self, dataset: GeoDataset, roi: BoundingBox) -> None:
+        """Builds a summed-area table for every MODIS_JD file intersecting the roi."""
+
+        for modis in self.modis_datasets(dataset):
+            for hit in modis.index.intersection(tuple(roi), objects=True):
+                bounds = BoundingBox(*hit.bounds) & roi
+
+                # Read the (CRS-warped) file at its native resolution, within the roi
+                with open_warp_file(modis, hit.object) as src:
+                    t = src.transform
+                    col0 = max(math.floor((bounds.minx - t.c) / t.a + _EPS), 0)
+                    col1 = min(math.ceil((bounds.maxx - t.c) / t.a - _EPS), src.width)
+                    row0 = max(math.floor((t.f - bounds.maxy) / -t.e + _EPS), 0)
+                    row1 = min(math.ceil((t.f - bounds.miny) / -t.e - _EPS), src.height)
+                    if col1 <= col0 or row1 <= row0:
+                        continue
+                    window = Window(col0, row0, col1 - col0, row1 - row0)
+                    burned = src.read(1, window=window) > 0
+
+                origin = (t.c + col0 * t.a, t.f + row0 * t.e, t.a, -t.e)
+                self.add(tuple(bounds), origin, self.summed_area_table(burned))
+
+    @staticmethod
+    def summed_area_table(burned: np.ndarray) -> Optional[np.ndarray]:
+        """Returns the zero-padded summed-area table of a boolean burn raster.
+
+        Returns:
+            table: (H + 1, W + 1) array of cumulative counts, or None if nothing burned.
+        """
+
+        total = int(burned.sum())
+        if total == 0:
+            return None
+
+        # Cumulative counts never exceed the total, so use the smallest dtype that fits
+        dtype = np.uint16 if total <= np.iinfo(np.uint16).max else np.uint32
+        table = np.zeros((burned.shape[0] + 1, burned.shape[1] + 1), dtype=dtype)
+        table[1:, 1:] = burned.cumsum(axis=0, dtype=dtype).cumsum(axis=1, dtype=dtype)
+        return table
+
+    def add(
+        self,
+        bounds: Tuple[float, ...],
+        origin: Tuple[float, ...],
+        table: Optional[np.ndarray],
+        shape: Optional[Tuple[int, int]] = None,
+    ) -> None:
+        """Adds a summed-area table covering 'bounds' to the index."""
+
+        if shape is None:
+            shape = (table.shape[0] - 1, table.shape[1] - 1)
+
+        self.index.insert(len(self.tables), tuple(bounds))
+        self.bounds.append(tuple(bounds))
+        self.origins.append(tuple(origin))
+        self.shapes.append(tuple(shape))
+        self.tables.append(table)
+
+    def count(
+        self,
+        i: int,
+        minx: np.ndarray,
+        maxx: np.ndarray,
+        miny: np.ndarray,
+        maxy: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the burned and total MODIS pixel counts of boxes within table 'i'.
+
+        All coordinate arguments may be scalars or arrays of the same shape.
+
+        Returns:
+            burned: number of burned pixels within each box.
+            total: number of pixels within each box (clipped to the table).
+        """
+
+        x0, y0, xres, yres = self.origins[i]
+        height, width = self.shapes[i]
+
+        # Convert the box edges into the pixel edges of the table
+        col0 = np.floor((minx - x0) / xres + _EPS).clip(0, width).astype(np.int64)
+        col1 = np.ceil((maxx - x0) / xres - _EPS).clip(col0, width).astype(np.int64)
+        row0 = np.floor((y0 - maxy) / yres + _EPS).clip(0, height).astype(np.int64)
+        row1 = np.ceil((y0 - miny) / yres - _EPS).clip(row0, height).astype(np.int64)
+        total = (row1 - row0) * (col1 - col0)
+
+        table = self.tables[i]
+        if table is None:
+            return np.zeros_like(total), total
+
+        burned = (
+            table[row1, col1].astype(np.int64)
+            - table[row0, col1]
+            - table[row1, col0]
+            + table[row0, col0]
+        )
+        return burned, total
+
+    def patch_counts(
+        self, i: int, bounds: BoundingBox, size: Tuple[float, float]
+    ) -> Tuple[float, float, np.ndarray]:
+        """Returns the burned pixel counts of every patch aligned to the grid of table 'i'.
+
+        Only patches lying entirely within both 'bounds' and the table are counted.
+
+        Args:
+            i: the table to use.
+            bounds: area that the patches must lie within.
+            size: (height, width) of the patches in CRS units.
+        Returns:
+            minx: left edge of the first patch.
+            maxy: top edge of the first patch.
+            burned: (rows, cols) array of burned pixel counts, one per patch origin.
+        """
+
+        x0, y0, xres, yres = self.origins[i]
+        tminx, tmaxx, tminy, tmaxy = self.bounds[i][:4]
+        minx, maxx = max(bounds.minx, tminx), min(bounds.maxx, tmaxx)
+        miny, maxy = max(bounds.miny, tminy), min(bounds.maxy, tmaxy)
+
+        # Patch origins (top-left corners) on the table grid
+        col0 = math.ceil((minx - x0) / xres - _EPS)
+        col1 = math.floor((maxx - size[1] - x0) / xres + _EPS)
+        row0 = math.ceil((y0 - maxy) / yres - _EPS)
+        row1 = math.floor((y0 - miny - size[0]) / yres + _EPS)
+        left = x0 + np.arange(col0, col1 + 1)[None, :] * xres
+        top = y0 - np.arange(row0, row1 + 1)[:, None] * yres
+
+        burned, _ = self.count(i, left, left + size[1], top - size[0], top)
+        return x0 + col0 * xres, y0 - row0 * yres, burned
+
+    def burned_pixels(self, bounding_box: BoundingBox) -> Tuple[int, int]:
+        """Returns the burned and total MODIS pixel counts within a bounding box."""
+
+        burned, total = 0, 0
+        for i in self.index.intersection(tuple(bounding_box)):
+            b, t = self.count(
+                i,
+                bounding_box.minx,
+                bounding_box.maxx,
+                bounding_box.miny,
+                bounding_box.maxy,
+            )
+            burned += int(b)
+            total += int(t)
+        return burned, total
+
+    def burn_proportion(self, bounding_box: BoundingBox) -> float:
+        """Returns the burn proportion found within a given bounding box."""
+
+        burned, total = self.burned_pixels(bounding_box)
+        return burned / total if total > 0 else 0.0
+
+    def save(self, path: str) -> None:
+        """Saves the index to a compressed .npz file."""
+
+        arrays = {
+            "roi": np.array(self.roi if self.roi is not None else [], dtype=float),
+            "fingerprint": np.array(self.fingerprint),
+            "bounds": np.array(self.bounds, dtype=float).reshape(-1, 6),
+            "origins": np.array(self.origins, dtype=float).reshape(-1, 4),
+            "shapes": np.array(self.shapes, dtype=np.int64).reshape(-1, 2),
+        }
+        for i, table in enumerate(self.tables):
+            if table is not None:
+                arrays[f"table_{i}"] = table
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> "BurnIndex":
+        """Loads an index previously written with BurnIndex.save."""
+
+        burn_index = cls()
+        with np.load(path) as data:
+            burn_index.roi = tuple(data["roi"]) if data["roi"].size else None
+            if "fingerprint" in data.files:
+                burn_index.fingerprint = str(data["fingerprint"])
+            for i, (bounds, origin, shape) in enumerate(
+                zip(data["bounds"], data["origins"], data["shapes"])
+            ):
+                table = data[f"table_{i}"] if f"table_{i}" in data.files else None
+                burn_index.add(tuple(bounds), tuple(origin), table, tuple(shape))
+        return burn_index
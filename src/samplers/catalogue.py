@@ -0,0 +1,408 @@
+import hashlib
+import os
+import numpy as np
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+from torchgeo.datasets import BoundingBox, GeoDataset
+from torchgeo.samplers.constants import Units
+from torchgeo.samplers.utils import _to_tuple
+
+from ..datasets import LandcoverComplex, LandcoverSimple, MODIS_JD
+from ..datasets.geo import dataset_files, leaf_datasets, read_raw, without_transforms
+
+
+class SampleCatalogue:
+    """Columnar table of accepted samples, saved to disk so that the (expensive) search
+    for balanced samples only has to be carried out once for a dataset.
+
+    Each row is a bounding box (minx, maxx, miny, maxy, mint, maxt), with the burn
+    proportion found within it and the tile (index of the sampler hit) it was drawn
+    from. The dates of a sample are given by its mint/maxt.
+    Args:
+        boxes: (N, 6) array of minx, maxx, miny, maxy, mint, maxt coordinates.
+        burn_prop: (N,) array of burn proportions.
+        tile: (N,) array of tile numbers.
+        fingerprint: fingerprint of the data/settings the samples were drawn with.
+    """
+
+    def __init__(
+        self,
+        boxes: np.ndarray,
+        burn_prop: np.ndarray,
+        tile: np.ndarray,
+        fingerprint: str = "",
+    ) -> None:
+
+        self.boxes = np.asarray(boxes, dtype=float).reshape(-1, 6)
+        self.burn_prop = np.asarray(burn_prop, dtype=np.float32)
+        self.tile = np.asarray(tile, dtype=np.int32)
+        self.fingerprint = fingerprint
+
+    def __len__(self) -> int:
+        return len(self.boxes)
+
+    @property
+    def burned(self) -> np.ndarray:
+        """Returns the row numbers of the samples containing burned pixels."""
+
+        return np.flatnonzero(self.burn_prop > 0)
+
+    @property
+    def not_burned(self) -> np.ndarray:
+        """Returns the row numbers of the samples without any burned pixels."""
+
+        return np.flatnonzero(self.burn_prop == 0)
+
+    def bounding_boxes(self, rows: np.ndarray) -> List[BoundingBox]:
+        """Returns the bounding boxes of the given rows."""
+
+        return [BoundingBox(*box) for box in self.boxes[rows].tolist()]
+
+    @staticmethod
+    def get_fingerprint(
+        dataset: GeoDataset,
+        roi: BoundingBox,
+        size: Union[Tuple[float, float], float],
+        units: Units,
+    ) -> str:
+        """Returns a fingerprint of the dataset files and sampler settings.
+
+        Catalogues are only reused if none of the files (paths, sizes or modification
+        times), the roi, the patch size or the units have changed.
+        """
+
+        digest = hashlib.sha1()
+        for filepath in dataset_files(dataset):
+            stat = os.stat(filepath)
+            digest.update(f"{filepath}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        digest.update(repr((tuple(roi), size, units.name, dataset.res)).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def get_path(directory: str, fingerprint: str) -> str:
+        """Returns the path of the catalogue with the given fingerprint."""
+
+        return os.path.join(directory, f"catalogue_{fingerprint[:16]}.npz")
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """Returns the columns of the catalogue, as saved to disk."""
+
+        return {
+            "boxes": self.boxes,
+            "burn_prop": self.burn_prop,
+            "tile": self.tile,
+            "fingerprint": np.array(self.fingerprint),
+        }
+
+    def save(self, path: str) -> None:
+        """Saves the catalogue to a .npz file.
+
+        The file is written under a temporary name first, so that processes running in
+        parallel never read a partially written catalogue.
+        """
+
+        tmp_path = f"{path[:-len('.npz')]}_{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, **self.arrays())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(
+        cls, path: str, fingerprint: Optional[str] = None
+    ) -> Optional["SampleCatalogue"]:
+        """Loads a catalogue written with save.
+
+        Returns:
+            catalogue: the catalogue, or None if the file does not exist or was made
+                with a different fingerprint.
+        """
+
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as data:
+            arrays = {key: data[key] for key in data.files}
+        catalogue = cls(fingerprint=str(arrays.pop("fingerprint")), **arrays)
+
+        if fingerprint is not None and catalogue.fingerprint != fingerprint:
+            return None
+        return catalogue
+
+
+class PatchCatalogue(SampleCatalogue):
+    """SampleCatalogue of every patch on a regular grid, with label, cloud, landcover
+    and coverage statistics, built by sweeping a dataset once (see build).
+
+    Besides the SampleCatalogue columns (where burn_prop is the burned fraction of the
+    MODIS pixels), each patch has the columns:
+        - unobserved: fraction of MODIS pixels that were not observed (-1), e.g. cloud
+        - nonburnable: fraction of MODIS pixels that are not burnable (-2)
+        - landcover: (N, C) fraction of the pixels of each landcover class
+        - coverage_<dataset>: fraction of the pixels of an image dataset with data
+    Rows are selected by the range of their columns with 'query', so that samplers can
+    filter and stratify the patches without reading any rasters.
+    Args:
+        boxes: (N, 6) array of minx, maxx, miny, maxy, mint, maxt coordinates.
+        burn_prop: (N,) array of burned fractions.
+        tile: (N,) array of the dataset hits (tiles) holding each patch.
+        fingerprint: fingerprint of the data/settings the patches were made with.
+        **columns: the other columns, as arrays with N rows.
+    """
+
+    def __init__(
+        self,
+        boxes: np.ndarray,
+        burn_prop: np.ndarray,
+        tile: np.ndarray,
+        fingerprint: str = "",
+        **columns: np.ndarray,
+    ) -> None:
+
+        super().__init__(boxes, burn_prop, tile, fingerprint)
+        self.columns = {name: np.asarray(column) for name, column in columns.items()}
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.namespace()[name]
+
+    def namespace(self) -> Dict[str, np.ndarray]:
+        """Returns every column by name, with 2D columns also split into 'name_k'."""
+
+        namespace = dict(
+            zip(("minx", "maxx", "miny", "maxy", "mint", "maxt"), self.boxes.T)
+        )
+        namespace.update(burn_prop=self.burn_prop, tile=self.tile)
+        for name, column in self.columns.items():
+            namespace[name] = column
+            if column.ndim == 2:
+                for k in range(column.shape[1]):
+                    namespace[f"{name}_{k}"] = column[:, k]
+        return namespace
+
+    def subset(self, rows: np.ndarray) -> "PatchCatalogue":
+        """Returns a catalogue of the given rows (indices or boolean mask)."""
+
+        columns = {name: column[rows] for name, column in self.columns.items()}
+        return PatchCatalogue(
+            self.boxes[rows],
+            self.burn_prop[rows],
+            self.tile[rows],
+            self.fingerprint,
+            **columns,
+        )
+
+    def query(self, filters: Dict[str, Sequence[Optional[float]]]) -> "PatchCatalogue":
+        """Returns the patches whose columns lie within the given ranges.
+
+        Args:
+            filters: (min, max) range of each column (inclusive), where None leaves
+                that side open, e.g. {"unobserved": (None, 0.2), "burn_prop": (0.01,
+                None)}. The columns of 2D columns are named 'name_k', e.g.
+                "landcover_8".
+        Returns:
+            catalogue: the patches within every range.
+        Raises:
+            ValueError: if a filter names an unknown (or 2D) column, or is not a
+                (min, max) pair.
+        """
+
+        namespace = self.namespace()
+        rows = np.ones(len(self), dtype=bool)
+        for name, limits in filters.items():
+            column = namespace.get(name)
+            if column is None or column.ndim != 1:
+                names = sorted(k for k, v in namespace.items() if v.ndim == 1)
+                raise ValueError(f"Unknown column '{name}', expected one of {names}.")
+            if len(limits) != 2:
+                raise ValueError(f"The filter of '{name}' must be a (min, max) pair.")
+
+            low, high = limits
+            if low is not None:
+                rows &= column >= low
+            if high is not None:
+                rows &= column <= high
+
+        return self.subset(rows)
+
+    @staticmethod
+    def get_fingerprint(
+        dataset: GeoDataset,
+        roi: BoundingBox,
+        size: Union[Tuple[float, float], float],
+        units: Units,
+        stride: Optional[Union[Tuple[float, float], float]] = None,
+        blocksize: int = 32,
+    ) -> str:
+        """Returns a fingerprint of the dataset files and the settings of build.
+
+        As SampleCatalogue.get_fingerprint, also keyed by the stride and blocksize.
+        """
+
+        digest = hashlib.sha1(
+            SampleCatalogue.get_fingerprint(dataset, roi, size, units).encode()
+        )
+        digest.update(repr((stride, blocksize)).encode())
+        return digest.hexdigest()
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """Returns the columns of the catalogue, as saved to disk."""
+
+        return {**super().arrays(), **self.columns}
+
+    @staticmethod
+    def patch_fractions(
+        values: np.ndarray,
+        rows: np.ndarray,
+        cols: np.ndarray,
+        size: Tuple[int, int],
+    ) -> np.ndarray:
+        """Returns the fraction of each patch in which a boolean raster is True.
+
+        Args:
+            values: (H, W) boolean raster.
+            rows: pixel rows of the patch origins (top edges).
+            cols: pixel columns of the patch origins (left edges).
+            size: (height, width) of the patches in pixels.
+        Returns:
+            fractions: (len(rows) * len(cols),) fractions, in row-major order.
+        """
+
+        table = np.zeros((values.shape[0] + 1, values.shape[1] + 1))
+        table[1:, 1:] = values.cumsum(axis=0).cumsum(axis=1)
+
+        bottom, right = rows + size[0], cols + size[1]
+        sums = (
+            table[np.ix_(bottom, right)]
+            - table[np.ix_(rows, right)]
+            - table[np.ix_(bottom, cols)]
+            + table[np.ix_(rows, cols)]
+        )
+        return (sums / (size[0] * size[1])).ravel()
+
+    @classmethod
+    def build(
+        cls,
+        dataset: GeoDataset,
+        size: Union[Tuple[float, float], float],
+        stride: Optional[Union[Tuple[float, float], float]] = None,
+        roi: Optional[BoundingBox] = None,
+        units: Units = Units.PIXELS,
+        blocksize: int = 32,
+    ) -> "PatchCatalogue":
+        """Sweeps a dataset on a regular grid of patches, recording their statistics.
+
+        Every tile (hit) of the dataset is read in blocks of up to 'blocksize' x
+        'blocksize' patches, with one read per source. The statistics of all the
+        patches in a block are then found at once from summed-area tables.
+        Args:
+            dataset: dataset containing MODIS_JD and landcover data (and optionally
+                other image datasets), e.g. landcover & modis & sentinel.
+            size: (height, width) of the patches.
+            stride: distance between patch origins (defaults to the patch size).
+            roi: region of interest to sweep (defaults to the bounds of the dataset).
+            units: Units.<PIXELS/CRS> depending on if size/stride are in pixels or
+                lat/lon.
+            blocksize: number of patches read at once along each axis.
+        Returns:
+            catalogue: the statistics of every patch.
+        """
+
+        res = dataset.res
+        size = _to_tuple(size)
+        stride = _to_tuple(stride) if stride is not None else size
+        if units == Units.CRS:
+            size = (size[0] / res, size[1] / res)
+            stride = (stride[0] / res, stride[1] / res)
+        size = (round(size[0]), round(size[1]))
+        stride = (round(stride[0]), round(stride[1]))
+        roi = roi if roi is not None else dataset.bounds
+
+        # Read the sources without their transforms, to get the raw values
+        leaves = [without_transforms(ds) for ds in leaf_datasets(dataset)]
+        modis = [ds for ds in leaves if isinstance(ds, MODIS_JD)]
+        landcover = [
+            ds for ds in leaves if isinstance(ds, (LandcoverSimple, LandcoverComplex))
+        ]
+        if not modis or not landcover:
+            raise ValueError("PatchCatalogue requires MODIS_JD and landcover data.")
+        num_classes = max(landcover[0].classifications.values()) + 1
+        images = [ds for ds in leaves if ds.is_image]
+
+        columns: Dict[str, List[np.ndarray]] = {
+            name: []
+            for name in ["boxes", "burn_prop", "tile", "unobserved", "nonburnable"]
+            + ["landcover"]
+            + [f"coverage_{type(ds).__name__}" for ds in images]
+        }
+        for tile, hit in enumerate(
+            dataset.index.intersection(tuple(roi), objects=True)
+        ):
+            bounds = BoundingBox(*hit.bounds) & roi
+            height = int((bounds.maxy - bounds.miny) / res + 1e-6)
+            width = int((bounds.maxx - bounds.minx) / res + 1e-6)
+            num_rows = max((height - size[0]) // stride[0] + 1, 0)
+            num_cols = max((width - size[1]) // stride[1] + 1, 0)
+
+            for r0 in range(0, num_rows, blocksize):
+                for c0 in range(0, num_cols, blocksize):
+                    rows = np.arange(r0, min(r0 + blocksize, num_rows)) * stride[0]
+                    cols = np.arange(c0, min(c0 + blocksize, num_cols)) * stride[1]
+
+                    # Read the block containing these patches from every source
+                    query = BoundingBox(
+                        bounds.minx + cols[0] * res,
+                        bounds.minx + (cols[-1] + size[1]) * res,
+                        bounds.maxy - (rows[-1] + size[0]) * res,
+                        bounds.maxy - rows[0] * res,
+                        bounds.mint,
+                        bounds.maxt,
+                    )
+                    rows, cols = rows - rows[0], cols - cols[0]
+
+                    julian_day = read_raw(modis[0], query)[0]
+                    for name, values in [
+                        ("burn_prop", julian_day > 0),
+                        ("unobserved", julian_day == -1),
+                        ("nonburnable", julian_day == -2),
+                    ]:
+                        columns[name].append(
+                            cls.patch_fractions(values, rows, cols, size)
+                        )
+
+                    classes = read_raw(landcover[0], query)[0]
+                    histogram = [
+                        cls.patch_fractions(classes == k, rows, cols, size)
+                        for k in range(num_classes)
+                    ]
+                    columns["landcover"].append(np.stack(histogram, axis=1))
+
+                    for ds in images:
+                        try:
+                            valid = (read_raw(ds, query) != 0).any(axis=0)
+                        except IndexError:
+                            valid = np.zeros(julian_day.shape, dtype=bool)
+                        columns[f"coverage_{type(ds).__name__}"].append(
+                            cls.patch_fractions(valid, rows, cols, size)
+                        )
+
+                    # Bounding box and tile of each patch
+                    top, left = np.meshgrid(
+                        query.maxy - rows * res, query.minx + cols * res, indexing="ij"
+                    )
+                    top, left = top.ravel(), left.ravel()
+                    columns["boxes"].append(
+                        np.stack(
+                            [
+                                left,
+                                left + size[1] * res,
+                                top - size[0] * res,
+                                top,
+                                np.full(len(left), bounds.mint),
+                                np.full(len(left), bounds.maxt),
+                            ],
+                            axis=1,
+                        )
+                    )
+                    columns["tile"].append(np.full(len(left), tile))
+
+        if not columns["boxes"]:
+            raise ValueError("No patches fit within the roi.")
+
+        return cls(**{name: np.concatenate(column) for name, column in columns.items()})
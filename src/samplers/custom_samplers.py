@@ -1,14 +1,255 @@
 import numpy as np
-import random
 import math
-from typing import Optional, Iterator, Union, Tuple, List
-from torchgeo.datasets import BoundingBox, IntersectionDataset
-from torchgeo.samplers import RandomBatchGeoSampler
-from torchgeo.samplers.utils import get_random_bounding_box
+import time
+import warnings
+import torch.distributed as dist
+from typing import Any, Dict, Optional, Iterator, Union, Tuple, List
+from torchgeo.datasets import BoundingBox, GeoDataset, IntersectionDataset
+from torchgeo.samplers import GridGeoSampler, RandomBatchGeoSampler
 from torchgeo.samplers.constants import Units
 
+from ..datasets import LandcoverComplex, LandcoverSimple, MODIS_JD
+from ..datasets.geo import (
+    LabelledBoundingBox,
+    PixelGrid,
+    leaf_datasets,
+    read_raw,
+    without_transforms,
+)
+from .burn_index import BurnIndex
+from .catalogue import SampleCatalogue
+from .footprint import FootprintIndex
+from .scheduler import TileScheduler
+from .stats import SamplerStats
 
-class ConstrainedRandomBatchGeoSampler(RandomBatchGeoSampler):
+
+class SeededRandomBatchGeoSampler(RandomBatchGeoSampler):
+    """Returns random batches of samples (as RandomBatchGeoSampler does), drawn with a
+    seeded, epoch-aware random generator and split across distributed processes.
+
+    The batches of an epoch only depend on the seed, the epoch and the process rank, so
+    epochs are reproducible and each of the 'num_replicas' (DDP) processes draws its own
+    length/num_replicas samples instead of duplicating work. The position within an
+    epoch can be saved with 'state_dict' and restored with 'load_state_dict'.
+    Note: batches are produced in the main process of each rank, so DataLoader workers
+    never receive the same batch. The work done to draw them is recorded in 'stats'.
+    Args:
+        dataset: the dataset to take samples from.
+        size: size of patch in lat/lon.
+        batch_size: the number of samples per batch.
+        length: number of samples (in total, over all processes) to take per epoch.
+        roi: region of interest to take samples from.
+        units: Units.<PIXELS/CRS> depending on if patch size is in pixels or lat/lon
+        seed: random seed, which should be the same for all processes (random if None).
+        rank: rank of this process (defaults to the torch.distributed rank, or 0).
+        num_replicas: number of processes (defaults to the torch.distributed world
+            size, or 1).
+        snap: set True to align patches with the pixel grid of the first (reference)
+            dataset, e.g. landcover, so that they are read without resampling.
+        footprint: FootprintIndex of where every source has data, which patches must
+            lie within (anywhere in the roi if None).
+    """
+
+    # Draws of the boxes outside the footprint before giving up
+    footprint_draws = 1000
+
+    def __init__(
+        self,
+        dataset: GeoDataset,
+        size: Union[Tuple[float, float], float],
+        batch_size: int,
+        length: int,
+        roi: Optional[BoundingBox] = None,
+        units: Units = Units.PIXELS,
+        seed: Optional[int] = None,
+        rank: Optional[int] = None,
+        num_replicas: Optional[int] = None,
+        snap: bool = False,
+        footprint: Optional[FootprintIndex] = None,
+    ) -> None:
+
+        # Use init from RandomBatchGeoSampler parent class
+        super().__init__(dataset, size, batch_size, length, roi, units)
+
+        # Use the process group (if any) to find our share of the samples
+        distributed = dist.is_available() and dist.is_initialized()
+        if rank is None:
+            rank = dist.get_rank() if distributed else 0
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if distributed else 1
+
+        self.seed = seed if seed is not None else np.random.SeedSequence().entropy
+        self.rank = rank
+        self.num_replicas = num_replicas
+
+        # Patch sizes (and origins) are a whole number of reference pixels
+        self.grid = PixelGrid.from_dataset(dataset) if snap else None
+        if self.grid is not None:
+            self.size = self.grid.snap_size(self.size)
+
+        # Tiles are chosen with a probability proportional to their area, or to the
+        # room for patches within the footprint (dropping tiles with no room)
+        self.footprint = footprint
+        if footprint is not None:
+            positions = [
+                footprint.patch_positions(BoundingBox(*hit.bounds), self.size)
+                for hit in self.hits
+            ]
+            self.hits = [hit for hit, n in zip(self.hits, positions) if n > 0]
+            if not self.hits:
+                raise ValueError("No patch fits within the footprint of the roi.")
+            areas = np.array([n for n in positions if n > 0], dtype=float)
+        else:
+            areas = self.areas.double().numpy()
+        self.tile_weights = areas / areas.sum()
+
+        # Position within the current epoch
+        self.epoch = 0
+        self.batches_yielded = 0
+        self.start_batch = 0
+        self.generator = self.get_generator()
+        self.stats = SamplerStats()
+
+    def get_generator(self) -> np.random.Generator:
+        """Returns the random generator for the current epoch and rank."""
+
+        return np.random.default_rng([self.seed, self.epoch, self.rank])
+
+    def set_epoch(self, epoch: int) -> None:
+        """Sets the epoch used to seed the next iteration of the sampler."""
+
+        self.epoch = epoch
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Returns the state needed to resume sampling from the current position."""
+
+        return {
+            "seed": self.seed,
+            "epoch": self.epoch,
+            "batches_yielded": self.batches_yielded,
+        }
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """Restores a state returned by state_dict.
+
+        The next iteration continues the saved epoch, after the batches already yielded.
+        """
+
+        self.seed = state_dict["seed"]
+        self.epoch = state_dict["epoch"]
+        self.start_batch = state_dict["batches_yielded"]
+
+    def __iter__(self) -> Iterator[List[BoundingBox]]:
+        """Defines a generator function to produce batches of areas to sample next.
+
+        Returns:
+            List((minx, maxx, miny, maxy, mint, maxt)) coordinates to index a dataset
+        """
+
+        self.generator = self.get_generator()
+        self.stats.reset()
+        for i in range(len(self)):
+            start = time.perf_counter()
+            batch = self.get_batch()
+            self.stats.add_batch(time.perf_counter() - start)
+
+            # Skip the batches that were used before the sampler state was restored
+            if i < self.start_batch:
+                continue
+
+            self.batches_yielded = i + 1
+            yield batch
+
+        # Move on to the next epoch (unless set_epoch is called before then)
+        self.batches_yielded = 0
+        self.start_batch = 0
+        self.epoch += 1
+
+    def __len__(self) -> int:
+        """Returns the number of batches drawn by this process in a single epoch."""
+
+        return self.length // self.batch_size // self.num_replicas
+
+    def get_batch(self) -> List[BoundingBox]:
+        """Returns a batch of random samples from a random tile."""
+
+        bounds = self.get_random_tile()
+        return self.to_bounding_boxes(
+            bounds, self.get_random_coordinates(bounds, self.batch_size)
+        )
+
+    def get_random_tile(self) -> BoundingBox:
+        """Returns the bounds of a random tile, weighted by area."""
+
+        hit = self.hits[self.generator.choice(len(self.hits), p=self.tile_weights)]
+        return BoundingBox(*hit.bounds)
+
+    def get_random_coordinates(self, bounds: BoundingBox, num: int) -> np.ndarray:
+        """Returns the coordinates of 'num' random bounding boxes within 'bounds' (and
+        the footprint, if any).
+
+        Returns:
+            coordinates: (4, num) array of minx, maxx, miny, maxy coordinates
+        Raises:
+            RuntimeError: if boxes are still outside the footprint after
+                'footprint_draws' draws.
+        """
+
+        coordinates = self.draw_coordinates(bounds, num)
+        if self.footprint is None:
+            return coordinates
+
+        # Boxes outside the footprint are drawn again, which needs no reads
+        for _ in range(self.footprint_draws):
+            outside = ~self.footprint.contains(*coordinates, bounds.mint, bounds.maxt)
+            if not outside.any():
+                return coordinates
+            coordinates[:, outside] = self.draw_coordinates(bounds, int(outside.sum()))
+
+        raise RuntimeError(
+            f"No patches within the footprint were found in {bounds} after "
+            f"{self.footprint_draws} draws."
+        )
+
+    def draw_coordinates(self, bounds: BoundingBox, num: int) -> np.ndarray:
+        """Returns the coordinates of 'num' random bounding boxes within 'bounds'."""
+
+        # Draw whole pixel offsets from the first grid line within the tile
+        if self.grid is not None:
+            bounds = self.grid.inner_bounds(bounds)
+            res = self.grid.res
+            width = max(round((bounds.maxx - bounds.minx - self.size[1]) / res), 0)
+            height = max(round((bounds.maxy - bounds.miny - self.size[0]) / res), 0)
+            minx = bounds.minx + self.generator.integers(width + 1, size=num) * res
+            miny = bounds.miny + self.generator.integers(height + 1, size=num) * res
+            return np.stack([minx, minx + self.size[1], miny, miny + self.size[0]])
+
+        # Same as torchgeo's get_random_bounding_box, for many boxes at once
+        width = (bounds.maxx - bounds.minx - self.size[1]) // self.res
+        height = (bounds.maxy - bounds.miny - self.size[0]) // self.res
+
+        minx = np.full(num, bounds.minx)
+        miny = np.full(num, bounds.miny)
+        if width > 0:
+            minx += self.generator.random(num) * width * self.res
+        if height > 0:
+            miny += self.generator.random(num) * height * self.res
+
+        return np.stack([minx, minx + self.size[1], miny, miny + self.size[0]])
+
+    @staticmethod
+    def to_bounding_boxes(
+        bounds: BoundingBox, coordinates: np.ndarray
+    ) -> List[BoundingBox]:
+        """Converts (4, N) coordinates within a tile into bounding boxes."""
+
+        return [
+            BoundingBox(*coordinate.tolist(), bounds.mint, bounds.maxt)
+            for coordinate in coordinates.T
+        ]
+
+
+class ConstrainedRandomBatchGeoSampler(SeededRandomBatchGeoSampler):
     """Returns batches of samples that meet the constraints specified:
         1. Proportion of samples with a burn proportion > 0 : 'burn_prop'
         2. The rest of the samples will make up 1-'burn_prop' proportion and have a sample burn proportion = 0
@@ -20,8 +261,25 @@ class ConstrainedRandomBatchGeoSampler(RandomBatchGeoSampler):
         burn_prop: proportion of returned samples present that are "burned". "burned" is defined as > 0 burned pixels.
         roi: region of interest to take samples from.
         units: Units.<PIXELS/CRS> depending on if patch size is in pixels or lat/lon
+        burn_index: precomputed BurnIndex used to look up burn proportions. If None, the
+            dataset itself is read for every candidate sample.
+        seed: random seed, which should be the same for all processes (random if None).
+        rank: rank of this process (defaults to the torch.distributed rank, or 0).
+        num_replicas: number of processes (defaults to the torch.distributed world
+            size, or 1).
+        snap: set True to align patches with the pixel grid of the first (reference)
+            dataset, e.g. landcover, so that they are read without resampling.
+        footprint: FootprintIndex of where every source has data, which patches must
+            lie within (anywhere in the roi if None).
+        max_attempts: maximum number of rounds of 'batch_size' candidates drawn for
+            each batch.
+        fill_on_failure: set True to fill a batch with samples of the other type
+            (with a warning) if 'max_attempts' is reached, rather than raising.
     Returns:
         constrained_samples: set of samples that meet the specified constraints.
+    Raises:
+        RuntimeError: if a batch cannot be filled within 'max_attempts' rounds (and
+            fill_on_failure is False).
     """
 
     # Setup the attributes required for constraint implementation
@@ -39,6 +297,14 @@ class ConstrainedRandomBatchGeoSampler(RandomBatchGeoSampler):
         burn_prop: float,
         roi: Optional[BoundingBox] = None,
         units: Units = Units.PIXELS,
+        burn_index: Optional[BurnIndex] = None,
+        seed: Optional[int] = None,
+        rank: Optional[int] = None,
+        num_replicas: Optional[int] = None,
+        snap: bool = False,
+        footprint: Optional[FootprintIndex] = None,
+        max_attempts: int = 100,
+        fill_on_failure: bool = False,
     ) -> None:
 
         # Ensures that the input dataset is of type: IntersectionDataset
@@ -47,66 +313,127 @@ class ConstrainedRandomBatchGeoSampler(RandomBatchGeoSampler):
                 "Input dataset to sampler must be of type: IntersectionDataset."
             )
 
-        # Use init from RandomBatchGeoSampler parent class
-        super().__init__(dataset, size, batch_size, length, roi, units)
+        # Use init from SeededRandomBatchGeoSampler parent class
+        super().__init__(
+            dataset,
+            size,
+            batch_size,
+            length,
+            roi,
+            units,
+            seed,
+            rank,
+            num_replicas,
+            snap,
+            footprint,
+        )
 
         # Save the dataset and input constraints to the object
         self.dataset = dataset
         self.burn_prop = burn_prop
+        self.burn_index = burn_index
+        self.max_attempts = max_attempts
+        self.fill_on_failure = fill_on_failure
 
         # Set the number of samples required of not burned/burned types
         self.burn_samples_required = math.ceil(burn_prop * self.batch_size)
         self.not_burned_samples_required = self.batch_size - self.burn_samples_required
 
-    def __iter__(self) -> Iterator[List[BoundingBox]]:
-        """Defines a generator function to produce batches of areas to sample next.
+    def get_batch(self) -> List[BoundingBox]:
+        """Returns a batch of samples that meets the constraints.
 
         Returns:
             List((minx, maxx, miny, maxy, mint, maxt)) coordinates to index a dataset
         """
 
-        # Generate samples in len(self) = length/batch_size = number of batches required
-        for _ in range(len(self)):
+        # Choose a random tile
+        bounds = self.get_random_tile()
 
-            # Choose a random tile
-            hit = random.choice(self.hits)
-            bounds = BoundingBox(*hit.bounds)
+        # Fill a new batch of samples
+        batch = []
+        candidates = 0
+        filling = False
+        while self.not_burned_samples_required != 0 or self.burn_samples_required != 0:
+
+            # Give up (or fill the batch with the other type) after max_attempts
+            if candidates == self.max_attempts * self.batch_size:
+                self.on_failure(len(batch), filling)
+                if self.burn_samples_required != 0:
+                    self.not_burned_samples_required += self.burn_samples_required
+                    self.burn_samples_required = 0
+                else:
+                    self.burn_samples_required = self.not_burned_samples_required
+                    self.not_burned_samples_required = 0
+                candidates = 0
+                filling = True
 
-            # Fill a new batch of samples
-            batch = []
-            while (
-                self.not_burned_samples_required != 0 or self.burn_samples_required != 0
+            # Choose a random sample within that tile
+            bounding_box = self.to_bounding_boxes(
+                bounds, self.get_random_coordinates(bounds, 1)
+            )[0]
+            samp_burn_prop = self.get_burn_proportion(bounding_box)
+            self.stats.candidates += 1
+            candidates += 1
+
+            # If we have a "not-burned" sample and we require "not-burned" samples
+            if samp_burn_prop == 0 and self.not_burned_samples_required != 0:
+                self.not_burned_samples_required -= 1
+                self.stats.not_burned += 1
+                batch.append(bounding_box)
+
+            # If we have a "burn" sample and we require "burn" samples
+            elif samp_burn_prop > 0 and self.burn_samples_required != 0:
+                self.burn_samples_required -= 1
+                self.stats.burned += 1
+                batch.append(bounding_box)
+
+            # If we have found no "burn" samples so far, assume we need to change tile (speed)
+            elif self.burn_samples_required == math.ceil(
+                self.burn_prop * self.batch_size
             ):
+                bounds = self.get_random_tile()
+                self.stats.tile_switches += 1
 
-                # Choose a random sample within that tile
-                bounding_box = get_random_bounding_box(bounds, self.size, self.res)
-                samp_burn_prop = self.get_burn_proportion(bounding_box)
+        # Reset requirements for next batch generation
+        self.reset_requirements()
 
-                # If we have a "not-burned" sample and we require "not-burned" samples
-                if samp_burn_prop == 0 and self.not_burned_samples_required != 0:
-                    self.not_burned_samples_required -= 1
-                    batch.append(bounding_box)
+        # Return the batch of balanced samples we have gathered
+        return batch
 
-                # If we have a "burn" sample and we require "burn" samples
-                elif samp_burn_prop > 0 and self.burn_samples_required != 0:
-                    self.burn_samples_required -= 1
-                    batch.append(bounding_box)
+    def reset_requirements(self) -> None:
+        """Sets the number of "burn" and "not-burned" samples a batch requires."""
 
-                # If we have found no "burn" samples so far, assume we need to change tile (speed)
-                elif self.burn_samples_required == math.ceil(
-                    self.burn_prop * self.batch_size
-                ):
-                    hit = random.choice(self.hits)
-                    bounds = BoundingBox(*hit.bounds)
+        self.burn_samples_required = math.ceil(self.burn_prop * self.batch_size)
+        self.not_burned_samples_required = self.batch_size - self.burn_samples_required
 
-            # Return the batch of balanced samples we have gathered
-            yield batch
+    def on_failure(self, found: int, filling: bool) -> None:
+        """Handles a batch that is still incomplete after 'max_attempts' rounds.
 
-            # Reset requirements for next batch generation
-            self.burn_samples_required = math.ceil(self.burn_prop * self.batch_size)
-            self.not_burned_samples_required = (
-                self.batch_size - self.burn_samples_required
-            )
+        Args:
+            found: the number of samples found so far.
+            filling: whether the batch was already being filled with the other type.
+        Raises:
+            RuntimeError: if fill_on_failure is False, or the batch was already being
+                filled with the other type.
+        """
+
+        message = (
+            f"Only found {found} of {self.batch_size} samples in "
+            f"{self.max_attempts} attempts."
+        )
+        if filling or not self.fill_on_failure:
+            self.reset_requirements()
+            if filling:
+                message += " The batch could not be filled."
+            raise RuntimeError(message)
+
+        warnings.warn(f"{message} Filling the batch with the other type.")
+
+    def get_random_tile(self) -> BoundingBox:
+        """Returns the bounds of a random tile (chosen uniformly)."""
+
+        hit = self.hits[self.generator.integers(len(self.hits))]
+        return BoundingBox(*hit.bounds)
 
     def get_burn_proportion(self, bounding_box):
         """Returns the burn proportion found within a given bounding box.
@@ -115,10 +442,1006 @@ class ConstrainedRandomBatchGeoSampler(RandomBatchGeoSampler):
             burn_prop: the burn proportion present within the bounding box.
         """
 
+        # Use the summed-area tables if available (no dataset read required)
+        if self.burn_index is not None:
+            return self.burn_index.burn_proportion(bounding_box)
+
         # Obtain the burn data within the bounding box
         burn_data = self.dataset[bounding_box]["mask"]
+        self.stats.reads += 1
 
         # Get burn proportion within the bounding box
         non_zero_count = int((np.array(burn_data) > 0).sum())
         samp_burn_prop = non_zero_count / burn_data.numel()
         return samp_burn_prop
+
+    def build_catalogue(self, num_samples: int) -> SampleCatalogue:
+        """Draws (at least) 'num_samples' constrained samples and stores them in a
+        SampleCatalogue, along with their burn proportion and tile.
+
+        Args:
+            num_samples: the number of samples to draw.
+        Returns:
+            catalogue: the samples drawn, which can be saved and resampled later.
+        """
+
+        boxes = []
+        while len(boxes) < num_samples:
+            boxes += [tuple(box) for box in self.get_batch()]
+        boxes = np.array(boxes, dtype=float)
+
+        # Find the (first) tile that holds each of the samples, allowing for rounding
+        tiles = np.array([hit.bounds for hit in self.hits], dtype=float)
+        inside = (
+            (boxes[:, None, 0::2] >= tiles[None, :, 0::2] - 1e-9)
+            & (boxes[:, None, 1::2] <= tiles[None, :, 1::2] + 1e-9)
+        ).all(axis=2)
+        tile = inside.argmax(axis=1)
+
+        burn_prop = [self.get_burn_proportion(BoundingBox(*box)) for box in boxes]
+        return SampleCatalogue(boxes, burn_prop, tile)
+
+
+class BurnWeightedBatchGeoSampler(ConstrainedRandomBatchGeoSampler):
+    """Returns batches of samples that meet the same constraints as the
+    ConstrainedRandomBatchGeoSampler, without any rejection sampling.
+
+    Every patch origin on the MODIS grid within the roi is classified once as "burned"
+    (> 0 burned pixels) or "not burned" using a BurnIndex. Each batch is then drawn
+    directly from these two strata: ceil('burn_prop' * batch_size) burned origins and
+    the rest not burned, in one vectorized draw per stratum. The cost per batch is
+    therefore fixed, no matter how rare fire is in a region or month.
+    Note: patch origins are aligned to the (native) MODIS grid. With 'snap', they are
+    moved onto the reference grid before being classified.
+    Args:
+        dataset: the dataset to take samples from.
+        size: size of patch in lat/lon.
+        batch_size: the number of samples per batch.
+        length: number of samples (in total) to take per epoch.
+        burn_prop: proportion of returned samples present that are "burned".
+        roi: region of interest to take samples from.
+        units: Units.<PIXELS/CRS> depending on if patch size is in pixels or lat/lon
+        burn_index: precomputed BurnIndex. If None, it is built from the dataset.
+        seed: random seed, which should be the same for all processes (random if None).
+        rank: rank of this process (defaults to the torch.distributed rank, or 0).
+        num_replicas: number of processes (defaults to the torch.distributed world
+            size, or 1).
+        snap: set True to align patches with the pixel grid of the first (reference)
+            dataset, e.g. landcover, so that they are read without resampling.
+        footprint: FootprintIndex of where every source has data, which patches must
+            lie within (anywhere in the roi if None).
+    Raises:
+        ValueError: if the roi holds no burned (or no unburned) patches but some are required.
+    """
+
+    def __init__(
+        self,
+        dataset: IntersectionDataset,
+        size: Union[Tuple[float, float], float],
+        batch_size: int,
+        length: int,
+        burn_prop: float,
+        roi: Optional[BoundingBox] = None,
+        units: Units = Units.PIXELS,
+        burn_index: Optional[BurnIndex] = None,
+        seed: Optional[int] = None,
+        rank: Optional[int] = None,
+        num_replicas: Optional[int] = None,
+        snap: bool = False,
+        footprint: Optional[FootprintIndex] = None,
+    ) -> None:
+
+        super().__init__(
+            dataset,
+            size,
+            batch_size,
+            length,
+            burn_prop,
+            roi,
+            units,
+            burn_index,
+            seed,
+            rank,
+            num_replicas,
+            snap,
+            footprint,
+        )
+
+        if self.burn_index is None:
+            self.burn_index = BurnIndex(dataset, self.roi)
+
+        self.build_strata()
+
+    def build_strata(self) -> None:
+        """Classifies every valid patch origin within the sampler tiles.
+
+        The patch origins of all tiles are numbered consecutively: 'offsets' holds the
+        first number of each tile and 'burned_origins' the sorted numbers of the
+        origins whose patch contains burned pixels.
+        """
+
+        # Each entry is: (minx, maxy, xres, yres, no. of columns, mint, maxt)
+        self.entries = []
+        offsets = [0]
+        burned_origins = []
+        excluded_origins = []
+        for hit in self.hits:
+            bounds = BoundingBox(*hit.bounds)
+            for i in self.burn_index.index.intersection(tuple(bounds)):
+                minx, maxy, burned = self.burn_index.patch_counts(i, bounds, self.size)
+                if burned.size == 0:
+                    continue
+
+                _, _, xres, yres = self.burn_index.origins[i]
+                self.entries.append(
+                    (minx, maxy, xres, yres, burned.shape[1], bounds.mint, bounds.maxt)
+                )
+
+                # Patches are classified where they are drawn, i.e. after being moved
+                # onto the reference grid
+                coordinates = self.origin_coordinates(
+                    minx, maxy, xres, yres, burned.shape
+                )
+                if self.grid is not None:
+                    burned = self.burn_index.count(i, *coordinates)[0]
+                burned = burned.reshape(-1)
+
+                # Origins of patches outside the footprint are never drawn
+                valid = np.ones(burned.shape, dtype=bool)
+                if self.footprint is not None:
+                    valid = self.footprint.contains(
+                        *coordinates, bounds.mint, bounds.maxt
+                    )
+
+                burned_origins.append(
+                    offsets[-1] + np.flatnonzero((burned > 0) & valid)
+                )
+                excluded_origins.append(
+                    offsets[-1] + np.flatnonzero((burned > 0) | ~valid)
+                )
+                offsets.append(offsets[-1] + burned.size)
+
+        # The entries as columns, to look up many origins at once
+        self.entry_columns = tuple(np.array(column) for column in zip(*self.entries))
+        self.offsets = np.array(offsets, dtype=np.int64)
+        if burned_origins:
+            self.burned_origins = np.concatenate(burned_origins)
+            excluded = np.concatenate(excluded_origins)
+        else:
+            self.burned_origins = np.array([], dtype=np.int64)
+            excluded = np.array([], dtype=np.int64)
+
+        # The k-th not burned origin is k + (no. of burned, or excluded, origins
+        # before it), which is found by searching the excluded numbers minus their rank
+        self.not_burned_lookup = excluded - np.arange(len(excluded))
+        self.num_not_burned = int(self.offsets[-1]) - len(excluded)
+
+        if self.burn_samples_required > 0 and len(self.burned_origins) == 0:
+            raise ValueError("No burned patches found within the sampler roi.")
+        if self.not_burned_samples_required > 0 and self.num_not_burned == 0:
+            raise ValueError("No unburned patches found within the sampler roi.")
+
+    def get_batch(self) -> List[BoundingBox]:
+        """Returns a batch of samples that meets the constraints.
+
+        Returns:
+            List((minx, maxx, miny, maxy, mint, maxt)) coordinates to index a dataset
+        """
+
+        # Draw the burned origins directly from their numbers
+        burned = self.burned_origins[
+            self.draw(len(self.burned_origins), self.burn_samples_required)
+        ]
+
+        # Draw the not burned origins by rank, skipping over the burned numbers
+        ranks = self.draw(self.num_not_burned, self.not_burned_samples_required)
+        not_burned = ranks + np.searchsorted(
+            self.not_burned_lookup, ranks, side="right"
+        )
+
+        self.stats.candidates += self.batch_size
+        self.stats.burned += len(burned)
+        self.stats.not_burned += len(not_burned)
+
+        return self.origins_to_bounding_boxes(np.concatenate([burned, not_burned]))
+
+    def draw(self, population: int, size: int) -> np.ndarray:
+        """Draws 'size' integers uniformly (with replacement) from [0, population)."""
+
+        if size == 0:
+            return np.array([], dtype=np.int64)
+        return self.generator.integers(population, size=size)
+
+    def origin_coordinates(
+        self,
+        minx: float,
+        maxy: float,
+        xres: float,
+        yres: float,
+        shape: Tuple[int, int],
+    ) -> np.ndarray:
+        """Returns the coordinates of the patches of a (rows, cols) grid of origins,
+        moved onto the reference grid (if snapping).
+
+        Returns:
+            coordinates: (4, rows * cols) array of minx, maxx, miny, maxy coordinates
+        """
+
+        left = minx + np.arange(shape[1])[None, :] * xres
+        top = maxy - np.arange(shape[0])[:, None] * yres
+        left, top = np.broadcast_arrays(left, top)
+        return self.patch_coordinates(left.reshape(-1), top.reshape(-1))
+
+    def patch_coordinates(self, left: np.ndarray, top: np.ndarray) -> np.ndarray:
+        """Returns the coordinates of the patches with the given top-left corners,
+        moved onto the reference grid (by less than half a pixel) if snapping.
+
+        Returns:
+            coordinates: (4, N) array of minx, maxx, miny, maxy coordinates
+        """
+
+        coordinates = np.stack([left, left + self.size[1], top - self.size[0], top])
+        if self.grid is not None:
+            coordinates = self.grid.snap(coordinates, self.size)
+        return coordinates
+
+    def origins_to_bounding_boxes(self, origins: np.ndarray) -> List[BoundingBox]:
+        """Converts patch origin numbers into bounding boxes.
+
+        Returns:
+            List((minx, maxx, miny, maxy, mint, maxt)) coordinates to index a dataset
+        """
+
+        entries = np.searchsorted(self.offsets, origins, side="right") - 1
+        minx, maxy, xres, yres, cols, mint, maxt = self.entry_columns
+        rows, cols = np.divmod(origins - self.offsets[entries], cols[entries])
+        coordinates = self.patch_coordinates(
+            minx[entries] + cols * xres[entries], maxy[entries] - rows * yres[entries]
+        )
+
+        return [
+            BoundingBox(*coordinate, mint[entry], maxt[entry])
+            for coordinate, entry in zip(coordinates.T.tolist(), entries)
+        ]
+
+
+class VectorizedConstrainedRandomBatchGeoSampler(ConstrainedRandomBatchGeoSampler):
+    """Returns batches of samples that meet the same constraints as the
+    ConstrainedRandomBatchGeoSampler, testing candidate samples in bulk.
+
+    Instead of drawing and classifying one bounding box at a time, 'num_candidates'
+    random bounding boxes are drawn at once as NumPy arrays and classified in a single
+    vectorized pass against the BurnIndex held in memory. The batch is then filled
+    from the results, drawing more candidates only if required.
+    Args:
+        dataset: the dataset to take samples from.
+        size: size of patch in lat/lon.
+        batch_size: the number of samples per batch.
+        length: number of samples (in total) to take per epoch.
+        burn_prop: proportion of returned samples present that are "burned".
+        roi: region of interest to take samples from.
+        units: Units.<PIXELS/CRS> depending on if patch size is in pixels or lat/lon
+        burn_index: precomputed BurnIndex. If None, it is built from the dataset.
+        num_candidates: number of candidate samples drawn (and classified) at once.
+        seed: random seed, which should be the same for all processes (random if None).
+        rank: rank of this process (defaults to the torch.distributed rank, or 0).
+        num_replicas: number of processes (defaults to the torch.distributed world
+            size, or 1).
+        snap: set True to align patches with the pixel grid of the first (reference)
+            dataset, e.g. landcover, so that they are read without resampling.
+        footprint: FootprintIndex of where every source has data, which patches must
+            lie within (anywhere in the roi if None).
+        max_attempts: maximum number of rounds of 'num_candidates' candidates drawn
+            for each batch.
+        fill_on_failure: set True to fill a batch with samples of the other type
+            (with a warning) if 'max_attempts' is reached, rather than raising.
+    Raises:
+        RuntimeError: if a batch cannot be filled within 'max_attempts' rounds (and
+            fill_on_failure is False).
+    """
+
+    def __init__(
+        self,
+        dataset: IntersectionDataset,
+        size: Union[Tuple[float, float], float],
+        batch_size: int,
+        length: int,
+        burn_prop: float,
+        roi: Optional[BoundingBox] = None,
+        units: Units = Units.PIXELS,
+        burn_index: Optional[BurnIndex] = None,
+        num_candidates: int = 256,
+        seed: Optional[int] = None,
+        rank: Optional[int] = None,
+        num_replicas: Optional[int] = None,
+        snap: bool = False,
+        footprint: Optional[FootprintIndex] = None,
+        max_attempts: int = 100,
+        fill_on_failure: bool = False,
+    ) -> None:
+
+        super().__init__(
+            dataset,
+            size,
+            batch_size,
+            length,
+            burn_prop,
+            roi,
+            units,
+            burn_index,
+            seed,
+            rank,
+            num_replicas,
+            snap,
+            footprint,
+            max_attempts,
+            fill_on_failure,
+        )
+
+        if self.burn_index is None:
+            self.burn_index = BurnIndex(dataset, self.roi)
+
+        self.num_candidates = num_candidates
+
+    def get_batch(self) -> List[BoundingBox]:
+        """Returns a batch of samples that meets the constraints.
+
+        Returns:
+            List((minx, maxx, miny, maxy, mint, maxt)) coordinates to index a dataset
+        """
+
+        # Choose a random tile
+        bounds = self.get_random_tile()
+
+        # Fill a new batch of samples
+        burned, not_burned = [], []
+        num_burned = self.burn_samples_required
+        num_not_burned = self.not_burned_samples_required
+        attempts = 0
+        filling = False
+        while len(burned) < num_burned or len(not_burned) < num_not_burned:
+
+            # Give up (or fill the batch with the other type) after max_attempts
+            if attempts == self.max_attempts:
+                self.on_failure(len(burned) + len(not_burned), filling)
+                if len(burned) < num_burned:
+                    num_burned = len(burned)
+                    num_not_burned = self.batch_size - num_burned
+                else:
+                    num_not_burned = len(not_burned)
+                    num_burned = self.batch_size - num_not_burned
+                attempts = 0
+                filling = True
+            attempts += 1
+
+            # Choose (and classify) many random samples within that tile at once
+            candidates = self.get_random_coordinates(bounds, self.num_candidates)
+            is_burned = self.get_burned_pixels(bounds, candidates) > 0
+            self.stats.candidates += self.num_candidates
+
+            # Keep as many "burn" and "not-burned" samples as we still require
+            burned += self.to_bounding_boxes(
+                bounds, candidates[:, is_burned][:, : num_burned - len(burned)]
+            )
+            not_burned += self.to_bounding_boxes(
+                bounds, candidates[:, ~is_burned][:, : num_not_burned - len(not_burned)]
+            )
+
+            # If we have found no "burn" samples so far, change tile (speed)
+            if len(burned) == 0 and num_burned != 0:
+                bounds = self.get_random_tile()
+                self.stats.tile_switches += 1
+
+        # Return the batch of balanced samples we have gathered
+        self.stats.burned += len(burned)
+        self.stats.not_burned += len(not_burned)
+        return burned + not_burned
+
+    def get_burned_pixels(
+        self, bounds: BoundingBox, candidates: np.ndarray
+    ) -> np.ndarray:
+        """Returns the number of burned (MODIS) pixels within each candidate.
+
+        Args:
+            bounds: the tile containing the candidates.
+            candidates: (4, N) array of minx, maxx, miny, maxy coordinates.
+        """
+
+        burned = np.zeros(candidates.shape[1], dtype=np.int64)
+        for i in self.burn_index.index.intersection(tuple(bounds)):
+            burned += self.burn_index.count(i, *candidates)[0]
+        return burned
+
+
+class CatalogueBatchGeoSampler(SeededRandomBatchGeoSampler):
+    """Returns batches of samples that meet the same constraints as the
+    ConstrainedRandomBatchGeoSampler, resampled from a SampleCatalogue.
+
+    The catalogue holds samples found by a constrained sampler in an earlier run (or
+    the patches of a PatchCatalogue), so no search is needed: each batch draws
+    ceil('burn_prop' * batch_size) of its burned samples and the rest from its unburned
+    samples (with replacement).
+    Args:
+        dataset: the dataset to take samples from.
+        size: size of patch in lat/lon.
+        batch_size: the number of samples per batch.
+        length: number of samples (in total) to take per epoch.
+        burn_prop: proportion of returned samples present that are "burned".
+        catalogue: the samples to draw from.
+        roi: region of interest to take samples from.
+        units: Units.<PIXELS/CRS> depending on if patch size is in pixels or lat/lon
+        seed: random seed, which should be the same for all processes (random if None).
+        rank: rank of this process (defaults to the torch.distributed rank, or 0).
+        num_replicas: number of processes (defaults to the torch.distributed world
+            size, or 1).
+        snap: set True to align patches with the pixel grid of the first (reference)
+            dataset, e.g. landcover, so that they are read without resampling.
+        footprint: FootprintIndex of where every source has data, which patches must
+            lie within (anywhere in the roi if None).
+    Raises:
+        ValueError: if the catalogue holds no burned (or no unburned) samples but some
+            are required.
+    """
+
+    def __init__(
+        self,
+        dataset: GeoDataset,
+        size: Union[Tuple[float, float], float],
+        batch_size: int,
+        length: int,
+        burn_prop: float,
+        catalogue: SampleCatalogue,
+        roi: Optional[BoundingBox] = None,
+        units: Units = Units.PIXELS,
+        seed: Optional[int] = None,
+        rank: Optional[int] = None,
+        num_replicas: Optional[int] = None,
+        snap: bool = False,
+        footprint: Optional[FootprintIndex] = None,
+    ) -> None:
+
+        super().__init__(
+            dataset,
+            size,
+            batch_size,
+            length,
+            roi,
+            units,
+            seed,
+            rank,
+            num_replicas,
+            snap,
+            footprint,
+        )
+
+        self.burn_prop = burn_prop
+        self.catalogue = catalogue
+        self.burned = catalogue.burned
+        self.not_burned = catalogue.not_burned
+
+        # The samples, moved onto the reference grid (by less than half a pixel)
+        self.boxes = catalogue.boxes.copy()
+        if self.grid is not None:
+            self.boxes[:, :4] = self.grid.snap(self.boxes[:, :4].T, self.size).T
+
+        # Samples outside the footprint are never drawn
+        if self.footprint is not None:
+            inside = self.footprint.contains(*self.boxes[:, :6].T)
+            self.burned = self.burned[inside[self.burned]]
+            self.not_burned = self.not_burned[inside[self.not_burned]]
+
+        # Set the number of samples required of not burned/burned types
+        self.burn_samples_required = math.ceil(burn_prop * self.batch_size)
+        self.not_burned_samples_required = self.batch_size - self.burn_samples_required
+
+        if self.burn_samples_required > 0 and len(self.burned) == 0:
+            raise ValueError("The sample catalogue holds no burned samples.")
+        if self.not_burned_samples_required > 0 and len(self.not_burned) == 0:
+            raise ValueError("The sample catalogue holds no unburned samples.")
+
+    def get_batch(self) -> List[BoundingBox]:
+        """Returns a batch of samples that meets the constraints.
+
+        Returns:
+            List((minx, maxx, miny, maxy, mint, maxt)) coordinates to index a dataset
+        """
+
+        rows = np.concatenate(
+            [
+                self.generator.choice(self.burned, self.burn_samples_required),
+                self.generator.choice(
+                    self.not_burned, self.not_burned_samples_required
+                ),
+            ]
+        )
+
+        self.stats.candidates += self.batch_size
+        self.stats.burned += self.burn_samples_required
+        self.stats.not_burned += self.not_burned_samples_required
+        return [BoundingBox(*box) for box in self.boxes[rows].tolist()]
+
+
+class AdaptiveConstrainedRandomBatchGeoSampler(
+    VectorizedConstrainedRandomBatchGeoSampler
+):
+    """Returns batches of samples that meet the same constraints as the
+    ConstrainedRandomBatchGeoSampler, choosing the tiles of burned samples by yield.
+
+    Candidates are drawn in rounds of 'num_candidates' from a single tile. The "not
+    burned" samples of a batch are filled first, from tiles chosen uniformly (as the
+    ConstrainedRandomBatchGeoSampler does), so that the unburned areas sampled are not
+    biased. Any remaining "burned" samples are then filled from tiles chosen by a
+    TileScheduler, which learns the burn yield of every tile and month from all the
+    candidates classified, so few rounds are wasted on tiles that never burned.
+    At most 'max_attempts' rounds are drawn for each of the two steps.
+    Args:
+        dataset: the dataset to take samples from.
+        size: size of patch in lat/lon.
+        batch_size: the number of samples per batch.
+        length: number of samples (in total) to take per epoch.
+        burn_prop: proportion of returned samples present that are "burned".
+        roi: region of interest to take samples from.
+        units: Units.<PIXELS/CRS> depending on if patch size is in pixels or lat/lon
+        burn_index: precomputed BurnIndex. If None, it is built from the dataset.
+        num_candidates: number of candidate samples drawn (and classified) at once.
+        prior: weight of the month yield when estimating the yield of a tile.
+        max_attempts: maximum number of rounds of candidates drawn per sample type
+            for each batch.
+        fill_on_failure: set True to fill a batch with samples of the other type
+            (with a warning) if 'max_attempts' is reached, rather than raising.
+        seed: random seed, which should be the same for all processes (random if None).
+        rank: rank of this process (defaults to the torch.distributed rank, or 0).
+        num_replicas: number of processes (defaults to the torch.distributed world
+            size, or 1).
+        snap: set True to align patches with the pixel grid of the first (reference)
+            dataset, e.g. landcover, so that they are read without resampling.
+        footprint: FootprintIndex of where every source has data, which patches must
+            lie within (anywhere in the roi if None).
+    Raises:
+        RuntimeError: if a batch cannot be filled within 'max_attempts' rounds (and
+            fill_on_failure is False).
+    """
+
+    def __init__(
+        self,
+        dataset: IntersectionDataset,
+        size: Union[Tuple[float, float], float],
+        batch_size: int,
+        length: int,
+        burn_prop: float,
+        roi: Optional[BoundingBox] = None,
+        units: Units = Units.PIXELS,
+        burn_index: Optional[BurnIndex] = None,
+        num_candidates: int = 256,
+        prior: float = 10.0,
+        max_attempts: int = 100,
+        fill_on_failure: bool = False,
+        seed: Optional[int] = None,
+        rank: Optional[int] = None,
+        num_replicas: Optional[int] = None,
+        snap: bool = False,
+        footprint: Optional[FootprintIndex] = None,
+    ) -> None:
+
+        super().__init__(
+            dataset,
+            size,
+            batch_size,
+            length,
+            burn_prop,
+            roi,
+            units,
+            burn_index,
+            num_candidates,
+            seed,
+            rank,
+            num_replicas,
+            snap,
+            footprint,
+            max_attempts,
+            fill_on_failure,
+        )
+
+        self.tile_scheduler = TileScheduler(self.hits, prior)
+
+        # Yields learned before the current epoch, and the tile of the last round
+        self.epoch_start_yields = self.tile_scheduler.state_dict()
+        self.last_tile: Optional[int] = None
+
+    def __iter__(self) -> Iterator[List[BoundingBox]]:
+        """Defines a generator function to produce batches of areas to sample next.
+
+        Returns:
+            List((minx, maxx, miny, maxy, mint, maxt)) coordinates to index a dataset
+        """
+
+        # After load_state_dict, the batches replayed up to the saved position learn
+        # the same yields again, starting from those saved for the start of the epoch
+        self.epoch_start_yields = self.tile_scheduler.state_dict()
+        return super().__iter__()
+
+    def get_batch(self) -> List[BoundingBox]:
+        """Returns a batch of samples that meets the constraints.
+
+        Returns:
+            List((minx, maxx, miny, maxy, mint, maxt)) coordinates to index a dataset
+        """
+
+        self.last_tile = None
+
+        # Fill the "not-burned" samples from uniform tiles (keeping any "burn" samples
+        # found on the way), then the remaining "burn" samples from productive tiles
+        burned, not_burned = [], []
+        num_burned = self.burn_samples_required
+        num_not_burned = self.not_burned_samples_required
+        self.fill(burned, not_burned, num_burned, num_not_burned, adaptive=False)
+        self.fill(burned, not_burned, num_burned, num_not_burned, adaptive=True)
+
+        # Fill any missing samples with the other type, or fail
+        if len(burned) + len(not_burned) < self.batch_size:
+            message = (
+                f"Only found {len(burned)} burned and {len(not_burned)} not burned "
+                f"samples in {self.max_attempts} attempts."
+            )
+            if not self.fill_on_failure:
+                raise RuntimeError(message)
+
+            warnings.warn(f"{message} Filling the batch with the other type.")
+            if len(burned) < num_burned:
+                num_not_burned = self.batch_size - len(burned)
+                self.fill(burned, not_burned, len(burned), num_not_burned, False)
+            else:
+                num_burned = self.batch_size - len(not_burned)
+                self.fill(burned, not_burned, num_burned, len(not_burned), True)
+
+            if len(burned) + len(not_burned) < self.batch_size:
+                raise RuntimeError(f"{message} The batch could not be filled.")
+
+        self.stats.burned += len(burned)
+        self.stats.not_burned += len(not_burned)
+        return burned + not_burned
+
+    def fill(
+        self,
+        burned: List[BoundingBox],
+        not_burned: List[BoundingBox],
+        num_burned: int,
+        num_not_burned: int,
+        adaptive: bool,
+    ) -> None:
+        """Adds samples to 'burned' and 'not_burned' (up to 'num_burned' and
+        'num_not_burned') from rounds of candidates, each drawn from a single tile.
+
+        Args:
+            burned: the "burn" samples found so far.
+            not_burned: the "not-burned" samples found so far.
+            num_burned: the number of "burn" samples required.
+            num_not_burned: the number of "not-burned" samples required.
+            adaptive: set True to choose tiles by yield until the "burn" samples are
+                complete, or False to choose tiles uniformly until the "not-burned"
+                samples are complete.
+        """
+
+        for _ in range(self.max_attempts):
+            if adaptive and len(burned) >= num_burned:
+                break
+            if not adaptive and len(not_burned) >= num_not_burned:
+                break
+
+            if adaptive:
+                tile = self.tile_scheduler.choose(self.generator)
+            else:
+                tile = int(self.generator.integers(len(self.hits)))
+            bounds = BoundingBox(*self.hits[tile].bounds)
+
+            # Classify many random samples within that tile, and learn from them
+            candidates = self.get_random_coordinates(bounds, self.num_candidates)
+            is_burned = self.get_burned_pixels(bounds, candidates) > 0
+            self.tile_scheduler.update(tile, self.num_candidates, int(is_burned.sum()))
+
+            burned += self.to_bounding_boxes(
+                bounds, candidates[:, is_burned][:, : num_burned - len(burned)]
+            )
+            not_burned += self.to_bounding_boxes(
+                bounds, candidates[:, ~is_burned][:, : num_not_burned - len(not_burned)]
+            )
+
+            self.stats.candidates += self.num_candidates
+            if self.last_tile is not None and tile != self.last_tile:
+                self.stats.tile_switches += 1
+            self.last_tile = tile
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Returns the state needed to resume sampling, including the tile yields.
+
+        Within an epoch, the yields are those of the start of the epoch, as the batches
+        already yielded are drawn again (and learned from) when sampling resumes.
+        """
+
+        state_dict = super().state_dict()
+        if self.batches_yielded > 0:
+            state_dict["tile_scheduler"] = self.epoch_start_yields
+        else:
+            state_dict["tile_scheduler"] = self.tile_scheduler.state_dict()
+        return state_dict
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """Restores a state returned by state_dict."""
+
+        super().load_state_dict(state_dict)
+        if "tile_scheduler" in state_dict:
+            self.tile_scheduler.load_state_dict(state_dict["tile_scheduler"])
+
+
+class StagedRandomBatchGeoSampler(SeededRandomBatchGeoSampler):
+    """Returns random batches of samples (as SeededRandomBatchGeoSampler does) that
+    only contain patches with enough valid labels.
+
+    Candidate patches are checked by reading the (cheap) label layers only, MODIS_JD
+    and landcover, and rejected if too many of their pixels are invalid, so that the
+    (expensive) image layers, e.g. Sentinel and Landsat, are only read by the
+    DataLoader for the patches that are used. Rejected patches are replaced by new
+    candidates from the same tile, or from another tile if none of a round of
+    candidates is valid. The fractions checked are those of the PatchCatalogue:
+        - invalid: fraction of landcover pixels of class 0 ("invalid"), or outside
+          the landcover
+        - unobserved: fraction of MODIS pixels that were not observed (-1)
+        - nonburnable: fraction of MODIS pixels that are not burnable (-2)
+    Args:
+        dataset: dataset containing MODIS_JD and landcover data, e.g.
+            landcover & modis & sentinel.
+        size: size of patch in lat/lon.
+        batch_size: the number of samples per batch.
+        length: number of samples (in total, over all processes) to take per epoch.
+        max_fractions: largest fraction of each kind of invalid pixels (see above)
+            that a patch may have, e.g. {"invalid": 0.5, "unobserved": 0.2}.
+        roi: region of interest to take samples from.
+        units: Units.<PIXELS/CRS> depending on if patch size is in pixels or lat/lon
+        seed: random seed, which should be the same for all processes (random if None).
+        rank: rank of this process (defaults to the torch.distributed rank, or 0).
+        num_replicas: number of processes (defaults to the torch.distributed world
+            size, or 1).
+        snap: set True to align patches with the pixel grid of the first (reference)
+            dataset, e.g. landcover, so that they are read without resampling.
+        max_candidates: number of candidates checked for a batch before giving up.
+        footprint: FootprintIndex of where every source has data, which patches must
+            lie within (anywhere in the roi if None).
+        reuse_labels: set True to return LabelledBoundingBoxes, carrying the labels
+            read to check the patches, so that the DataLoader does not read them
+            again (with a LabelledReader, CoalescingReader or ConcurrentReader).
+    Raises:
+        ValueError: if the dataset has no MODIS_JD or landcover data, or max_fractions
+            has unknown names.
+        RuntimeError: if no batch of valid patches is found within max_candidates.
+    """
+
+    fractions = ("invalid", "unobserved", "nonburnable")
+
+    def __init__(
+        self,
+        dataset: GeoDataset,
+        size: Union[Tuple[float, float], float],
+        batch_size: int,
+        length: int,
+        max_fractions: Dict[str, float],
+        roi: Optional[BoundingBox] = None,
+        units: Units = Units.PIXELS,
+        seed: Optional[int] = None,
+        rank: Optional[int] = None,
+        num_replicas: Optional[int] = None,
+        snap: bool = False,
+        max_candidates: Optional[int] = None,
+        footprint: Optional[FootprintIndex] = None,
+        reuse_labels: bool = False,
+    ) -> None:
+
+        super().__init__(
+            dataset,
+            size,
+            batch_size,
+            length,
+            roi,
+            units,
+            seed,
+            rank,
+            num_replicas,
+            snap,
+            footprint,
+        )
+
+        unknown = set(max_fractions) - set(self.fractions)
+        if unknown:
+            raise ValueError(f"Unknown fractions {sorted(unknown)} in max_fractions.")
+        self.max_fractions = max_fractions
+        self.max_candidates = max_candidates or 100 * batch_size
+        self.reuse_labels = reuse_labels
+
+        # The label layers are read without their transforms, to get the raw values,
+        # and are known by their position among the sources
+        leaves = [without_transforms(ds) for ds in leaf_datasets(dataset)]
+        modis = [i for i, ds in enumerate(leaves) if isinstance(ds, MODIS_JD)]
+        landcover = [
+            i
+            for i, ds in enumerate(leaves)
+            if isinstance(ds, (LandcoverSimple, LandcoverComplex))
+        ]
+        if not modis or not landcover:
+            raise ValueError(
+                "StagedRandomBatchGeoSampler requires MODIS_JD and landcover data."
+            )
+        self.modis_index, self.landcover_index = modis[0], landcover[0]
+        self.modis = leaves[self.modis_index]
+        self.landcover = leaves[self.landcover_index]
+
+    def get_batch(self) -> List[BoundingBox]:
+        """Returns a batch of random samples with enough valid labels, from a random
+        tile.
+
+        Returns:
+            List((minx, maxx, miny, maxy, mint, maxt)) coordinates to index a dataset
+        """
+
+        bounds = self.get_random_tile()
+
+        batch: List[BoundingBox] = []
+        candidates = 0
+        while len(batch) < self.batch_size:
+            if candidates >= self.max_candidates:
+                raise RuntimeError(
+                    f"No valid batch found within {self.max_candidates} candidates, "
+                    f"try higher max_fractions ({self.max_fractions})."
+                )
+
+            # Draw as many candidates as are still required
+            boxes = self.to_bounding_boxes(
+                bounds,
+                self.get_random_coordinates(bounds, self.batch_size - len(batch)),
+            )
+            candidates += len(boxes)
+            self.stats.candidates += len(boxes)
+
+            accepted = 0
+            for bounding_box in boxes:
+                labels = self.read_labels(bounding_box)
+                if labels is None:
+                    continue
+
+                accepted += 1
+                if self.reuse_labels:
+                    bounding_box = LabelledBoundingBox(*bounding_box, labels)
+                batch.append(bounding_box)
+                if (labels[self.modis_index] > 0).any():
+                    self.stats.burned += 1
+                else:
+                    self.stats.not_burned += 1
+
+            # The tile is probably mostly invalid, so try another one
+            if accepted == 0:
+                bounds = self.get_random_tile()
+                self.stats.tile_switches += 1
+
+        return batch
+
+    def read_labels(self, bounding_box: BoundingBox) -> Optional[Dict[int, np.ndarray]]:
+        """Returns the raw MODIS julian days and landcover classes of a patch (keyed by
+        the position of their source, see LabelledBoundingBox), or None if it has too
+        many invalid pixels."""
+
+        try:
+            julian_day = read_raw(self.modis, bounding_box)
+            self.stats.reads += 1
+            classes = read_raw(self.landcover, bounding_box)
+            self.stats.reads += 1
+        except IndexError:
+            # No labels at all within the patch
+            return None
+
+        fractions = {
+            "invalid": (classes[0] == 0).mean(),
+            "unobserved": (julian_day[0] == -1).mean(),
+            "nonburnable": (julian_day[0] == -2).mean(),
+        }
+        for name, max_fraction in self.max_fractions.items():
+            if fractions[name] > max_fraction:
+                return None
+
+        return {self.modis_index: julian_day, self.landcover_index: classes}
+
+
+class SnappedGridGeoSampler(GridGeoSampler):
+    """Samples patches in a grid (as GridGeoSampler does), aligned with the pixel grid
+    of the first (reference) dataset, e.g. landcover.
+
+    The patch size and stride are rounded to a whole number of reference pixels, and
+    the grid of each tile starts at its first pixel edge, so that every patch is read
+    without resampling. Patches outside the footprint (if any) are skipped.
+    Args:
+        dataset: the dataset to take samples from.
+        size: size of patch in lat/lon.
+        stride: distance to skip between each patch.
+        roi: region of interest to take samples from.
+        units: Units.<PIXELS/CRS> depending on if patch size is in pixels or lat/lon
+        footprint: FootprintIndex of where every source has data, which patches must
+            lie within (anywhere in the roi if None).
+    """
+
+    def __init__(
+        self,
+        dataset: GeoDataset,
+        size: Union[Tuple[float, float], float],
+        stride: Union[Tuple[float, float], float],
+        roi: Optional[BoundingBox] = None,
+        units: Units = Units.PIXELS,
+        footprint: Optional[FootprintIndex] = None,
+    ) -> None:
+
+        # Use init from GridGeoSampler parent class
+        super().__init__(dataset, size, stride, roi, units)
+
+        self.grid = PixelGrid.from_dataset(dataset)
+        self.size = self.grid.snap_size(self.size)
+        self.stride = self.grid.snap_size(self.stride)
+        self.footprint = footprint
+
+        # Which patches of each tile lie within the footprint, found once for all
+        # iterations (and the length)
+        self.inside: Optional[List[np.ndarray]] = None
+        if footprint is None:
+            self.length = sum(
+                rows * cols for _, rows, cols in map(self.get_tile_grid, self.hits)
+            )
+        else:
+            self.inside = [self.footprint_mask(hit) for hit in self.hits]
+            self.length = int(sum(inside.sum() for inside in self.inside))
+
+    def get_tile_grid(self, hit: Any) -> Tuple[BoundingBox, int, int]:
+        """Returns the bounds (on the reference grid) and number of patch rows and
+        columns of a tile."""
+
+        bounds = self.grid.inner_bounds(BoundingBox(*hit.bounds))
+        height = round((bounds.maxy - bounds.miny) / self.grid.res)
+        width = round((bounds.maxx - bounds.minx) / self.grid.res)
+        size = [round(s / self.grid.res) for s in self.size]
+        stride = [round(s / self.grid.res) for s in self.stride]
+
+        rows = (height - size[0]) // stride[0] + 1 if height >= size[0] else 0
+        cols = (width - size[1]) // stride[1] + 1 if width >= size[1] else 0
+        return bounds, rows, cols
+
+    def footprint_mask(self, hit: Any) -> np.ndarray:
+        """Returns whether each patch of a tile lies within the footprint.
+
+        Returns:
+            inside: (rows, cols) boolean array
+        """
+
+        bounds, rows, cols = self.get_tile_grid(hit)
+        miny = bounds.miny + np.arange(rows)[:, None] * self.stride[0]
+        minx = bounds.minx + np.arange(cols)[None, :] * self.stride[1]
+        return self.footprint.contains(
+            minx,
+            minx + self.size[1],
+            miny,
+            miny + self.size[0],
+            bounds.mint,
+            bounds.maxt,
+        )
+
+    def __iter__(self) -> Iterator[BoundingBox]:
+        """Return the index of a dataset.
+
+        Returns:
+            (minx, maxx, miny, maxy, mint, maxt) coordinates to index a dataset
+        """
+
+        for k, hit in enumerate(self.hits):
+            bounds, rows, cols = self.get_tile_grid(hit)
+            for i in range(rows):
+                miny = bounds.miny + i * self.stride[0]
+                maxy = miny + self.size[0]
+                for j in range(cols):
+                    if self.inside is not None and not self.inside[k][i, j]:
+                        continue
+                    minx = bounds.minx + j * self.stride[1]
+                    maxx = minx + self.size[1]
+                    yield BoundingBox(minx, maxx, miny, maxy, bounds.mint, bounds.maxt)
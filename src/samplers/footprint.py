@@ -0,0 +1,344 @@
+import math
+import numpy as np
+from collections import defaultdict
+from contextlib import ExitStack
+from typing import Dict, List, Optional, Set, Tuple
+from rasterio.merge import merge
+from torchgeo.datasets import BoundingBox, GeoDataset, RasterDataset
+
+from ..datasets.geo import PixelGrid, leaf_datasets, open_warp_file
+
+# Tolerance (in cells) used when converting coordinates to cell edges, so that
+# boxes lying exactly on the cell grid do not pick up an extra row/column
+_EPS = 1e-6
+
+
+class FootprintIndex:
+    """Coarse occupancy bitmaps of where every source of a dataset has valid data.
+
+    The roi is divided into square cells of 'cell_size' reference pixels, aligned with
+    the grid of the reference dataset (e.g. landcover). Each source (leaf dataset) is
+    read once per time range of its files (e.g. per month), at 'samples' x 'samples'
+    points per cell, and a cell is occupied if at least 'min_valid' of its points hold
+    valid data (inside a file, and not the 'nodata' value of the dataset). There is one
+    bitmap per time range, intersecting the sources whose files share it, and a box is
+    valid if its cells are occupied in every bitmap whose time range overlaps its own
+    (e.g. the landcover, MODIS and Sentinel bitmaps of its month), and these cover
+    every source (so boxes of a month without imagery are never valid). The bitmaps are
+    stored with their summed-area tables, so whether a bounding box only covers
+    occupied cells is found with four lookups per bitmap.
+    Args:
+        dataset: the dataset to index, e.g. landcover & modis & sentinel.
+        roi: region of interest to index (defaults to the bounds of the dataset).
+        cell_size: size of the cells, in pixels of the dataset.
+        min_valid: fraction of the points of a cell that must be valid.
+        samples: points read per cell, along each axis.
+    """
+
+    def __init__(
+        self,
+        dataset: Optional[GeoDataset] = None,
+        roi: Optional[BoundingBox] = None,
+        cell_size: int = 16,
+        min_valid: float = 1.0,
+        samples: int = 4,
+    ) -> None:
+
+        # Grid of the cells (x0, y0, cell size in CRS units), the (mint, maxt) time
+        # range of each bitmap, the sources with files in it, and their occupancy
+        self.roi = None
+        self.origin: Tuple[float, float, float] = (0.0, 0.0, 1.0)
+        self.times = np.zeros((0, 2), dtype=float)
+        self.sources = np.zeros((0, 0), dtype=bool)
+        self.occupied = np.zeros((0, 0, 0), dtype=bool)
+        self.tables: Dict[Tuple[int, ...], np.ndarray] = {}
+
+        if dataset is not None:
+            self.roi = tuple(roi if roi is not None else dataset.bounds)
+            self._populate(
+                dataset, BoundingBox(*self.roi), cell_size, min_valid, samples
+            )
+
+    def _populate(
+        self,
+        dataset: GeoDataset,
+        roi: BoundingBox,
+        cell_size: int,
+        min_valid: float,
+        samples: int,
+    ) -> None:
+        """Intersects the valid data of the sources sharing each time range within the
+        roi."""
+
+        # Cells cover the roi, starting on a reference grid line
+        reference = PixelGrid.from_dataset(dataset)
+        cell = cell_size * reference.res
+        x0 = reference.x0 + math.floor((roi.minx - reference.x0) / cell + _EPS) * cell
+        y0 = reference.y0 - math.floor((reference.y0 - roi.maxy) / cell + _EPS) * cell
+        cols = max(math.ceil((roi.maxx - x0) / cell - _EPS), 0)
+        rows = max(math.ceil((y0 - roi.miny) / cell - _EPS), 0)
+
+        bitmaps: Dict[Tuple[float, float], np.ndarray] = {}
+        sources: Dict[Tuple[float, float], Set[int]] = defaultdict(set)
+        # Datasets held in memory (e.g. ERA5LandCube) have no files to read
+        leaves = [ds for ds in leaf_datasets(dataset) if isinstance(ds, RasterDataset)]
+        for source, ds in enumerate(leaves):
+            for key, filepaths in self.monthly_files(ds, roi).items():
+                sources[key].add(source)
+                valid = self.valid_points(
+                    ds, filepaths, (x0, y0, cell), rows, cols, samples
+                )
+                fraction = valid.reshape(rows, samples, cols, samples).mean(axis=(1, 3))
+                occupied = bitmaps.setdefault(key, np.ones((rows, cols), dtype=bool))
+                occupied &= fraction >= min_valid
+
+        times = sorted(bitmaps)
+        self.set_bitmaps(
+            (x0, y0, cell),
+            np.array(times, dtype=float).reshape(-1, 2),
+            np.array([bitmaps[key] for key in times], dtype=bool).reshape(
+                -1, rows, cols
+            ),
+            np.array(
+                [[i in sources[key] for i in range(len(leaves))] for key in times],
+                dtype=bool,
+            ).reshape(-1, len(leaves)),
+        )
+
+    @staticmethod
+    def monthly_files(
+        dataset: RasterDataset, roi: BoundingBox
+    ) -> Dict[Tuple[float, float], List[str]]:
+        """Returns the files of a dataset within the roi, grouped by time range, in
+        the order the dataset merges them."""
+
+        hits = sorted(
+            dataset.index.intersection(tuple(roi), objects=True), key=lambda hit: hit.id
+        )
+        files: Dict[Tuple[float, float], List[str]] = defaultdict(list)
+        for hit in hits:
+            files[hit.bounds[4], hit.bounds[5]].append(hit.object)
+        return files
+
+    @staticmethod
+    def valid_points(
+        dataset: RasterDataset,
+        filepaths: List[str],
+        origin: Tuple[float, float, float],
+        rows: int,
+        cols: int,
+        samples: int,
+    ) -> np.ndarray:
+        """Returns whether the files of a dataset hold valid data at the sample points
+        of every cell.
+
+        Returns:
+            valid: (rows * samples, cols * samples) boolean array
+        """
+
+        x0, y0, cell = origin
+        with ExitStack() as stack:
+            handles = [
+                stack.enter_context(open_warp_file(dataset, fp)) for fp in filepaths
+            ]
+            dtype = np.dtype(handles[0].dtypes[0])
+
+            # Points outside the files are filled with the nodata value, or (without
+            # one) with a value that real data is assumed never to hold
+            nodata = getattr(dataset, "nodata", None)
+            if nodata is None:
+                nodata = handles[0].nodata
+            if nodata is not None:
+                fill = nodata
+            elif np.issubdtype(dtype, np.floating):
+                fill = np.nan
+            else:
+                fill = np.iinfo(dtype).min
+
+            data, _ = merge(
+                handles,
+                bounds=(x0, y0 - rows * cell, x0 + cols * cell, y0),
+                res=cell / samples,
+                nodata=fill,
+                indexes=[1],
+            )
+        data = data[0, : rows * samples, : cols * samples]
+
+        if np.isnan(fill):
+            return ~np.isnan(data)
+        return data != fill
+
+    def set_bitmaps(
+        self,
+        origin: Tuple[float, float, float],
+        times: np.ndarray,
+        occupied: np.ndarray,
+        sources: Optional[np.ndarray] = None,
+    ) -> None:
+        """Sets the occupancy bitmaps (with their origin and (mint, maxt) time ranges).
+
+        Args:
+            origin: x0, y0 and cell size of the grid of the cells
+            times: (bitmaps, 2) array of the time range of each bitmap
+            occupied: (bitmaps, rows, cols) boolean array
+            sources: (bitmaps, sources) boolean array of the sources with files in
+                each bitmap (a single source in all bitmaps if None)
+        """
+
+        self.origin = tuple(origin)
+        self.times = np.asarray(times, dtype=float).reshape(-1, 2)
+        if sources is None:
+            sources = np.ones((len(self.times), 1), dtype=bool)
+        self.sources = np.asarray(sources, dtype=bool).reshape(len(self.times), -1)
+        self.occupied = np.asarray(occupied, dtype=bool)
+        self.tables = {}
+
+    def table(self, mint: float, maxt: float) -> np.ndarray:
+        """Returns the summed-area table of the cells occupied in every bitmap whose
+        time range overlaps (mint, maxt), built on first use. No cell is occupied if
+        these bitmaps miss a source, as it has no files (so no data) then."""
+
+        overlaps = (self.times[:, 0] <= maxt) & (self.times[:, 1] >= mint)
+        key = tuple(np.flatnonzero(overlaps))
+        if key not in self.tables:
+            covered = bool(key) and self.sources[overlaps].any(axis=0).all()
+            occupied = self.occupied[list(key)].all(axis=0) & covered
+            table = np.zeros(
+                (occupied.shape[0] + 1, occupied.shape[1] + 1), dtype=np.int64
+            )
+            table[1:, 1:] = occupied.cumsum(axis=0).cumsum(axis=1)
+            self.tables[key] = table
+        return self.tables[key]
+
+    def cells(
+        self, minx: np.ndarray, maxx: np.ndarray, miny: np.ndarray, maxy: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the (unclipped) rows and cols of the cells touched by boxes.
+
+        Returns:
+            row0, row1, col0, col1: first and last (excluded) rows and cols
+        """
+
+        x0, y0, cell = self.origin
+        col0 = np.floor((np.asarray(minx) - x0) / cell + _EPS).astype(np.int64)
+        col1 = np.ceil((np.asarray(maxx) - x0) / cell - _EPS).astype(np.int64)
+        row0 = np.floor((y0 - np.asarray(maxy)) / cell + _EPS).astype(np.int64)
+        row1 = np.ceil((y0 - np.asarray(miny)) / cell - _EPS).astype(np.int64)
+        return row0, row1, col0, col1
+
+    @staticmethod
+    def occupied_cells(
+        table: np.ndarray,
+        row0: np.ndarray,
+        row1: np.ndarray,
+        col0: np.ndarray,
+        col1: np.ndarray,
+    ) -> np.ndarray:
+        """Returns the number of occupied cells of a summed-area table within (clipped)
+        ranges of cells."""
+
+        return (
+            table[row1, col1]
+            - table[row0, col1]
+            - table[row1, col0]
+            + table[row0, col0]
+        )
+
+    def contains(
+        self,
+        minx: np.ndarray,
+        maxx: np.ndarray,
+        miny: np.ndarray,
+        maxy: np.ndarray,
+        mint: np.ndarray,
+        maxt: np.ndarray,
+    ) -> np.ndarray:
+        """Returns whether boxes only cover cells occupied in every bitmap whose time
+        range overlaps theirs.
+
+        All coordinate arguments may be scalars or arrays of the same shape.
+        """
+
+        minx, maxx, miny, maxy, mint, maxt = np.broadcast_arrays(
+            minx, maxx, miny, maxy, mint, maxt
+        )
+        height, width = self.occupied.shape[1:]
+        row0, row1, col0, col1 = self.cells(minx, maxx, miny, maxy)
+        inside = (row0 >= 0) & (col0 >= 0) & (row1 <= height) & (col1 <= width)
+
+        row0, row1 = row0.clip(0, height), row1.clip(0, height)
+        col0, col1 = col0.clip(0, width), col1.clip(0, width)
+        row1, col1 = row1.clip(row0), col1.clip(col0)
+
+        # Boxes are counted in groups sharing a time range (usually a single one)
+        count = np.zeros(inside.shape, dtype=np.int64)
+        times = np.stack([mint.reshape(-1), maxt.reshape(-1)], axis=1)
+        ranges, groups = np.unique(times, axis=0, return_inverse=True)
+        groups = groups.reshape(inside.shape)
+        for group, (start, stop) in enumerate(ranges):
+            select = groups == group
+            count[select] = self.occupied_cells(
+                self.table(start, stop),
+                row0[select],
+                row1[select],
+                col0[select],
+                col1[select],
+            )
+        return inside & (count == (row1 - row0) * (col1 - col0))
+
+    def patch_positions(self, bounds: BoundingBox, size: Tuple[float, float]) -> int:
+        """Returns the number of positions on the cell grid, within 'bounds', where a
+        patch of (height, width) 'size' only covers cells occupied in every bitmap
+        overlapping the time range of the bounds."""
+
+        height, width = self.occupied.shape[1:]
+        x0, y0, cell = self.origin
+        patch_rows = max(math.ceil(size[0] / cell - _EPS), 1)
+        patch_cols = max(math.ceil(size[1] / cell - _EPS), 1)
+
+        # Cells that lie entirely within the bounds
+        col0 = min(max(math.ceil((bounds.minx - x0) / cell - _EPS), 0), width)
+        col1 = max(min(math.floor((bounds.maxx - x0) / cell + _EPS), width), col0)
+        row0 = min(max(math.ceil((y0 - bounds.maxy) / cell - _EPS), 0), height)
+        row1 = max(min(math.floor((y0 - bounds.miny) / cell + _EPS), height), row0)
+        if row1 - row0 < patch_rows or col1 - col0 < patch_cols:
+            return 0
+
+        rows = np.arange(row0, row1 - patch_rows + 1)[:, None]
+        cols = np.arange(col0, col1 - patch_cols + 1)[None, :]
+        count = self.occupied_cells(
+            self.table(bounds.mint, bounds.maxt),
+            rows,
+            rows + patch_rows,
+            cols,
+            cols + patch_cols,
+        )
+        return int((count == patch_rows * patch_cols).sum())
+
+    def save(self, path: str) -> None:
+        """Saves the index to a compressed .npz file."""
+
+        np.savez_compressed(
+            path,
+            roi=np.array(self.roi if self.roi is not None else [], dtype=float),
+            origin=np.array(self.origin, dtype=float),
+            times=self.times,
+            sources=self.sources,
+            occupied=self.occupied,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "FootprintIndex":
+        """Loads an index previously written with FootprintIndex.save."""
+
+        footprint = cls()
+        with np.load(path) as data:
+            footprint.roi = tuple(data["roi"]) if data["roi"].size else None
+            # Indexes saved with a single bitmap hold it for all times
+            times = data["times"] if "times" in data else [[-np.inf, np.inf]]
+            occupied = data["occupied"].reshape(
+                len(times), *data["occupied"].shape[-2:]
+            )
+            sources = data["sources"] if "sources" in data else None
+            footprint.set_bitmaps(tuple(data["origin"]), times, occupied, sources)
+        return footprint
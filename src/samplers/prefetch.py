@@ -0,0 +1,184 @@
+import queue
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from torch.utils.data import Sampler
+from torchgeo.datasets import BoundingBox
+
+from .stats import SamplerStats
+
+# Marks the end of an epoch in the queue of batches
+_END = object()
+
+
+class PrefetchStats:
+    """Counters describing how often the consumer of a PrefetchBatchSampler waited.
+
+    - batches: batches taken from the queue
+    - starved: batches for which the queue was empty, so the consumer had to wait
+    - wait_time: time spent waiting for batches, in seconds
+    - queue_depth: total number of batches ready in the queue when a batch was taken
+    """
+
+    counters = ("batches", "starved", "queue_depth")
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        """Sets all counters and timers to zero."""
+
+        for counter in self.counters:
+            setattr(self, counter, 0)
+        self.wait_time = 0.0
+
+    def as_dict(self, prefix: str = "prefetch/") -> Dict[str, float]:
+        """Returns the stats (totals and per batch averages) to log.
+
+        Args:
+            prefix: prepended to the name of every stat.
+        """
+
+        batches = max(self.batches, 1)
+        stats = {counter: getattr(self, counter) for counter in self.counters}
+        stats["wait_time"] = self.wait_time
+        stats["starved_rate"] = self.starved / batches
+        stats["wait_time_per_batch"] = self.wait_time / batches
+        stats["mean_queue_depth"] = self.queue_depth / batches
+
+        return {prefix + name: float(value) for name, value in stats.items()}
+
+    def __repr__(self) -> str:
+        stats = ", ".join(f"{k}={v:.4g}" for k, v in self.as_dict("").items())
+        return f"PrefetchStats({stats})"
+
+
+class PrefetchBatchSampler(Sampler[List[BoundingBox]]):
+    """Wraps a batch sampler, drawing its batches in a background thread.
+
+    Up to 'queue_size' batches are drawn ahead of time, so the time spent by the
+    sampler overlaps with the DataLoader workers reading data and the model training,
+    rather than adding to them. How often the queue ran dry is recorded in
+    'prefetch_stats'. Other attributes (e.g. 'stats', 'set_epoch' or 'hits') are
+    those of the wrapped sampler.
+    Args:
+        sampler: the batch sampler to wrap (any of the project samplers).
+        queue_size: maximum number of batches drawn ahead of time.
+    """
+
+    def __init__(
+        self, sampler: Sampler[List[BoundingBox]], queue_size: int = 4
+    ) -> None:
+
+        self.sampler = sampler
+        self.queue_size = queue_size
+        self.prefetch_stats = PrefetchStats()
+
+        # (epoch, batches taken) of the epoch being consumed, as the wrapped sampler
+        # is ahead of the consumer
+        self.position: Optional[Tuple[int, int]] = None
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called for attributes not found on the wrapper itself
+        if name == "sampler":
+            raise AttributeError(name)
+        return getattr(self.sampler, name)
+
+    def __iter__(self) -> Iterator[List[BoundingBox]]:
+        """Yields the batches of the wrapped sampler, as they become ready.
+
+        Raises:
+            Exception: any exception raised by the wrapped sampler.
+        """
+
+        epoch = getattr(self.sampler, "epoch", 0)
+        taken = getattr(self.sampler, "start_batch", 0)
+        self.position = (epoch, taken)
+        self.prefetch_stats.reset()
+
+        batches: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self.produce, args=(batches, stop), daemon=True
+        )
+        thread.start()
+
+        try:
+            while True:
+                depth = batches.qsize()
+                start = time.perf_counter()
+                batch = batches.get()
+                self.prefetch_stats.wait_time += time.perf_counter() - start
+
+                if batch is _END:
+                    break
+                if isinstance(batch, BaseException):
+                    raise batch
+
+                self.prefetch_stats.batches += 1
+                self.prefetch_stats.starved += depth == 0
+                self.prefetch_stats.queue_depth += depth
+                taken += 1
+                self.position = (epoch, taken)
+                yield batch
+
+            # The epoch was consumed in full, so the wrapped sampler is up to date
+            self.position = None
+
+        finally:
+            # Stop the thread, making room in the queue in case it is blocked
+            stop.set()
+            while thread.is_alive():
+                try:
+                    batches.get_nowait()
+                except queue.Empty:
+                    thread.join(0.01)
+
+    def produce(self, batches: queue.Queue, stop: threading.Event) -> None:
+        """Puts the batches of the wrapped sampler in the queue, until told to stop."""
+
+        def put(item: Any) -> bool:
+            # Waits for room in the queue, returning False if told to stop
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        batch_iterator = iter(self.sampler)
+        try:
+            for batch in batch_iterator:
+                if not put(batch):
+                    return
+            put(_END)
+        except Exception as error:
+            put(error)
+        finally:
+            # Close the sampler here (if stopped early), rather than in another thread
+            if hasattr(batch_iterator, "close"):
+                batch_iterator.close()
+
+    def __len__(self) -> int:
+        return len(self.sampler)
+
+    @property
+    def stats(self) -> SamplerStats:
+        """Returns the stats of the wrapped sampler."""
+
+        return self.sampler.stats
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Returns the state of the wrapped sampler, at the batch last taken."""
+
+        state_dict = self.sampler.state_dict()
+        if self.position is not None:
+            state_dict["epoch"], state_dict["batches_yielded"] = self.position
+        return state_dict
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """Restores a state returned by state_dict."""
+
+        self.position = None
+        self.sampler.load_state_dict(state_dict)
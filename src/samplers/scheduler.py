@@ -0,0 +1,59 @@
+import numpy as np
+from typing import Any, Dict, List
+
+
+class TileScheduler:
+    """Chooses tiles in proportion to their (learned) burn yield.
+
+    The yield of a tile is the proportion of candidate samples drawn from it that
+    contained burned pixels. Each tile (i.e. each sampler hit, a tile in a given month)
+    starts at the yield of its month, which starts at 1/2. As candidates are classified,
+    the yields of both the tile and its month are updated, so tiles of months without
+    fires are quickly given less weight, without ever being ruled out.
+    Args:
+        hits: the hits (tiles) of the sampler.
+        prior: number of candidates that the month yield counts for in each tile.
+    """
+
+    def __init__(self, hits: List[Any], prior: float = 10.0) -> None:
+
+        self.prior = prior
+
+        # Tiles starting at the same time belong to the same month
+        _, self.month = np.unique([hit.bounds[4] for hit in hits], return_inverse=True)
+        self.candidates = np.zeros(len(hits))
+        self.burned = np.zeros(len(hits))
+
+    def yields(self) -> np.ndarray:
+        """Returns the estimated burn yield of every tile."""
+
+        month_candidates = np.bincount(self.month, self.candidates)
+        month_burned = np.bincount(self.month, self.burned)
+        month_yield = (month_burned + 1) / (month_candidates + 2)
+
+        return (self.burned + self.prior * month_yield[self.month]) / (
+            self.candidates + self.prior
+        )
+
+    def choose(self, generator: np.random.Generator) -> int:
+        """Returns a random tile (index), weighted by burn yield."""
+
+        weights = self.yields()
+        return int(generator.choice(len(weights), p=weights / weights.sum()))
+
+    def update(self, tile: int, candidates: int, burned: int) -> None:
+        """Records that 'burned' of 'candidates' samples drawn from a tile burned."""
+
+        self.candidates[tile] += candidates
+        self.burned[tile] += burned
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Returns the yields learned so far."""
+
+        return {"candidates": self.candidates.copy(), "burned": self.burned.copy()}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """Restores yields returned by state_dict."""
+
+        self.candidates = np.array(state_dict["candidates"], dtype=float)
+        self.burned = np.array(state_dict["burned"], dtype=float)
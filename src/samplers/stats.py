@@ -0,0 +1,67 @@
+from typing import Dict
+
+
+class SamplerStats:
+    """Counters and timers describing the work done by a batch sampler.
+
+    The sampler updates these while drawing batches, and resets them at the start of
+    every epoch, so that the cost of an epoch can be broken down into:
+        - candidates: candidate samples drawn (and classified)
+        - burned / not_burned: candidates accepted into a batch as burned / not burned
+        - tile_switches: times a new tile was picked within a batch
+        - reads: dataset reads made by the sampler itself (not the DataLoader)
+        - time: wall time spent drawing batches, in seconds
+    """
+
+    counters = (
+        "batches",
+        "candidates",
+        "burned",
+        "not_burned",
+        "tile_switches",
+        "reads",
+    )
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        """Sets all counters and timers to zero."""
+
+        for counter in self.counters:
+            setattr(self, counter, 0)
+        self.time = 0.0
+
+    def add_batch(self, time: float) -> None:
+        """Records a batch that took 'time' seconds to draw."""
+
+        self.batches += 1
+        self.time += time
+
+    @property
+    def acceptance_rate(self) -> float:
+        """Returns the proportion of candidates that were accepted into a batch."""
+
+        accepted = self.burned + self.not_burned
+        return accepted / self.candidates if self.candidates > 0 else 0.0
+
+    def as_dict(self, prefix: str = "sampler/") -> Dict[str, float]:
+        """Returns the stats (totals and per batch averages) to log.
+
+        Args:
+            prefix: prepended to the name of every stat.
+        """
+
+        stats = {counter: getattr(self, counter) for counter in self.counters}
+        stats["time"] = self.time
+        stats["acceptance_rate"] = self.acceptance_rate
+
+        batches = max(self.batches, 1)
+        for name in ("candidates", "tile_switches", "reads", "time"):
+            stats[f"{name}_per_batch"] = stats[name] / batches
+
+        return {prefix + name: float(value) for name, value in stats.items()}
+
+    def __repr__(self) -> str:
+        stats = ", ".join(f"{k}={v:.4g}" for k, v in self.as_dict("").items())
+        return f"SamplerStats({stats})"
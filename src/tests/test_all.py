@@ -3,11 +3,13 @@ import unittest
 from src.tests import test_data
 from src.tests import test_preprocessing
 from src.tests import test_models
+from src.tests import test_samplers
 
 suites = []
 suites.append(test_data.suite)
 suites.append(test_preprocessing.suite)
 suites.append(test_models.suite)
+suites.append(test_samplers.suite)
 
 suite = unittest.TestSuite(suites)
 
@@ -1,4 +1,40 @@
+import math
+import os
+import tempfile
 import unittest
+import warnings
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torchgeo.datasets import BoundingBox, stack_samples
+
+from src.datamodules.collate import BatchCollator, random_samples
+from src.datamodules.landcover import MODISJDLandcoverSimpleDataModule
+from src.datasets import (
+    ChipDataset,
+    CoalescingReader,
+    ConcurrentReader,
+    ERA5LandCube,
+    ERA5SnowC,
+    ERA5T2M,
+    GridSweepReader,
+    LandcoverSimple,
+    MODIS_JD,
+    Sentinel2,
+    Sentinel2Stacked,
+)
+from src.datasets.geo import PixelGrid
+from src.datasets.utils import stack_sentinel_bands
+from src.samplers import SnappedGridGeoSampler
+from src.tests.utils import (
+    ERA5_NAN_CELL,
+    ERA5_ORIGIN,
+    ERA5_RES,
+    ERA5_SHAPE,
+    LANDCOVER_ORIGIN,
+    LANDCOVER_RES,
+    make_roots,
+)
 
 
 class TestCase(unittest.TestCase):
@@ -6,4 +42,514 @@ class TestCase(unittest.TestCase):
         self.assertEqual("foo".upper(), "FOO")
 
 
-suite = unittest.TestLoader().loadTestsFromTestCase(TestCase)
+def scale_image(sample):
+    """Transform of the tests, so that transformed samples differ from raw ones."""
+
+    sample["image"] = sample["image"].float() / 10
+    return sample
+
+
+class DataTestCase(unittest.TestCase):
+    """Builds landcover & modis & sentinel from small synthetic roots, shared by the
+    tests."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.roots = make_roots(cls.tmp.name)
+        cls.landcover = LandcoverSimple(cls.roots["landcover"], transforms=scale_image)
+        cls.modis = MODIS_JD(cls.roots["modis"], cls.landcover.crs, cls.landcover.res)
+        cls.sentinel = Sentinel2(
+            cls.roots["sentinel"], cls.landcover.crs, cls.landcover.res
+        )
+        cls.dataset = cls.landcover & cls.modis & cls.sentinel
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def grid_boxes(self, n, size=32, seed=0):
+        """Returns random boxes of size x size landcover pixels, on the landcover grid,
+        within the area every source covers in the first month."""
+
+        rng = np.random.default_rng(seed)
+        hit = next(iter(self.dataset.index.intersection(self.dataset.bounds, True)))
+        x0, y0 = LANDCOVER_ORIGIN
+        boxes = []
+        for col, row in rng.integers(0, 250 - size, (n, 2)):
+            minx, maxy = x0 + col * LANDCOVER_RES, y0 - row * LANDCOVER_RES
+            boxes.append(
+                BoundingBox(
+                    minx,
+                    minx + size * LANDCOVER_RES,
+                    maxy - size * LANDCOVER_RES,
+                    maxy,
+                    *hit.bounds[4:],
+                )
+            )
+        return boxes
+
+    def assertSamplesEqual(self, sample, expected):
+        for key in ["image", "mask"]:
+            self.assertEqual(sample[key].dtype, expected[key].dtype)
+            torch.testing.assert_close(sample[key], expected[key], rtol=0, atol=0)
+        self.assertEqual(sample["bbox"], expected["bbox"])
+
+
+class TestChipDataset(DataTestCase):
+    def test_chips(self):
+        boxes = self.grid_boxes(12)
+        array = np.array([tuple(box) for box in boxes])
+        root = os.path.join(self.tmp.name, "chips")
+        chips = ChipDataset.build(self.dataset, array, root, "fingerprint")
+
+        self.assertEqual(len(chips), len(boxes))
+        for i, box in enumerate(boxes):
+            expected = self.dataset[box]
+            self.assertSamplesEqual(chips[box], expected)
+            self.assertSamplesEqual(chips[i], expected)
+
+        # The store is reused as long as the fingerprint matches
+        mtime = os.path.getmtime(os.path.join(root, "source_0.npy"))
+        ChipDataset.build(self.dataset, array, root, "fingerprint")
+        self.assertEqual(os.path.getmtime(os.path.join(root, "source_0.npy")), mtime)
+
+    def test_missing_box(self):
+        boxes = self.grid_boxes(2)
+        root = os.path.join(self.tmp.name, "missing")
+        chips = ChipDataset.build(self.dataset, np.array([tuple(boxes[0])]), root)
+        with self.assertRaises(IndexError):
+            chips[boxes[1]]
+
+
+class ReaderTestCase(DataTestCase):
+    def batch_boxes(self, month=0, size=32):
+        """Returns boxes of a batch: nearby patches on the landcover grid, one off the
+        grid, and one past the edge of the Sentinel tile of the second month."""
+
+        hits = self.dataset.index.intersection(self.dataset.bounds, objects=True)
+        mint, maxt = sorted({tuple(hit.bounds[4:]) for hit in hits})[month]
+        x0, y0 = LANDCOVER_ORIGIN
+        boxes = []
+        for col, row in [(60, 60), (70, 65), (80, 80), (65, 90), (150, 40), (260, 100)]:
+            minx, maxy = x0 + col * LANDCOVER_RES, y0 - row * LANDCOVER_RES
+            boxes.append(
+                BoundingBox(
+                    minx,
+                    minx + size * LANDCOVER_RES,
+                    maxy - size * LANDCOVER_RES,
+                    maxy,
+                    mint,
+                    maxt,
+                )
+            )
+        shift = LANDCOVER_RES / 3
+        box = boxes[0]
+        boxes.append(BoundingBox(box.minx + shift, box.maxx + shift, *box[2:]))
+        return boxes
+
+
+class TestCoalescingReader(ReaderTestCase):
+    def test_samples(self):
+        for read_threads in [0, 2]:
+            reader = CoalescingReader(self.dataset, read_threads=read_threads)
+            for month in [0, 1]:
+                boxes = self.batch_boxes(month)
+                for sample, box in zip(reader[boxes], boxes):
+                    self.assertSamplesEqual(sample, self.dataset[box])
+
+    def test_coalesced(self):
+        reader = CoalescingReader(self.dataset)
+        modis = reader.leaves[1]
+        merge_files = modis._merge_files
+        reads = []
+
+        def count_reads(filepaths, query):
+            reads.append(query)
+            return merge_files(filepaths, query)
+
+        boxes = self.batch_boxes()
+        modis._merge_files = count_reads
+        try:
+            reader[boxes]
+        finally:
+            del modis._merge_files
+        # The nearby patches are read together
+        self.assertLess(len(reads), len(boxes))
+
+    def test_missing_box(self):
+        box = self.batch_boxes()[0]
+        outside = BoundingBox(box.minx - 1, box.maxx - 1, *box[2:])
+        with self.assertRaises(IndexError):
+            CoalescingReader(self.dataset)[[box, outside]]
+
+
+class TestGridSweepReader(ReaderTestCase):
+    def test_samples(self):
+        sampler = SnappedGridGeoSampler(self.dataset, 40, 16)
+        reader = GridSweepReader(self.dataset, sampler, block_size=64)
+        samples = list(reader)
+        self.assertEqual(len(samples), len(sampler))
+        self.assertGreater(len(reader.blocks()), 1)
+
+        # Every patch of the sampler, block by block
+        expected = {tuple(box): box for box in sampler}
+        self.assertEqual({tuple(s["bbox"]) for s in samples}, set(expected))
+        for sample in samples:
+            self.assertSamplesEqual(
+                sample, self.dataset[expected[tuple(sample["bbox"])]]
+            )
+
+    def test_workers(self):
+        sampler = SnappedGridGeoSampler(self.dataset, 40, 16)
+        batch_size = 5
+        self.assertNotEqual(len(sampler) % batch_size, 0)
+        reader = GridSweepReader(self.dataset, sampler, 64, batch_size)
+        expected = [sample["bbox"] for sample in reader]
+
+        # Workers take whole batches in turn, so the length holds with the same order
+        loader = DataLoader(
+            reader, batch_size=batch_size, num_workers=2, collate_fn=stack_samples
+        )
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            batches = list(loader)
+        messages = [str(warning.message) for warning in caught]
+        self.assertFalse([m for m in messages if "Length of IterableDataset" in m])
+        self.assertEqual(len(batches), len(loader))
+        self.assertEqual(len(loader), math.ceil(len(sampler) / batch_size))
+        self.assertEqual([box for batch in batches for box in batch["bbox"]], expected)
+
+
+class TestConcurrentReader(ReaderTestCase):
+    def test_samples(self):
+        reader = ConcurrentReader(self.dataset, read_threads=3)
+        for month in [0, 1]:
+            for box in self.batch_boxes(month):
+                self.assertSamplesEqual(reader[box], self.dataset[box])
+
+    def test_missing_box(self):
+        box = self.batch_boxes()[0]
+        with self.assertRaises(IndexError):
+            ConcurrentReader(self.dataset)[
+                BoundingBox(box.minx - 1, box.maxx - 1, *box[2:])
+            ]
+
+
+class TestCachedIndex(DataTestCase):
+    def entries(self, dataset):
+        hits = dataset.index.intersection(dataset.index.bounds, objects=True)
+        return sorted((hit.id, tuple(hit.bounds), hit.object) for hit in hits)
+
+    def test_reload(self):
+        # The datasets of the class were built fresh, saving their index sidecars
+        grid = (self.landcover.crs, self.landcover.res)
+        for built, (crs, res) in [
+            (self.landcover, (None, None)),
+            (self.modis, grid),
+            (self.sentinel, grid),
+        ]:
+            path, key = built.get_index_path(built.root, crs, res)
+            self.assertTrue(os.path.exists(path))
+
+            reloaded = type(built)(built.root, crs, res)
+            self.assertIsNotNone(reloaded.load_index(path, key))
+            self.assertEqual(reloaded.crs, built.crs)
+            self.assertEqual(reloaded.res, built.res)
+            self.assertEqual(reloaded.cmap, built.cmap)
+            self.assertEqual(self.entries(reloaded), self.entries(built))
+
+    def test_stale_index(self):
+        path, key = self.modis.get_index_path(
+            self.modis.root, self.modis.crs, self.modis.res
+        )
+        filepath = self.entries(self.modis)[0][2]
+        stat = os.stat(filepath)
+        try:
+            os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            _, changed = self.modis.get_index_path(
+                self.modis.root, self.modis.crs, self.modis.res
+            )
+            self.assertNotEqual(changed, key)
+            self.assertIsNone(self.modis.load_index(path, changed))
+        finally:
+            os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+class TestRasterCache(DataTestCase):
+    def test_share_memory(self):
+        shared = LandcoverSimple(self.roots["landcover"]).share_memory()
+        plain = LandcoverSimple(self.roots["landcover"])
+        self.assertTrue(shared.shared_data.is_shared())
+        for box in self.grid_boxes(10) + [self.landcover.bounds]:
+            torch.testing.assert_close(
+                shared[box]["image"], plain[box]["image"], rtol=0, atol=0
+            )
+
+    def test_block_cache(self):
+        crs, res = self.landcover.crs, self.landcover.res
+        grid = PixelGrid.from_dataset(self.landcover)
+        for cls, root in [(MODIS_JD, "modis"), (Sentinel2, "sentinel")]:
+            plain = cls(self.roots[root], crs, res)
+            # Small enough for blocks to be evicted while reading
+            cached = cls(self.roots[root], crs, res)
+            cached.enable_block_cache(2**16, blocksize=48, grid=grid)
+
+            key = "image" if cls.is_image else "mask"
+            boxes = self.grid_boxes(20, size=40) + self.grid_boxes(5, size=40, seed=1)
+            for box in boxes + boxes[:5]:
+                torch.testing.assert_close(
+                    cached[box][key], plain[box][key], rtol=0, atol=0
+                )
+            self.assertGreater(len(cached.block_cache), 0)
+            self.assertLessEqual(cached.block_cache_bytes, 2**16)
+
+            # Boxes off the grid are read as usual
+            box = boxes[0]
+            shifted = BoundingBox(box.minx + res / 3, box.maxx + res / 3, *box[2:])
+            torch.testing.assert_close(
+                cached[shifted][key], plain[shifted][key], rtol=0, atol=0
+            )
+
+
+class DataModuleTestCase(unittest.TestCase):
+    """Loads batches of the landcover datamodule from small synthetic roots."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.roots = make_roots(cls.tmp.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def batches(self, num_batches=3, **kwargs):
+        """Returns the first training batches of a datamodule, as given to a model on
+        the CPU."""
+
+        datamodule = MODISJDLandcoverSimpleDataModule(
+            self.roots["modis"],
+            self.roots["landcover"],
+            self.roots["sentinel"],
+            batch_size=4,
+            length=4 * num_batches,
+            patch_size=32,
+            seed=0,
+            **kwargs,
+        )
+        datamodule.setup()
+        device = torch.device("cpu")
+        return [
+            datamodule.on_after_batch_transfer(
+                datamodule.transfer_batch_to_device(batch, device, 0), 0
+            )
+            for batch in datamodule.train_dataloader()
+        ]
+
+    def assertBatchesEqual(self, batches, expected, atol=0.0):
+        self.assertEqual(len(batches), len(expected))
+        for batch, other in zip(batches, expected):
+            for key in ["image", "mask"]:
+                self.assertEqual(batch[key].dtype, other[key].dtype)
+                torch.testing.assert_close(
+                    batch[key], other[key], rtol=0, atol=atol, equal_nan=True
+                )
+
+
+class TestLandcoverOnDevice(DataModuleTestCase):
+    def test_batches(self):
+        for one_hot_encode in [False, True]:
+            expected = self.batches(one_hot_encode=one_hot_encode)
+            batches = self.batches(
+                one_hot_encode=one_hot_encode, landcover_on_device=True
+            )
+            self.assertBatchesEqual(batches, expected)
+
+
+class TestCompactDtypes(DataModuleTestCase):
+    def test_batches(self):
+        for one_hot_encode in [False, True]:
+            expected = self.batches(one_hot_encode=one_hot_encode)
+            batches = self.batches(one_hot_encode=one_hot_encode, compact_dtypes=True)
+            # Sentinel bands are stored to 1 / 65535 (see Sentinel2.compact_scale)
+            self.assertBatchesEqual(batches, expected, atol=0.5 / 65535)
+
+
+class TestBatchCollator(DataModuleTestCase):
+    def test_collate(self):
+        collator = BatchCollator(ring_size=2)
+        batches = []
+        for i in range(5):
+            samples = random_samples(4, 16)
+            expected = stack_samples(samples)
+            batch = collator(samples)
+            for key in ["image", "mask"]:
+                self.assertEqual(batch[key].dtype, expected[key].dtype)
+                torch.testing.assert_close(batch[key], expected[key], rtol=0, atol=0)
+            batches.append(batch)
+
+        # The buffers are used in turn
+        self.assertEqual(batches[0]["image"].data_ptr(), batches[2]["image"].data_ptr())
+        self.assertNotEqual(
+            batches[0]["image"].data_ptr(), batches[1]["image"].data_ptr()
+        )
+
+    def test_cpu_batches(self):
+        expected = self.batches()
+        with self.assertWarns(UserWarning):
+            batches = self.batches(collate_buffers=2)
+        # Batches are copied out of their buffers, so they are not overwritten
+        self.assertBatchesEqual(batches, expected)
+
+
+class TestSentinel2Stacked(DataTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        root = os.path.join(cls.tmp.name, "stacked")
+        stack_sentinel_bands(cls.roots["sentinel"], root)
+        cls.stacked = Sentinel2Stacked(root, cls.landcover.crs, cls.landcover.res)
+
+    def box(self, col, row, size, month):
+        """Returns a box of size x size landcover pixels, in a month of Sentinel."""
+
+        hits = self.sentinel.index.intersection(self.sentinel.bounds, objects=True)
+        mint, maxt = sorted({tuple(hit.bounds[4:]) for hit in hits})[month]
+        x0, y0 = LANDCOVER_ORIGIN
+        minx, maxy = x0 + col * LANDCOVER_RES, y0 - row * LANDCOVER_RES
+        return BoundingBox(
+            minx,
+            minx + size * LANDCOVER_RES,
+            maxy - size * LANDCOVER_RES,
+            maxy,
+            mint,
+            maxt,
+        )
+
+    def test_reads(self):
+        # Within a tile, and across the two tiles of the first month
+        for col, row, month in [(10, 10, 0), (200, 50, 1), (240, 100, 0)]:
+            box = self.box(col, row, 64, month)
+            torch.testing.assert_close(
+                self.stacked[box]["image"], self.sentinel[box]["image"], rtol=0, atol=0
+            )
+
+    def test_tile_edge(self):
+        # The only tile of the second month ends 275 pixels from the landcover origin
+        box = self.box(240, 100, 64, 1)
+        image = self.stacked[box]["image"]
+        self.assertEqual(tuple(image.shape), (3, 64, 64))
+
+        edge = LANDCOVER_ORIGIN[0] + 275 * LANDCOVER_RES
+        inside = self.sentinel[BoundingBox(box.minx, edge, *box[2:])]
+        torch.testing.assert_close(image[:, :, :35], inside["image"], rtol=0, atol=0)
+        self.assertTrue((image[:, :, 35:] == Sentinel2Stacked.nodata).all())
+
+
+class TestERA5LandCube(DataTestCase):
+    variables = [("snowc", ERA5SnowC), ("t2m", ERA5T2M)]
+
+    def make_cube(self, **kwargs):
+        return ERA5LandCube(
+            self.roots["era5"], variables=[name for name, _ in self.variables], **kwargs
+        )
+
+    def months(self):
+        hits = ERA5SnowC(self.roots["era5"]).index.intersection(
+            (-180, 180, -90, 90, 0, 2**40), objects=True
+        )
+        return sorted(tuple(hit.bounds[4:]) for hit in hits)
+
+    def cell_box(self, row, col, height, width, month):
+        """Returns the box of a window of cells of the ERA5 grid."""
+
+        x0, y0 = ERA5_ORIGIN
+        return BoundingBox(
+            x0 + col * ERA5_RES,
+            x0 + (col + width) * ERA5_RES,
+            y0 - (row + height) * ERA5_RES,
+            y0 - row * ERA5_RES,
+            *month,
+        )
+
+    def test_grid_reads(self):
+        datasets = [cls(self.roots["era5"]) for _, cls in self.variables]
+        rng = np.random.default_rng(0)
+        for mode in ["bilinear", "nearest"]:
+            cube = self.make_cube(mode=mode)
+            for month in self.months():
+                # The whole grid (with its NaN cell) and random windows of it
+                boxes = [self.cell_box(0, 0, *ERA5_SHAPE, month)]
+                for _ in range(5):
+                    height, width = rng.integers(1, 5, 2)
+                    row = rng.integers(0, ERA5_SHAPE[0] - height + 1)
+                    col = rng.integers(0, ERA5_SHAPE[1] - width + 1)
+                    boxes.append(self.cell_box(row, col, height, width, month))
+
+                for box in boxes:
+                    expected = torch.cat([ds[box]["image"] for ds in datasets])
+                    torch.testing.assert_close(
+                        cube[box]["image"], expected, atol=1e-6, rtol=0, equal_nan=True
+                    )
+
+    def test_missing_data(self):
+        # Upsampled 4 times, over the grid and one cell around it
+        cube = self.make_cube(res=ERA5_RES / 4)
+        grid = torch.from_numpy(cube.data[0])
+        box = self.cell_box(
+            -1, -1, ERA5_SHAPE[0] + 2, ERA5_SHAPE[1] + 2, self.months()[0]
+        )
+        image = cube[box]["image"]
+        self.assertEqual(image.shape, (2, 4 * ERA5_SHAPE[0] + 8, 4 * ERA5_SHAPE[1] + 8))
+
+        # Pixel centres in (fractional) cells of the grid
+        rows = (np.arange(image.shape[1]) + 0.5) / 4 - 1.5
+        cols = (np.arange(image.shape[2]) + 0.5) / 4 - 1.5
+        inside = ((rows > -0.5) & (rows < ERA5_SHAPE[0] - 0.5))[:, None] & (
+            (cols > -0.5) & (cols < ERA5_SHAPE[1] - 0.5)
+        )[None, :]
+        nan_cell = (np.round(rows) == ERA5_NAN_CELL[0])[:, None] & (
+            np.round(cols) == ERA5_NAN_CELL[1]
+        )[None, :]
+        missing = torch.from_numpy(~inside | nan_cell).expand_as(image)
+        torch.testing.assert_close(torch.isnan(image), missing)
+
+        # Other pixels are interpolated from the valid cells around them only
+        r0 = np.clip(np.floor(rows), 0, ERA5_SHAPE[0] - 1).astype(int)
+        c0 = np.clip(np.floor(cols), 0, ERA5_SHAPE[1] - 1).astype(int)
+        r1 = np.minimum(r0 + 1, ERA5_SHAPE[0] - 1)
+        c1 = np.minimum(c0 + 1, ERA5_SHAPE[1] - 1)
+        dr = torch.from_numpy(np.clip(rows - r0, 0, 1))[:, None].float()
+        dc = torch.from_numpy(np.clip(cols - c0, 0, 1))[None, :].float()
+        values, weights = 0, 0
+        for r, c, weight in [
+            (r0, c0, (1 - dr) * (1 - dc)),
+            (r0, c1, (1 - dr) * dc),
+            (r1, c0, dr * (1 - dc)),
+            (r1, c1, dr * dc),
+        ]:
+            corner = grid[:, r][:, :, c]
+            valid = ~torch.isnan(corner)
+            values = values + torch.where(valid, corner, 0.0) * weight
+            weights = weights + valid * weight
+        expected = (values / weights).masked_fill(missing, float("nan"))
+        torch.testing.assert_close(image, expected, atol=1e-5, rtol=0, equal_nan=True)
+
+
+suite = unittest.TestSuite(
+    [
+        unittest.TestLoader().loadTestsFromTestCase(TestCase),
+        unittest.TestLoader().loadTestsFromTestCase(TestChipDataset),
+        unittest.TestLoader().loadTestsFromTestCase(TestCoalescingReader),
+        unittest.TestLoader().loadTestsFromTestCase(TestGridSweepReader),
+        unittest.TestLoader().loadTestsFromTestCase(TestConcurrentReader),
+        unittest.TestLoader().loadTestsFromTestCase(TestCachedIndex),
+        unittest.TestLoader().loadTestsFromTestCase(TestRasterCache),
+        unittest.TestLoader().loadTestsFromTestCase(TestSentinel2Stacked),
+        unittest.TestLoader().loadTestsFromTestCase(TestERA5LandCube),
+        unittest.TestLoader().loadTestsFromTestCase(TestLandcoverOnDevice),
+        unittest.TestLoader().loadTestsFromTestCase(TestCompactDtypes),
+        unittest.TestLoader().loadTestsFromTestCase(TestBatchCollator),
+    ]
+)
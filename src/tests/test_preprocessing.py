@@ -1,4 +1,18 @@
+import os
+import shutil
+import tempfile
 import unittest
+import numpy as np
+import rasterio
+import torch
+import torch.nn.functional as F
+from torchgeo.datasets import BoundingBox
+
+from src.datasets import LandcoverSimple, MODIS_JD
+from src.preprocessing import OneHotEncode, dequantize, one_hot, quantize
+from src.preprocessing.align import align_dataset
+from src.preprocessing.cog import convert_file, convert_root, get_blocksize, is_cog
+from src.tests.utils import LANDCOVER_ORIGIN, LANDCOVER_RES, LANDCOVER_SHAPE, make_roots
 
 
 class TestCase(unittest.TestCase):
@@ -6,4 +20,243 @@ class TestCase(unittest.TestCase):
         self.assertEqual("foo".upper(), "FOO")
 
 
-suite = unittest.TestLoader().loadTestsFromTestCase(TestCase)
+def one_hot_reference(mask, num_classes):
+    """One-hot encodes a (batch, 1, height, width) mask as OneHotEncode used to, one
+    band at a time."""
+
+    batch, _, height, width = mask.shape
+    encodings = F.one_hot(
+        mask.reshape(batch, height, width).to(torch.int64), num_classes
+    )
+    encoded = torch.zeros([batch, num_classes, height, width])
+    for band in range(num_classes):
+        encoded[:, band, :, :] = encodings[:, :, :, band]
+    return encoded.to(torch.int32)
+
+
+class TestOneHot(unittest.TestCase):
+    classes = {f"class_{i}": i for i in range(1, 10)}
+
+    def test_one_hot(self):
+        mask = torch.randint(
+            0, 9, (4, 1, 16, 24), generator=torch.Generator().manual_seed(0)
+        )
+        encoded = one_hot(mask, 9)
+        self.assertEqual(encoded.dtype, torch.uint8)
+        torch.testing.assert_close(
+            encoded.to(torch.int32), one_hot_reference(mask, 9), rtol=0, atol=0
+        )
+
+        # A single sample is encoded along its band dimension
+        torch.testing.assert_close(encoded[1], one_hot(mask[1], 9), rtol=0, atol=0)
+
+    def test_one_hot_encode(self):
+        mask = torch.randint(
+            1, 10, (4, 1, 16, 24), generator=torch.Generator().manual_seed(1)
+        )
+        expected = one_hot_reference(mask - 1, len(self.classes))
+        outputs = OneHotEncode(self.classes)({"mask": mask})
+        self.assertEqual(outputs["mask"].dtype, torch.int32)
+        torch.testing.assert_close(outputs["mask"], expected, rtol=0, atol=0)
+
+
+class TestQuantize(unittest.TestCase):
+    # Values are restored to half a step of 1 / scale, plus float32 rounding
+    tolerance = 0.501
+
+    def test_round_trip(self):
+        generator = torch.Generator().manual_seed(0)
+        for scale in [1, 100, 65535]:
+            values = torch.rand(3, 16, 16, generator=generator) * 65535 / scale
+            quantized = quantize(values, scale)
+            self.assertEqual(quantized.dtype, torch.int16)
+            torch.testing.assert_close(
+                dequantize(quantized, scale),
+                values,
+                rtol=0,
+                atol=self.tolerance / scale,
+            )
+
+    def test_band_scales(self):
+        scales = torch.tensor([1.0, 100.0, 65535.0]).view(-1, 1, 1)
+        values = torch.rand(3, 16, 16, generator=torch.Generator().manual_seed(1))
+        values = values * 65535 / scales
+        restored = dequantize(quantize(values, scales), scales)
+        torch.testing.assert_close(
+            restored, values, rtol=0, atol=float(self.tolerance / scales.min())
+        )
+        for band in range(3):
+            torch.testing.assert_close(
+                quantize(values, scales)[band],
+                quantize(values[band], float(scales[band])),
+                rtol=0,
+                atol=0,
+            )
+
+    def test_out_of_range(self):
+        values = torch.tensor([-1.0, float("nan"), 0.0, 1.0, 2.0])
+        restored = dequantize(quantize(values, 65535), 65535)
+        torch.testing.assert_close(
+            restored, torch.tensor([0.0, 0.0, 0.0, 1.0, 1.0]), rtol=0, atol=0
+        )
+
+
+class TestAlign(unittest.TestCase):
+    """Aligns the synthetic MODIS root onto the landcover grid."""
+
+    # Grid of the synthetic MODIS files
+    modis_origin = (26.99, 51.61)
+    modis_res = 0.0025
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.roots = make_roots(cls.tmp.name)
+        cls.landcover = LandcoverSimple(cls.roots["landcover"])
+        cls.modis = MODIS_JD(cls.roots["modis"], cls.landcover.crs, cls.landcover.res)
+        align_dataset(MODIS_JD, cls.roots["modis"], cls.landcover, 64, workers=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def untied(self, start, count, origin, sign):
+        """Returns which landcover pixel centres, along an axis, do not lie on a MODIS
+        pixel edge (where nearest resampling may pick either neighbour)."""
+
+        centres = start + sign * (np.arange(count) + 0.5) * LANDCOVER_RES
+        position = (centres - origin) / self.modis_res
+        return np.abs(position - np.round(position)) > 1e-6
+
+    def test_aligned_reads(self):
+        aligned = MODIS_JD(self.roots["modis"], self.landcover.crs, self.landcover.res)
+        self.assertTrue(aligned.aligned)
+        self.assertFalse(self.modis.aligned)
+
+        x0, y0 = LANDCOVER_ORIGIN
+        size = 64
+        rng = np.random.default_rng(0)
+        for hit in self.modis.index.intersection(self.modis.bounds, objects=True):
+            for col, row in rng.integers(0, LANDCOVER_SHAPE[0] - size, (5, 2)):
+                minx, maxy = x0 + col * LANDCOVER_RES, y0 - row * LANDCOVER_RES
+                box = BoundingBox(
+                    minx,
+                    minx + size * LANDCOVER_RES,
+                    maxy - size * LANDCOVER_RES,
+                    maxy,
+                    *hit.bounds[4:],
+                )
+                expected = self.modis[box]["mask"]
+                sample = aligned[box]["mask"]
+                self.assertEqual(sample.shape, expected.shape)
+
+                rows = self.untied(maxy, size, self.modis_origin[1], -1)
+                cols = self.untied(minx, size, self.modis_origin[0], 1)
+                keep = torch.from_numpy(rows[:, None] & cols[None, :])
+                torch.testing.assert_close(
+                    sample[..., keep], expected[..., keep], rtol=0, atol=0
+                )
+
+    def test_stale_store(self):
+        hits = self.modis.index.intersection(self.modis.bounds, objects=True)
+        filepath = next(iter(hits)).object
+        stat = os.stat(filepath)
+        try:
+            os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            with self.assertWarns(UserWarning):
+                stale = MODIS_JD(
+                    self.roots["modis"], self.landcover.crs, self.landcover.res
+                )
+            self.assertFalse(stale.aligned)
+        finally:
+            os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+class TestCog(unittest.TestCase):
+    """Converts the synthetic landcover and MODIS roots to COGs."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.roots = make_roots(self.tmp.name)
+        self.landcover = os.path.join(self.roots["landcover"], "Polesia_Simple.tif")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def assertCog(self, path, src_path, blocksize):
+        with rasterio.open(path) as dst, rasterio.open(src_path) as src:
+            self.assertTrue(dst.profile["tiled"])
+            self.assertEqual(dst.compression.name.lower(), "deflate")
+            self.assertEqual(set(dst.block_shapes), {(blocksize, blocksize)})
+            # Rasters within a single tile need no overviews
+            if max(dst.width, dst.height) > blocksize:
+                self.assertGreater(len(dst.overviews(1)), 0)
+            self.assertEqual(dst.transform, src.transform)
+            np.testing.assert_array_equal(dst.read(), src.read())
+
+    def test_get_blocksize(self):
+        # Half the patch size, as a power of two between 128 and 512
+        for patch_size, blocksize in [
+            (0, 128),
+            (64, 128),
+            (256, 128),
+            (512, 256),
+            (600, 256),
+            (1024, 512),
+            (4096, 512),
+        ]:
+            self.assertEqual(get_blocksize(patch_size), blocksize)
+
+    def test_convert_file(self):
+        dst_path = os.path.join(self.tmp.name, "cog", "landcover.tif")
+        self.assertFalse(is_cog(self.landcover, 128))
+        self.assertEqual(convert_file(self.landcover, dst_path, 128), "converted")
+        self.assertCog(dst_path, self.landcover, 128)
+        self.assertTrue(is_cog(dst_path, 128))
+
+        # A COG with the same layout is not written again, but another layout is
+        mtime = os.path.getmtime(dst_path)
+        self.assertEqual(convert_file(self.landcover, dst_path, 128), "skipped")
+        self.assertEqual(os.path.getmtime(dst_path), mtime)
+        self.assertEqual(convert_file(self.landcover, dst_path, 256), "converted")
+        self.assertCog(dst_path, self.landcover, 256)
+
+    def test_convert_in_place(self):
+        original = os.path.join(self.tmp.name, "original.tif")
+        shutil.copy(self.landcover, original)
+        self.assertEqual(convert_file(self.landcover, self.landcover), "converted")
+        self.assertCog(self.landcover, original, 256)
+        self.assertEqual(convert_file(self.landcover, self.landcover), "skipped")
+
+    def test_convert_root(self):
+        root = self.roots["modis"]
+        rasters = sorted(os.listdir(root))
+
+        # Sidecars are skipped, and a broken raster does not stop the others
+        with open(os.path.join(root, rasters[0] + ".aux.xml"), "w") as f:
+            f.write("<PAMDataset/>")
+        with open(os.path.join(root, "broken.tif"), "w") as f:
+            f.write("not a raster")
+
+        out = os.path.join(self.tmp.name, "cog")
+        counts = convert_root(root, out, blocksize=128, workers=2)
+        self.assertEqual(counts, {"converted": 2, "skipped": 0, "failed": 1})
+        self.assertEqual(sorted(os.listdir(out)), rasters)
+        for filename in rasters:
+            self.assertCog(
+                os.path.join(out, filename), os.path.join(root, filename), 128
+            )
+
+        counts = convert_root(root, out, blocksize=128, workers=2)
+        self.assertEqual(counts, {"converted": 0, "skipped": 2, "failed": 1})
+
+
+suite = unittest.TestSuite(
+    [
+        unittest.TestLoader().loadTestsFromTestCase(TestCase),
+        unittest.TestLoader().loadTestsFromTestCase(TestOneHot),
+        unittest.TestLoader().loadTestsFromTestCase(TestQuantize),
+        unittest.TestLoader().loadTestsFromTestCase(TestAlign),
+        unittest.TestLoader().loadTestsFromTestCase(TestCog),
+    ]
+)
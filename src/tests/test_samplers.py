@@ -0,0 +1,856 @@
+import math
+import os
+import tempfile
+import time
+import unittest
+import numpy as np
+import rasterio
+import torch
+from rasterio.merge import merge
+from torchgeo.datasets import BoundingBox
+from torchgeo.samplers.constants import Units
+
+from src.datasets import (
+    CoalescingReader,
+    ConcurrentReader,
+    LabelledReader,
+    LandcoverSimple,
+    MODIS_JD,
+    Sentinel2,
+)
+from src.datasets.geo import LabelledBoundingBox, PixelGrid
+from src.samplers import (
+    AdaptiveConstrainedRandomBatchGeoSampler,
+    BurnIndex,
+    BurnWeightedBatchGeoSampler,
+    CatalogueBatchGeoSampler,
+    ConstrainedRandomBatchGeoSampler,
+    FootprintIndex,
+    PatchCatalogue,
+    PrefetchBatchSampler,
+    SampleCatalogue,
+    SeededRandomBatchGeoSampler,
+    SnappedGridGeoSampler,
+    StagedRandomBatchGeoSampler,
+    TileScheduler,
+    VectorizedConstrainedRandomBatchGeoSampler,
+)
+from src.tests.utils import make_roots
+
+
+class SamplerTestCase(unittest.TestCase):
+    """Builds landcover & modis from small synthetic roots, shared by the tests."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.roots = make_roots(cls.tmp.name)
+        cls.landcover = LandcoverSimple(cls.roots["landcover"])
+        cls.modis = MODIS_JD(cls.roots["modis"], cls.landcover.crs, cls.landcover.res)
+        cls.dataset = cls.landcover & cls.modis
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def random_boxes(self, n, seed=0):
+        """Returns random boxes of 8 to 80 landcover pixels within the landcover, in
+        each month of MODIS."""
+
+        rng = np.random.default_rng(seed)
+        bounds = self.landcover.bounds
+        res = self.landcover.res
+        boxes = []
+        for hit in self.modis.index.intersection(tuple(bounds), objects=True):
+            for _ in range(n):
+                width, height = rng.uniform(8, 80, 2) * res
+                minx = rng.uniform(bounds.minx, bounds.maxx - width)
+                miny = rng.uniform(bounds.miny, bounds.maxy - height)
+                mint, maxt = hit.bounds[4:]
+                boxes.append(
+                    (
+                        hit.object,
+                        BoundingBox(
+                            minx, minx + width, miny, miny + height, mint, maxt
+                        ),
+                    )
+                )
+        return boxes
+
+    def brute_force(self, filepath, box):
+        """Returns the burned and total counts of the MODIS pixels a box touches."""
+
+        with rasterio.open(filepath) as src:
+            burned = src.read(1) > 0
+            t = src.transform
+        x = t.c + np.arange(src.width + 1) * t.a
+        y = t.f + np.arange(src.height + 1) * t.e
+        # Pixels that only touch the box within rounding errors are not counted
+        eps = 1e-6 * t.a
+        cols = (x[:-1] < box.maxx - eps) & (x[1:] > box.minx + eps)
+        rows = (y[1:] < box.maxy - eps) & (y[:-1] > box.miny + eps)
+        return int(burned[np.ix_(rows, cols)].sum()), int(rows.sum() * cols.sum())
+
+    def modis_file(self, box):
+        """Returns the MODIS file of the month of a box."""
+
+        hits = self.modis.index.intersection(tuple(box), objects=True)
+        return next(iter(hits)).object
+
+
+class TestBurnIndex(SamplerTestCase):
+    def test_counts(self):
+        burn_index = BurnIndex(self.dataset)
+        burned = 0
+        for filepath, box in self.random_boxes(50):
+            counts = self.brute_force(filepath, box)
+            self.assertEqual(burn_index.burned_pixels(box), counts)
+            burned += counts[0] > 0
+        self.assertGreater(burned, 0)
+
+    def test_patch_counts(self):
+        burn_index = BurnIndex(self.dataset)
+        size = (20 * self.landcover.res, 30 * self.landcover.res)
+        for i, bounds in enumerate(burn_index.bounds):
+            minx, maxy, burned = burn_index.patch_counts(i, BoundingBox(*bounds), size)
+            x0, _, xres, yres = burn_index.origins[i]
+            for row, col in [(0, 0), (burned.shape[0] - 1, burned.shape[1] - 1)]:
+                left, top = minx + col * xres, maxy - row * yres
+                box = BoundingBox(left, left + size[1], top - size[0], top, *bounds[4:])
+                self.assertEqual(burned[row, col], burn_index.burned_pixels(box)[0])
+
+    def test_save_load(self):
+        burn_index = BurnIndex(self.dataset)
+        path = os.path.join(self.tmp.name, "burn_index.npz")
+        burn_index.save(path)
+        loaded = BurnIndex.load(path)
+
+        self.assertEqual(loaded.roi, burn_index.roi)
+        self.assertEqual(loaded.fingerprint, BurnIndex.get_fingerprint(self.dataset))
+        for _, box in self.random_boxes(10, seed=1):
+            self.assertEqual(loaded.burned_pixels(box), burn_index.burned_pixels(box))
+
+    def test_fingerprint(self):
+        fingerprint = BurnIndex.get_fingerprint(self.dataset)
+        hits = self.modis.index.intersection(self.modis.bounds, objects=True)
+        filepath = next(iter(hits)).object
+        stat = os.stat(filepath)
+        try:
+            os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            self.assertNotEqual(BurnIndex.get_fingerprint(self.dataset), fingerprint)
+        finally:
+            os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+class TestFootprintIndex(SamplerTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        crs, res = cls.landcover.crs, cls.landcover.res
+        cls.sentinel = Sentinel2(cls.roots["sentinel"], crs, res)
+        cls.images = cls.landcover & cls.modis & cls.sentinel
+        # One point per landcover pixel, so that the cells are exact
+        cls.footprint = FootprintIndex(cls.images, cell_size=8, samples=8)
+
+    def valid(self, box):
+        """Returns whether the landcover and Sentinel files (MODIS covers all of the
+        landcover) of the time range of a box have no nodata within it."""
+
+        bounds = (box.minx, box.miny, box.maxx, box.maxy)
+        for ds in [self.landcover, self.sentinel]:
+            hits = ds.index.intersection(tuple(box), objects=True)
+            sources = [rasterio.open(hit.object) for hit in hits]
+            if not sources:
+                return False
+            try:
+                # Merged here, as a read of a single file stretches it over the box
+                data, _ = merge(sources, bounds, ds.res, nodata=ds.nodata, indexes=[1])
+            finally:
+                for src in sources:
+                    src.close()
+            if (data == ds.nodata).any():
+                return False
+        return True
+
+    def cell_boxes(self, n, seed=0):
+        """Returns random boxes of 1 to 6 cells of the footprint, in each time range
+        of the dataset."""
+
+        rng = np.random.default_rng(seed)
+        x0, y0, cell = self.footprint.origin
+        rows, cols = self.footprint.occupied.shape[1:]
+        hits = self.images.index.intersection(self.images.bounds, objects=True)
+        boxes = []
+        for mint, maxt in sorted({tuple(hit.bounds[4:]) for hit in hits}):
+            for _ in range(n):
+                height, width = rng.integers(1, 7, 2)
+                row = rng.integers(0, rows - height + 1)
+                col = rng.integers(0, cols - width + 1)
+                boxes.append(
+                    BoundingBox(
+                        x0 + col * cell,
+                        x0 + (col + width) * cell,
+                        y0 - (row + height) * cell,
+                        y0 - row * cell,
+                        mint,
+                        maxt,
+                    )
+                )
+        return boxes
+
+    def test_bitmaps(self):
+        # Landcover for all times, and MODIS and Sentinel for each month
+        self.assertEqual(len(self.footprint.times), 3)
+        self.assertEqual(self.footprint.occupied.shape[0], 3)
+
+    def test_contains(self):
+        boxes = self.cell_boxes(100)
+        expected = [self.valid(box) for box in boxes]
+        self.assertTrue(any(expected))
+        self.assertFalse(all(expected))
+        for box, valid in zip(boxes, expected):
+            self.assertEqual(bool(self.footprint.contains(*box)), valid)
+
+        # Boxes of different months are checked at once
+        contains = self.footprint.contains(*np.array([tuple(b) for b in boxes]).T)
+        np.testing.assert_array_equal(contains, expected)
+
+    def test_months(self):
+        # The second Sentinel tile only exists in the first month
+        x0, y0, cell = self.footprint.origin
+        minx, maxy = x0 + 45 * cell, y0 - 15 * cell
+        hits = self.images.index.intersection(self.images.bounds, objects=True)
+        months = sorted({tuple(hit.bounds[4:]) for hit in hits})
+        self.assertEqual(len(months), 2)
+        inside = []
+        for mint, maxt in months:
+            box = BoundingBox(minx, minx + 2 * cell, maxy - 2 * cell, maxy, mint, maxt)
+            self.assertEqual(bool(self.footprint.contains(*box)), self.valid(box))
+            inside.append(bool(self.footprint.contains(*box)))
+        self.assertEqual(inside, [True, False])
+
+    def test_other_times(self):
+        x0, y0, cell = self.footprint.origin
+        box = BoundingBox(
+            x0 + 30 * cell,
+            x0 + 32 * cell,
+            y0 - 17 * cell,
+            y0 - 15 * cell,
+            *self.footprint.times[1],
+        )
+        self.assertTrue(self.footprint.contains(*box))
+
+        # Before all the files, and before or after the months of MODIS and Sentinel
+        # (where only the landcover has files)
+        for mint, maxt in [
+            (-(10**9), -(10**8)),
+            (0, box.mint - 10**7),
+            (box.maxt + 10**8, box.maxt + 10**9),
+        ]:
+            other = BoundingBox(*box[:4], mint, maxt)
+            self.assertFalse(self.valid(other))
+            self.assertFalse(self.footprint.contains(*other))
+            self.assertEqual(self.footprint.patch_positions(other, (cell, cell)), 0)
+
+    def test_patch_positions(self):
+        _, _, cell = self.footprint.origin
+        for hit in self.images.index.intersection(self.images.bounds, objects=True):
+            bounds = BoundingBox(*hit.bounds)
+            positions = self.footprint.patch_positions(bounds, (3 * cell, 2 * cell))
+
+            # Every position of the patch on the cell grid within the bounds
+            x0, y0, _ = self.footprint.origin
+            rows, cols = self.footprint.occupied.shape[1:]
+            row, col = np.mgrid[: rows - 2, : cols - 1].reshape(2, -1)
+            minx, maxy = x0 + col * cell, y0 - row * cell
+            coordinates = [minx, minx + 2 * cell, maxy - 3 * cell, maxy]
+            within = (
+                (coordinates[0] >= bounds.minx - 1e-9)
+                & (coordinates[1] <= bounds.maxx + 1e-9)
+                & (coordinates[2] >= bounds.miny - 1e-9)
+                & (coordinates[3] <= bounds.maxy + 1e-9)
+            )
+            contains = self.footprint.contains(*coordinates, bounds.mint, bounds.maxt)
+            self.assertGreater(positions, 0)
+            self.assertEqual(positions, int((contains & within).sum()))
+
+    def test_save_load(self):
+        path = os.path.join(self.tmp.name, "footprint.npz")
+        self.footprint.save(path)
+        loaded = FootprintIndex.load(path)
+        self.assertEqual(loaded.roi, self.footprint.roi)
+        self.assertEqual(loaded.origin, self.footprint.origin)
+        np.testing.assert_array_equal(loaded.times, self.footprint.times)
+        np.testing.assert_array_equal(loaded.sources, self.footprint.sources)
+
+        boxes = np.array([tuple(box) for box in self.cell_boxes(20, seed=1)]).T
+        np.testing.assert_array_equal(
+            loaded.contains(*boxes), self.footprint.contains(*boxes)
+        )
+
+
+class TestSeededRandomBatchGeoSampler(SamplerTestCase):
+    def make_sampler(self, **kwargs):
+        return SeededRandomBatchGeoSampler(self.dataset, 40, 8, 80, seed=0, **kwargs)
+
+    def test_shards(self):
+        for num_replicas in [1, 2, 3]:
+            samplers = [
+                self.make_sampler(rank=rank, num_replicas=num_replicas)
+                for rank in range(num_replicas)
+            ]
+            shards = []
+            for sampler in samplers:
+                batches = list(sampler)
+                self.assertEqual(len(sampler), 80 // 8 // num_replicas)
+                self.assertEqual(len(batches), len(sampler))
+                shards.append({tuple(box) for batch in batches for box in batch})
+
+            # Every rank draws its own samples
+            for i in range(num_replicas):
+                self.assertEqual(len(shards[i]), 8 * len(samplers[i]))
+                for j in range(i):
+                    self.assertFalse(shards[i] & shards[j])
+
+    def test_epochs(self):
+        sampler = self.make_sampler()
+        first, second = list(sampler), list(sampler)
+        self.assertNotEqual(first, second)
+
+        sampler.set_epoch(1)
+        self.assertEqual(list(sampler), second)
+        sampler.set_epoch(0)
+        self.assertEqual(list(sampler), first)
+
+    def test_resume(self):
+        sampler = self.make_sampler()
+        sampler.set_epoch(3)
+        expected = list(sampler)
+
+        sampler.set_epoch(3)
+        batches = iter(sampler)
+        for _ in range(4):
+            next(batches)
+        state_dict = sampler.state_dict()
+
+        resumed = self.make_sampler()
+        resumed.load_state_dict(state_dict)
+        self.assertEqual(list(resumed), expected[4:])
+
+        # The next epoch is whole again
+        sampler.set_epoch(4)
+        self.assertEqual(list(resumed), list(sampler))
+
+
+class TestSnappedGridGeoSampler(SamplerTestCase):
+    def test_aligned(self):
+        # Sizes and strides in pixels are rounded to whole pixels
+        sampler = SnappedGridGeoSampler(self.dataset, (40.4, 39.6), (16.3, 15.8))
+        grid = PixelGrid.from_dataset(self.dataset)
+        np.testing.assert_allclose(sampler.size, (40 * grid.res, 40 * grid.res))
+        np.testing.assert_allclose(sampler.stride, (16 * grid.res, 16 * grid.res))
+
+        boxes = list(sampler)
+        self.assertEqual(len(boxes), len(sampler))
+        self.assertGreater(len(boxes), 0)
+        windows = [grid.window(box) for box in boxes]
+        for window in windows:
+            self.assertIsNotNone(window)
+            self.assertEqual(window[2:], (40, 40))
+
+        # Patches of a row are a stride apart
+        for previous, window in zip(windows, windows[1:]):
+            if window[0] == previous[0]:
+                self.assertEqual(window[1] - previous[1], 16)
+
+    def test_footprint(self):
+        footprint = FootprintIndex(self.dataset, cell_size=8)
+        sampler = SnappedGridGeoSampler(self.dataset, 40, 16, footprint=footprint)
+        expected = [
+            box
+            for box in SnappedGridGeoSampler(self.dataset, 40, 16)
+            if footprint.contains(*box)
+        ]
+        self.assertGreater(len(expected), 0)
+        self.assertLess(len(expected), len(SnappedGridGeoSampler(self.dataset, 40, 16)))
+        self.assertEqual(list(sampler), expected)
+        self.assertEqual(len(sampler), len(expected))
+
+        # The footprint is only looked up when the sampler is made
+        footprint.contains = None
+        self.assertEqual(list(sampler), expected)
+
+
+class TestPrefetchBatchSampler(SamplerTestCase):
+    class FailingSampler:
+        """Yields two batches, then fails."""
+
+        def __iter__(self):
+            yield [1]
+            yield [2]
+            raise ValueError("sampler failed")
+
+        def __len__(self):
+            return 3
+
+    def make_sampler(self):
+        return SeededRandomBatchGeoSampler(self.dataset, 40, 8, 80, seed=0)
+
+    def test_batches(self):
+        expected = list(self.make_sampler())
+        prefetch = PrefetchBatchSampler(self.make_sampler(), queue_size=2)
+        self.assertEqual(len(prefetch), len(expected))
+        self.assertEqual(list(prefetch), expected)
+        self.assertEqual(prefetch.prefetch_stats.batches, len(expected))
+
+        # The next epoch follows on, as it does for the wrapped sampler
+        sampler = self.make_sampler()
+        sampler.set_epoch(1)
+        self.assertEqual(list(prefetch), list(sampler))
+
+    def test_errors(self):
+        batches = iter(PrefetchBatchSampler(self.FailingSampler()))
+        self.assertEqual([next(batches), next(batches)], [[1], [2]])
+        with self.assertRaisesRegex(ValueError, "sampler failed"):
+            next(batches)
+
+    def test_state_dict(self):
+        expected = list(self.make_sampler())
+        prefetch = PrefetchBatchSampler(self.make_sampler(), queue_size=4)
+        batches = iter(prefetch)
+        for _ in range(3):
+            next(batches)
+
+        # Wait for the thread to draw batches ahead of those taken
+        deadline = time.monotonic() + 10
+        while prefetch.sampler.batches_yielded <= 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertGreater(prefetch.sampler.batches_yielded, 3)
+
+        state_dict = prefetch.state_dict()
+        batches.close()
+        self.assertEqual(state_dict["batches_yielded"], 3)
+
+        resumed = PrefetchBatchSampler(self.make_sampler())
+        resumed.load_state_dict(state_dict)
+        self.assertEqual(list(resumed), expected[3:])
+
+
+class ConstrainedSamplerTestCase(SamplerTestCase):
+    def check_batches(self, sampler, burn_prop):
+        required = math.ceil(burn_prop * sampler.batch_size)
+        batches = list(sampler)
+        self.assertEqual(len(batches), len(sampler))
+        for batch in batches:
+            self.assertEqual(len(batch), sampler.batch_size)
+            burned = [
+                self.brute_force(self.modis_file(box), box)[0] > 0 for box in batch
+            ]
+            self.assertEqual(sum(burned), required)
+        return batches
+
+
+class TestBurnWeightedBatchGeoSampler(ConstrainedSamplerTestCase):
+    def test_strata(self):
+        for burn_prop in [0.0, 0.25, 0.5, 1.0]:
+            sampler = BurnWeightedBatchGeoSampler(
+                self.dataset, 40, 8, 80, burn_prop, seed=0
+            )
+            self.check_batches(sampler, burn_prop)
+
+    def test_snapped_strata(self):
+        sampler = BurnWeightedBatchGeoSampler(
+            self.dataset, 40, 8, 80, 0.5, seed=0, snap=True
+        )
+        grid = PixelGrid.from_dataset(self.dataset)
+        for batch in self.check_batches(sampler, 0.5):
+            for box in batch:
+                self.assertEqual(grid.window(box)[2:], (40, 40))
+
+    def test_seeded(self):
+        batches = [
+            list(BurnWeightedBatchGeoSampler(self.dataset, 40, 8, 80, 0.5, seed=1))
+            for _ in range(2)
+        ]
+        self.assertEqual(batches[0], batches[1])
+
+
+class TestConstrainedRandomBatchGeoSampler(ConstrainedSamplerTestCase):
+    sampler_cls = ConstrainedRandomBatchGeoSampler
+
+    def make_sampler(self, **kwargs):
+        burn_index = BurnIndex(self.dataset)
+        return self.sampler_cls(
+            self.dataset, 40, 8, 32, 0.5, burn_index=burn_index, seed=0, **kwargs
+        )
+
+    def never_burned(self, sampler):
+        """Makes a sampler classify every candidate as not burned."""
+
+        sampler.get_burn_proportion = lambda bounding_box: 0.0
+
+    def test_constraints(self):
+        self.check_batches(self.make_sampler(), 0.5)
+
+    def test_max_attempts(self):
+        sampler = self.make_sampler(max_attempts=3)
+        self.never_burned(sampler)
+        with self.assertRaises(RuntimeError):
+            sampler.get_batch()
+
+        # The requirements are reset for the next batch
+        self.assertEqual(sampler.burn_samples_required, 4)
+        self.assertEqual(sampler.not_burned_samples_required, 4)
+
+    def test_fill_on_failure(self):
+        sampler = self.make_sampler(max_attempts=3, fill_on_failure=True)
+        self.never_burned(sampler)
+        with self.assertWarns(UserWarning):
+            batch = sampler.get_batch()
+        self.assertEqual(len(batch), 8)
+
+
+class TestVectorizedConstrainedRandomBatchGeoSampler(
+    TestConstrainedRandomBatchGeoSampler
+):
+    sampler_cls = VectorizedConstrainedRandomBatchGeoSampler
+
+    def never_burned(self, sampler):
+        sampler.get_burned_pixels = lambda bounds, candidates: np.zeros(
+            candidates.shape[1]
+        )
+
+
+class TestAdaptiveConstrainedRandomBatchGeoSampler(
+    TestVectorizedConstrainedRandomBatchGeoSampler
+):
+    sampler_cls = AdaptiveConstrainedRandomBatchGeoSampler
+
+    def test_resume(self):
+        sampler = self.make_sampler()
+        expected = list(sampler) + list(sampler)
+
+        interrupted = self.make_sampler()
+        batches = iter(interrupted)
+        for _ in range(2):
+            next(batches)
+        state_dict = interrupted.state_dict()
+
+        # The resumed sampler learns the same yields as the uninterrupted one
+        resumed = self.make_sampler()
+        resumed.load_state_dict(state_dict)
+        self.assertEqual(list(resumed) + list(resumed), expected[2:])
+        for name, value in sampler.tile_scheduler.state_dict().items():
+            np.testing.assert_array_equal(
+                resumed.tile_scheduler.state_dict()[name], value
+            )
+
+    def test_tile_switches(self):
+        # A single tile (one month) is never switched, however many rounds it takes
+        bounds = self.dataset.bounds
+        hit = next(iter(self.dataset.index.intersection(tuple(bounds), objects=True)))
+        roi = BoundingBox(*bounds[:4], *hit.bounds[4:])
+        sampler = self.make_sampler(roi=roi, num_candidates=2)
+        self.check_batches(sampler, 0.5)
+        self.assertGreater(sampler.stats.candidates, 2 * len(sampler))
+        self.assertEqual(sampler.stats.tile_switches, 0)
+
+
+class TestTileScheduler(unittest.TestCase):
+    class Hit:
+        def __init__(self, mint):
+            self.bounds = (0, 1, 0, 1, mint, mint + 1)
+
+    def make_scheduler(self):
+        # Two tiles in the first month and one in the second
+        return TileScheduler([self.Hit(0), self.Hit(0), self.Hit(10)], prior=10.0)
+
+    def test_prior(self):
+        scheduler = self.make_scheduler()
+        np.testing.assert_allclose(scheduler.yields(), [0.5, 0.5, 0.5])
+
+        # The other tile of the month starts at the month yield
+        scheduler.update(0, 10, 10)
+        month = 11 / 12
+        np.testing.assert_allclose(
+            scheduler.yields(), [(10 + 10 * month) / 20, month, 0.5]
+        )
+
+    def test_choose(self):
+        scheduler = self.make_scheduler()
+        scheduler.update(0, 100, 90)
+        scheduler.update(2, 100, 0)
+        weights = scheduler.yields() / scheduler.yields().sum()
+        self.assertGreater(weights[0], weights[1])
+        self.assertGreater(weights[1], weights[2])
+
+        generator = np.random.default_rng(0)
+        tiles = [scheduler.choose(generator) for _ in range(4000)]
+        np.testing.assert_allclose(
+            np.bincount(tiles, minlength=3) / len(tiles), weights, atol=0.03
+        )
+
+    def test_state_dict(self):
+        scheduler = self.make_scheduler()
+        scheduler.update(1, 20, 5)
+        restored = self.make_scheduler()
+        restored.load_state_dict(scheduler.state_dict())
+        np.testing.assert_array_equal(restored.yields(), scheduler.yields())
+
+        # The state is a copy
+        scheduler.update(1, 20, 5)
+        self.assertFalse(np.array_equal(restored.yields(), scheduler.yields()))
+
+
+class TestSamplerStats(ConstrainedSamplerTestCase):
+    def test_epoch(self):
+        sampler = ConstrainedRandomBatchGeoSampler(
+            self.dataset, 40, 8, 32, 0.5, burn_index=BurnIndex(self.dataset), seed=0
+        )
+
+        # Count the candidates classified and the tiles chosen
+        calls = {"candidates": 0, "tiles": 0}
+        get_burn_proportion = sampler.get_burn_proportion
+        get_random_tile = sampler.get_random_tile
+
+        def count_candidate(bounding_box):
+            calls["candidates"] += 1
+            return get_burn_proportion(bounding_box)
+
+        def count_tile():
+            calls["tiles"] += 1
+            return get_random_tile()
+
+        sampler.get_burn_proportion = count_candidate
+        sampler.get_random_tile = count_tile
+
+        for epoch in range(2):
+            calls.update(candidates=0, tiles=0)
+            self.check_batches(sampler, 0.5)
+
+            # The stats only cover the last epoch
+            stats = sampler.stats
+            self.assertEqual(stats.batches, len(sampler))
+            self.assertEqual(stats.burned, 4 * len(sampler))
+            self.assertEqual(stats.not_burned, 4 * len(sampler))
+            self.assertEqual(stats.candidates, calls["candidates"])
+            self.assertEqual(stats.tile_switches, calls["tiles"] - len(sampler))
+            self.assertEqual(stats.reads, 0)
+            self.assertGreater(stats.time, 0)
+            self.assertAlmostEqual(
+                stats.acceptance_rate, 8 * len(sampler) / calls["candidates"]
+            )
+
+        logged = stats.as_dict()
+        expected = {
+            "batches": len(sampler),
+            "candidates": stats.candidates,
+            "burned": stats.burned,
+            "not_burned": stats.not_burned,
+            "tile_switches": stats.tile_switches,
+            "reads": 0,
+            "time": stats.time,
+            "acceptance_rate": stats.acceptance_rate,
+            "candidates_per_batch": stats.candidates / len(sampler),
+            "tile_switches_per_batch": stats.tile_switches / len(sampler),
+            "reads_per_batch": 0,
+            "time_per_batch": stats.time / len(sampler),
+        }
+        self.assertEqual(set(logged), {f"sampler/{name}" for name in expected})
+        for name, value in expected.items():
+            self.assertAlmostEqual(logged[f"sampler/{name}"], value)
+        self.assertEqual(set(stats.as_dict("train/")), {f"train/{n}" for n in expected})
+
+        stats.reset()
+        self.assertTrue(all(value == 0 for value in stats.as_dict().values()))
+        self.assertEqual(stats.acceptance_rate, 0.0)
+
+
+def binarize(sample):
+    """Transform of the tests, so that transformed samples differ from raw ones."""
+
+    sample["mask"] = (sample["mask"] > 0).long()
+    return sample
+
+
+class TestStagedRandomBatchGeoSampler(SamplerTestCase):
+    max_fractions = {"invalid": 0.2, "unobserved": 0.05, "nonburnable": 0.0}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        crs, res = cls.landcover.crs, cls.landcover.res
+        cls.images = (
+            cls.landcover
+            & MODIS_JD(cls.roots["modis"], crs, res, transforms=binarize)
+            & Sentinel2(cls.roots["sentinel"], crs, res)
+        )
+
+    def assertSamplesEqual(self, sample, expected):
+        for key in ["image", "mask"]:
+            self.assertEqual(sample[key].dtype, expected[key].dtype)
+            torch.testing.assert_close(sample[key], expected[key], rtol=0, atol=0)
+        self.assertEqual(sample["bbox"], expected["bbox"])
+
+    def make_sampler(self, **kwargs):
+        return StagedRandomBatchGeoSampler(
+            self.images, 24, 8, 40, self.max_fractions, seed=0, **kwargs
+        )
+
+    def test_fractions(self):
+        sampler = self.make_sampler()
+        batches = list(sampler)
+        self.assertEqual(len(batches), len(sampler))
+        for batch in batches:
+            self.assertEqual(len(batch), 8)
+            for box in batch:
+                julian_day = self.modis[box]["mask"].numpy()
+                classes = self.landcover[box]["image"].numpy()
+                self.assertLessEqual((classes == 0).mean(), 0.2)
+                self.assertLessEqual((julian_day == -1).mean(), 0.05)
+                self.assertLessEqual((julian_day == -2).mean(), 0.0)
+
+        # Each candidate reads both label layers
+        stats = sampler.stats
+        self.assertEqual(stats.burned + stats.not_burned, 8 * len(sampler))
+        self.assertEqual(stats.reads, 2 * stats.candidates)
+
+    def test_failed_reads(self):
+        sampler = self.make_sampler()
+        box = next(iter(sampler))[0]
+        outside = BoundingBox(box.minx, box.maxx, box.miny, box.maxy, 0, 1)
+        reads = sampler.stats.reads
+        self.assertIsNone(sampler.read_labels(outside))
+        self.assertEqual(sampler.stats.reads, reads)
+
+    def test_reuse_labels(self):
+        sampler = self.make_sampler(reuse_labels=True)
+        boxes = [box for batch in sampler for box in batch]
+        expected = [self.images[BoundingBox(*box)] for box in boxes]
+        for box in boxes:
+            self.assertIsInstance(box, LabelledBoundingBox)
+            np.testing.assert_array_equal(
+                box.labels[sampler.modis_index], self.modis[box]["mask"].numpy()
+            )
+            np.testing.assert_array_equal(
+                box.labels[sampler.landcover_index],
+                self.landcover[box]["image"].numpy(),
+            )
+
+        # The label layers are not read again
+        readers = [
+            LabelledReader(self.images),
+            ConcurrentReader(self.images, read_threads=2),
+        ]
+        leaves = readers[0].leaves
+        for ds in leaves[:2]:
+            ds._merge_files = None
+        try:
+            coalesced = CoalescingReader(self.images)[boxes]
+            for box, sample, expected_sample in zip(boxes, coalesced, expected):
+                for reader in readers:
+                    self.assertSamplesEqual(reader[box], expected_sample)
+                self.assertSamplesEqual(sample, expected_sample)
+        finally:
+            for ds in leaves[:2]:
+                del ds._merge_files
+
+
+class TestSampleCatalogue(ConstrainedSamplerTestCase):
+    def build_catalogue(self):
+        sampler = VectorizedConstrainedRandomBatchGeoSampler(
+            self.dataset, 40, 8, 32, 0.5, seed=0
+        )
+        return sampler.build_catalogue(64)
+
+    def test_build(self):
+        catalogue = self.build_catalogue()
+        self.assertGreaterEqual(len(catalogue), 64)
+        for box, burn_prop in zip(catalogue.boxes, catalogue.burn_prop):
+            box = BoundingBox(*box)
+            burned, total = self.brute_force(self.modis_file(box), box)
+            self.assertAlmostEqual(burn_prop, burned / total, places=6)
+
+    def test_save_load(self):
+        catalogue = self.build_catalogue()
+        catalogue.fingerprint = SampleCatalogue.get_fingerprint(
+            self.dataset, self.dataset.bounds, 40, Units.PIXELS
+        )
+        path = SampleCatalogue.get_path(self.tmp.name, catalogue.fingerprint)
+        catalogue.save(path)
+
+        loaded = SampleCatalogue.load(path, catalogue.fingerprint)
+        np.testing.assert_array_equal(loaded.boxes, catalogue.boxes)
+        np.testing.assert_array_equal(loaded.burn_prop, catalogue.burn_prop)
+        np.testing.assert_array_equal(loaded.tile, catalogue.tile)
+        self.assertIsNone(SampleCatalogue.load(path, "other"))
+
+    def test_sampler(self):
+        catalogue = self.build_catalogue()
+        sampler = CatalogueBatchGeoSampler(
+            self.dataset, 40, 8, 80, 0.25, catalogue, seed=0
+        )
+        self.check_batches(sampler, 0.25)
+
+
+class TestPatchCatalogue(SamplerTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.catalogue = PatchCatalogue.build(cls.dataset, 40, blocksize=4)
+
+    def test_query(self):
+        catalogue = self.catalogue
+        unobserved, landcover = catalogue["unobserved"], catalogue["landcover_0"]
+        queried = catalogue.query(
+            {"unobserved": (None, 0.05), "landcover_0": [0.1, 0.9]}
+        )
+        rows = (unobserved <= 0.05) & (landcover >= 0.1) & (landcover <= 0.9)
+        self.assertGreater(rows.sum(), 0)
+        np.testing.assert_array_equal(queried.boxes, catalogue.boxes[rows])
+        np.testing.assert_array_equal(
+            queried["landcover"], catalogue["landcover"][rows]
+        )
+
+    def test_query_errors(self):
+        with self.assertRaises(ValueError):
+            self.catalogue.query({"__import__('os')": (0, 1)})
+        with self.assertRaises(ValueError):
+            self.catalogue.query({"landcover": (0, 1)})
+        with self.assertRaises(ValueError):
+            self.catalogue.query({"burn_prop": (0,)})
+
+    def test_fingerprint(self):
+        args = (self.dataset, self.dataset.bounds, 40, Units.PIXELS)
+        fingerprints = {
+            PatchCatalogue.get_fingerprint(*args),
+            PatchCatalogue.get_fingerprint(*args, stride=20),
+            PatchCatalogue.get_fingerprint(*args, blocksize=8),
+        }
+        self.assertEqual(len(fingerprints), 3)
+
+
+suite = unittest.TestSuite(
+    [
+        unittest.TestLoader().loadTestsFromTestCase(TestBurnIndex),
+        unittest.TestLoader().loadTestsFromTestCase(TestFootprintIndex),
+        unittest.TestLoader().loadTestsFromTestCase(TestSeededRandomBatchGeoSampler),
+        unittest.TestLoader().loadTestsFromTestCase(TestSnappedGridGeoSampler),
+        unittest.TestLoader().loadTestsFromTestCase(TestPrefetchBatchSampler),
+        unittest.TestLoader().loadTestsFromTestCase(TestBurnWeightedBatchGeoSampler),
+        unittest.TestLoader().loadTestsFromTestCase(
+            TestConstrainedRandomBatchGeoSampler
+        ),
+        unittest.TestLoader().loadTestsFromTestCase(
+            TestVectorizedConstrainedRandomBatchGeoSampler
+        ),
+        unittest.TestLoader().loadTestsFromTestCase(
+            TestAdaptiveConstrainedRandomBatchGeoSampler
+        ),
+        unittest.TestLoader().loadTestsFromTestCase(TestTileScheduler),
+        unittest.TestLoader().loadTestsFromTestCase(TestSamplerStats),
+        unittest.TestLoader().loadTestsFromTestCase(TestStagedRandomBatchGeoSampler),
+        unittest.TestLoader().loadTestsFromTestCase(TestSampleCatalogue),
+        unittest.TestLoader().loadTestsFromTestCase(TestPatchCatalogue),
+    ]
+)
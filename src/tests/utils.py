@@ -0,0 +1,140 @@
+import os
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from typing import Dict, Optional, Sequence
+
+# Grid of the synthetic landcover (the reference dataset of the tests)
+LANDCOVER_ORIGIN = (27.0, 51.6)
+LANDCOVER_RES = 0.0002
+LANDCOVER_SHAPE = (250, 500)
+
+MONTHS = ("202003", "202004")
+SENTINEL_BANDS = ("B03", "B08", "B11")
+
+# Grid of the synthetic ERA5 Land files, and its cell without data
+ERA5_ORIGIN = (26.96, 51.64)
+ERA5_RES = 0.02
+ERA5_SHAPE = (8, 10)
+ERA5_NAN_CELL = (3, 4)
+ERA5_VARIABLES = ("snowc", "sd", "t2m", "swvl1")
+
+
+def write_raster(
+    path: str,
+    data: np.ndarray,
+    x0: float,
+    y0: float,
+    res: float,
+    dtype: str,
+    nodata: Optional[float] = None,
+    descriptions: Optional[Sequence[str]] = None,
+) -> None:
+    """Writes a (bands, height, width) or (height, width) array to a GeoTIFF in
+    EPSG:4326, with its top-left corner at (x0, y0)."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if data.ndim == 2:
+        data = data[None]
+
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=data.shape[1],
+        width=data.shape[2],
+        count=data.shape[0],
+        dtype=dtype,
+        crs="EPSG:4326",
+        transform=from_origin(x0, y0, res, res),
+        nodata=nodata,
+    ) as dst:
+        dst.write(data.astype(dtype))
+        if descriptions is not None:
+            dst.descriptions = tuple(descriptions)
+
+
+def make_roots(root: str, seed: int = 0) -> Dict[str, str]:
+    """Writes small synthetic landcover, MODIS_JD and Sentinel 2 roots.
+
+    - landcover: random classes 1-9 within an ellipse, 0 (no data) outside it.
+    - modis: one file per month, on a coarser grid offset from the landcover, with
+      about 5% of the pixels burned.
+    - sentinel: two tiles in the first month and one in the second, all bands with a
+      strip of no data (0) along their left edge.
+    - era5: one file per variable and month, on a grid of a few cells around the
+      landcover, with one cell of no data (NaN).
+
+    Returns:
+        roots: the directory of each dataset, keyed by "landcover", "modis",
+            "sentinel" and "era5".
+    """
+
+    rng = np.random.default_rng(seed)
+    roots = {name: os.path.join(root, name) for name in ("landcover", "modis")}
+    roots["sentinel"] = os.path.join(root, "sentinel")
+    roots["era5"] = os.path.join(root, "era5")
+
+    height, width = LANDCOVER_SHAPE
+    classes = rng.integers(1, 10, (height, width))
+    yy, xx = np.mgrid[:height, :width]
+    outside = ((xx - width / 2) / (width * 0.48)) ** 2 + (
+        (yy - height / 2) / (height * 0.48)
+    ) ** 2 > 1
+    classes[outside] = 0
+    write_raster(
+        os.path.join(roots["landcover"], "Polesia_Simple.tif"),
+        classes,
+        *LANDCOVER_ORIGIN,
+        LANDCOVER_RES,
+        "uint8",
+    )
+
+    for i, month in enumerate(MONTHS):
+        julian_day = np.zeros((30, 50))
+        julian_day[rng.random((30, 50)) < 0.05] = 60 + i * 30
+        julian_day[rng.random((30, 50)) < 0.02] = -1
+        write_raster(
+            os.path.join(
+                roots["modis"],
+                f"{month}01-ESACCI-L3S_FIRE-BA-MODIS-AREA_3-fv5.1-JD.tif",
+            ),
+            julian_day,
+            26.99,
+            51.61,
+            0.0025,
+            "int16",
+        )
+
+        tiles = [(10, 26.995), (11, 27.05)] if i == 0 else [(10, 26.995)]
+        for tile, x0 in tiles:
+            for band in SENTINEL_BANDS:
+                # Reflectances in (0, 1), as pull_monthly_cloudless_sentinel exports
+                values = rng.random((130, 120)) * 0.99 + 0.01
+                values[:, :10] = 0
+                write_raster(
+                    os.path.join(roots["sentinel"], f"{month}_{tile}_{band}.tif"),
+                    values,
+                    x0,
+                    51.605,
+                    0.0005,
+                    "float32",
+                )
+
+    # Drawn last, so that the other datasets do not depend on them
+    for month in MONTHS:
+        for variable in ERA5_VARIABLES:
+            values = rng.random(ERA5_SHAPE)
+            values[ERA5_NAN_CELL] = np.nan
+            write_raster(
+                os.path.join(
+                    roots["era5"], f"era5-land_monthly_{variable}_{month}01.tiff"
+                ),
+                values,
+                *ERA5_ORIGIN,
+                ERA5_RES,
+                "float32",
+                nodata=np.nan,
+            )
+
+    return roots
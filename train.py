@@ -44,11 +44,29 @@ def main(conf):
         modis_root_dir=conf["datamodule"]["modis_root_dir"],
         landcover_root_dir=conf["datamodule"]["landcover_root_dir"],
         sentinel_root_dir=conf["datamodule"]["sentinel_root_dir"],
+        era5_root_dir=conf["datamodule"]["era5_root_dir"],
         patch_size=conf["datamodule"]["patch_size"],
         length=conf["datamodule"]["length"],
         batch_size=conf["datamodule"]["batch_size"],
         num_workers=conf["datamodule"]["num_workers"],
         balance_samples=conf["datamodule"]["balance_samples"],
+        catalogue_dir=conf["datamodule"]["catalogue_dir"],
+        log_sampler_stats=conf["datamodule"]["log_sampler_stats"],
+        prefetch_batches=conf["datamodule"]["prefetch_batches"],
+        chip_store_dir=conf["datamodule"]["chip_store_dir"],
+        sentinel_stacked=conf["datamodule"]["sentinel_stacked"],
+        share_landcover=conf["datamodule"]["share_landcover"],
+        block_cache_mb=conf["datamodule"]["block_cache_mb"],
+        landcover_on_device=conf["datamodule"]["landcover_on_device"],
+        compact_dtypes=conf["datamodule"]["compact_dtypes"],
+        collate_buffers=conf["datamodule"]["collate_buffers"],
+        pin_memory=conf["datamodule"]["pin_memory"],
+        coalesce_reads=conf["datamodule"]["coalesce_reads"],
+        read_threads=conf["datamodule"]["read_threads"],
+        patch_validity=conf["datamodule"]["patch_validity"],
+        footprint_cell_size=conf["datamodule"]["footprint_cell_size"],
+        footprint_path=conf["datamodule"]["footprint_path"],
+        seed=conf["program"]["seed"],
     )
 
     model = SemanticSegmentationTask(
@@ -90,7 +108,12 @@ def main(conf):
         callbacks=callbacks,
         fast_dev_run=conf["trainer"]["fast_dev_run"],
         default_root_dir=conf["trainer"]["default_root_dir"],
-        gpus=conf["trainer"]["gpus"],
+        accelerator=conf["trainer"]["accelerator"],
+        devices=conf["trainer"]["devices"],
+        strategy=conf["trainer"]["strategy"],
+        num_nodes=conf["trainer"]["num_nodes"],
+        # the datamodule samplers split each epoch across processes themselves
+        replace_sampler_ddp=False,
         max_epochs=conf["trainer"]["max_epochs"],
         log_every_n_steps=conf["trainer"]["log_every_n_steps"],
         precision=conf["trainer"]["precision"],